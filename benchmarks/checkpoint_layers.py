@@ -0,0 +1,142 @@
+# Copyright Universitat Pompeu Fabra 2020-2023  https://www.compscience.org
+# Distributed under the MIT License.
+# (See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
+
+"""
+Benchmark script for per-layer activation checkpointing during training.
+For each model, it measures the peak GPU memory and the time of a training step with forces
+(energy and force loss, backpropagated through the double backward) on a batch of copies of a molecule,
+with and without checkpoint_layers.
+
+"""
+import os
+import time
+import torch
+from os.path import dirname, join
+import yaml
+from moleculekit.molecule import Molecule
+from moleculekit.periodictable import periodictable
+from tabulate import tabulate
+from torchmdnet.models.model import create_model
+
+
+def load_example_args(model_name, config_file=None, **kwargs):
+    if config_file is None:
+        if model_name == "tensornet":
+            config_file = join(dirname(dirname(__file__)), "examples", "TensorNet-QM9.yaml")
+        else:
+            config_file = join(dirname(dirname(__file__)), "examples", "ET-QM9.yaml")
+    with open(config_file, "r") as f:
+        args = yaml.load(f, Loader=yaml.FullLoader)
+    args["model"] = model_name
+    args["seed"] = 1234
+    args["prior_model"] = None
+    args["derivative"] = True
+    args["precision"] = 32
+    args.update(kwargs)
+    return args
+
+
+def load_batch(pdb_file, batch_size, device):
+    molecule = Molecule(pdb_file)
+    z = torch.tensor(
+        [periodictable[symbol].number for symbol in molecule.element], dtype=torch.long
+    )
+    pos = torch.tensor(molecule.coords[:, :, 0], dtype=torch.float32)
+    # Copies of the molecule, slightly displaced so that they are not identical
+    z = z.repeat(batch_size)
+    pos = pos.repeat(batch_size, 1) + 0.05 * torch.randn(batch_size * len(pos), 3)
+    batch = torch.arange(batch_size).repeat_interleave(len(molecule.element))
+    return z.to(device), pos.to(device), batch.to(device)
+
+
+def benchmark_training(model_name, z, pos, batch, nbench=20, **kwargs):
+    args = load_example_args(model_name, max_z=int(z.max() + 1), **kwargs)
+    model = create_model(args).to(z.device)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-5)
+    num_samples = int(batch.max() + 1)
+    ref_y = torch.zeros(num_samples, 1, device=z.device)
+    ref_neg_dy = torch.zeros_like(pos)
+
+    def step():
+        optimizer.zero_grad()
+        y, neg_dy = model(z, pos, batch)
+        loss = (y - ref_y).pow(2).mean() + (neg_dy - ref_neg_dy).pow(2).mean()
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(3):
+        step()
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(nbench):
+        step()
+    torch.cuda.synchronize()
+    interval = (time.perf_counter() - start) * 1000 / nbench
+    memory = torch.cuda.max_memory_allocated() / 2**20
+    return interval, memory
+
+
+# List of cases to benchmark, arbitrary parameters can be overriden here
+cases = {
+    "ET 8L": ("equivariant-transformer", {"num_layers": 8}),
+    "TensorNet 4L": ("tensornet", {"num_layers": 4}),
+    "GN 8L": ("graph-network", {"num_layers": 8}),
+}
+
+
+def benchmark_all(pdb_file="testosterone.pdb", batch_sizes=(32, 128)):
+    device = "cuda"
+    table_data = [
+        [
+            "Model (batch size)",
+            "Time (ms)",
+            "Time ckpt (ms)",
+            "Memory (MiB)",
+            "Memory ckpt (MiB)",
+        ]
+    ]
+    for batch_size in batch_sizes:
+        torch.manual_seed(1234)
+        z, pos, batch = load_batch(os.path.join("systems", pdb_file), batch_size, device)
+        for name, (model_name, kwargs) in cases.items():
+            results = []
+            for checkpoint_layers in [False, True]:
+                torch.cuda.empty_cache()
+                results.append(
+                    benchmark_training(
+                        model_name,
+                        z,
+                        pos,
+                        batch,
+                        checkpoint_layers=checkpoint_layers,
+                        **kwargs,
+                    )
+                )
+            (time_ref, memory_ref), (time_ckpt, memory_ckpt) = results
+            table_data.append(
+                [
+                    f"{name} ({batch_size})",
+                    round(time_ref, 2),
+                    round(time_ckpt, 2),
+                    round(memory_ref),
+                    round(memory_ckpt),
+                ]
+            )
+    table = tabulate(
+        table_data,
+        headers="firstrow",
+        tablefmt="pretty",
+        showindex=False,
+        stralign="center",
+        numalign="center",
+        colalign=("center",),
+    )
+    print(f"Training step with forces on copies of {pdb_file}")
+    print(table)
+
+
+if __name__ == "__main__":
+    benchmark_all()
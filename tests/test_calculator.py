@@ -74,3 +74,54 @@ def test_compare_forward_multiple():
 
     assert_allclose(e_calc, e_pred)
     assert_allclose(f_calc, f_pred.view(-1, len(z1), 3))
+
+
+@pytest.mark.parametrize("per_replica_box", [True, False])
+def test_compare_forward_replicas(per_replica_box):
+    checkpoint = join(dirname(dirname(__file__)), "tests", "example.ckpt")
+    n_replicas = 4
+    z, pos, _ = create_example_batch(multiple_batches=False)
+    calc = External(checkpoint, z.unsqueeze(0), num_replicas=n_replicas)
+    model = load_model(checkpoint, derivative=True)
+
+    torch.manual_seed(1234)
+    pos = pos.unsqueeze(0) + 0.1 * torch.randn(n_replicas, *pos.shape)
+    if per_replica_box:
+        box = torch.eye(3).repeat(n_replicas, 1, 1) * torch.linspace(12, 15, n_replicas).view(-1, 1, 1)
+    else:
+        box = 12 * torch.eye(3)
+    e_calc, f_calc = calc.calculate(pos, box)
+    assert e_calc.shape == (n_replicas, 1)
+    assert f_calc.shape == (n_replicas, len(z), 3)
+    for i in range(n_replicas):
+        e_pred, f_pred = model(z, pos[i], torch.zeros_like(z), box[i] if per_replica_box else box)
+        assert_allclose(e_calc[i], e_pred[0])
+        assert_allclose(f_calc[i], f_pred)
+
+
+def test_reuse_buffers():
+    checkpoint = join(dirname(dirname(__file__)), "tests", "example.ckpt")
+    z, pos, _ = create_example_batch(multiple_batches=False)
+    calc = External(checkpoint, z.unsqueeze(0))
+    calc_buffers = External(checkpoint, z.unsqueeze(0), reuse_buffers=True)
+    box = 12 * torch.eye(3)
+
+    e_calc, f_calc = calc.calculate(pos, box)
+    e_buf, f_buf = calc_buffers.calculate(pos, box)
+    assert_allclose(e_calc, e_buf)
+    assert_allclose(f_calc, f_buf)
+
+    # Subsequent calls write to the same buffers
+    pos_ptr = calc_buffers._pos_buffer.data_ptr()
+    e_buf2, f_buf2 = calc_buffers.calculate(pos + 0.1, box)
+    assert e_buf2.data_ptr() == e_buf.data_ptr()
+    assert f_buf2.data_ptr() == f_buf.data_ptr()
+    assert calc_buffers._pos_buffer.data_ptr() == pos_ptr
+    assert_allclose(f_buf2, calc.calculate(pos + 0.1, box)[1])
+
+    # Or to the ones provided by the user
+    out = (torch.empty(1, 1), torch.empty(1, len(z), 3))
+    e_out, f_out = calc_buffers.calculate(pos, box, out=out)
+    assert e_out is out[0] and f_out is out[1]
+    assert_allclose(e_out, e_calc)
+    assert_allclose(f_out, f_calc)
@@ -3,8 +3,10 @@
 # (See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
 
 from pytest import mark
+import numpy as np
 import torch
-from torchmdnet.data import DataModule
+from torch.utils.data import Subset
+from torchmdnet.data import DataModule, DynamicBatchSampler, ChunkedShuffleSampler
 from utils import load_example_args, DummyDataset
 
 
@@ -86,3 +88,67 @@ def test_datamodule_standardize(energy, forces, has_atomref, tmpdir):
     else:
         # the data module should not have mean and std set if the dataset does not include energies
         assert data.mean is None and data.std is None
+
+
+@mark.parametrize("metric", ["atoms", "edges"])
+@mark.parametrize("num_replicas", [1, 3])
+def test_dynamic_batch_sampler(metric, num_replicas):
+    sizes = np.random.default_rng(0).integers(1, 30, 500)
+    max_size = 400 if metric == "edges" else 60
+    samplers = [
+        DynamicBatchSampler(sizes, max_size, metric=metric, max_num_neighbors=10, shuffle=True, seed=1,
+                            num_replicas=num_replicas, rank=rank)
+        for rank in range(num_replicas)
+    ]
+    cost = sizes * np.minimum(sizes - 1, 10) if metric == "edges" else sizes
+    seen = []
+    for sampler in samplers:
+        batches = list(sampler)
+        assert len(batches) == len(sampler) == len(samplers[0])
+        for batch in batches:
+            assert len(batch) == 1 or cost[batch].sum() <= max_size
+            seen.extend(batch)
+    # Every sample is visited, some are repeated to even out the processes
+    assert set(seen) == set(range(len(sizes)))
+    assert len(seen) < len(sizes) + num_replicas * max(len(b) for b in samplers[0])
+
+    # The order changes between epochs
+    first_epoch = list(samplers[0])
+    samplers[0].set_epoch(1)
+    assert list(samplers[0]) != first_epoch
+
+
+def test_datamodule_dynamic_batch_size(tmpdir):
+    args = load_example_args("graph-network")
+    args["train_size"] = 800
+    args["val_size"] = 100
+    args["test_size"] = 100
+    args["log_dir"] = tmpdir
+    args["dynamic_batch_size"] = 50
+
+    dataset = DummyDataset()
+    data = DataModule(args, dataset=dataset)
+    data.prepare_data()
+    data.setup("fit")
+    for batch in data._get_dataloader(data.train_dataset, "train", store_dataloader=False):
+        assert batch.z.numel() <= 50
+
+
+@mark.parametrize("window_blocks", [1, 3])
+def test_chunked_shuffle_sampler(window_blocks):
+    dataset = DummyDataset(num_samples=100)
+    subset = Subset(dataset, np.random.default_rng(0).permutation(100)[:96])
+    block_size = 8
+    sampler = ChunkedShuffleSampler(subset, block_size, window_blocks=window_blocks, seed=1)
+    order = list(sampler)
+    assert len(order) == len(sampler) == 96
+    assert sorted(order) == list(range(96))
+    # Each window only spans a few blocks of the underlying dataset
+    base_indices = np.asarray(subset.indices)[order]
+    window = block_size * window_blocks
+    for start in range(0, 96, window):
+        ranks = np.searchsorted(np.sort(subset.indices), base_indices[start : start + window])
+        assert len(np.unique(ranks // block_size)) <= window_blocks
+
+    sampler.set_epoch(1)
+    assert list(sampler) != order
@@ -49,7 +49,7 @@ def write_sample_npy_files(energy, forces, tmpdir, num_files):
 @mark.parametrize("energy", [True, False])
 @mark.parametrize("forces", [True, False])
 @mark.parametrize("num_files", [1, 3])
-@mark.parametrize("preload", [True, False])
+@mark.parametrize("preload", [True, False, "shared"])
 def test_custom(energy, forces, num_files, preload, tmpdir):
     # set up necessary files
     n_atoms_per_sample = write_sample_npy_files(energy, forces, tmpdir, num_files)
@@ -69,9 +69,12 @@ def test_custom(energy, forces, num_files, preload, tmpdir):
         energyglob=join(tmpdir, "energy*") if energy else None,
         forceglob=join(tmpdir, "forces*") if forces else None,
         preload_memory_limit=256 if preload else 0,
+        preload_shared=preload == "shared",
+        shared_memory_dir=str(tmpdir),
     )
 
     assert len(data) == len(n_atoms_per_sample), "Number of samples does not match"
+    assert np.array_equal(data.sizes, n_atoms_per_sample), "Sizes do not match"
     sample = data[0]
     assert hasattr(sample, "pos"), "Sample doesn't contain coords"
     assert hasattr(sample, "z"), "Sample doesn't contain atom numbers"
@@ -158,7 +161,7 @@ def test_write_as_hdf5(energy, forces, tmpdir):
             ), "Dataset has incorrect forces shape"
 
 
-@mark.parametrize("preload", [True, False])
+@mark.parametrize("preload", [True, False, "shared"])
 @mark.parametrize(("energy", "forces"), [(True, False), (False, True), (True, True)])
 @mark.parametrize("num_files", [1, 3])
 def test_hdf5(preload, energy, forces, num_files, tmpdir):
@@ -175,9 +178,24 @@ def test_hdf5(preload, energy, forces, num_files, tmpdir):
     # Assert file is present in the disk
     assert os.path.isfile(join(tmpdir, "test.hdf5")), "HDF5 file was not created"
 
-    data = HDF5(join(tmpdir, "test.hdf5"), dataset_preload_limit=256 if preload else 0)
+    data = HDF5(
+        join(tmpdir, "test.hdf5"),
+        dataset_preload_limit=256 if preload else 0,
+        preload_shared=preload == "shared",
+        shared_memory_dir=str(tmpdir),
+    )
+    if preload == "shared":
+        # Other instances, e.g. in other ranks, attach to the same arrays
+        shared = glob.glob(join(tmpdir, "torchmdnet-*"))
+        assert len(shared) == 1
+        other = HDF5(
+            join(tmpdir, "test.hdf5"), preload_shared=True, shared_memory_dir=str(tmpdir)
+        )
+        assert glob.glob(join(tmpdir, "torchmdnet-*")) == shared
+        assert np.allclose(other[len(other) - 1].pos, data[len(data) - 1].pos)
 
     assert len(data) == len(n_atoms_per_sample), "Number of samples does not match"
+    assert np.array_equal(data.sizes, n_atoms_per_sample), "Sizes do not match"
     sample = data[0]
     assert hasattr(sample, "pos"), "Sample doesn't contain coords"
     assert hasattr(sample, "z"), "Sample doesn't contain atom numbers"
@@ -270,6 +288,10 @@ def test_ace(tmpdir):
 
     dataset = Ace(root=tmpdir, paths=tmpfilename)
     assert len(dataset) == 6
+    assert np.array_equal(dataset.sizes, [3] * 6)
+    # All atoms are within the cutoff of each other
+    assert np.array_equal(dataset.neighbor_counts(10.0), [6] * 6)
+    assert os.path.isfile(join(dataset.processed_dir, "Ace.neighbors_10.mmap"))
     f.flush()
     f.close()
     # Test Version 2.0
@@ -297,3 +319,153 @@ def test_ace(tmpdir):
     assert len(dataset_v2) == 6
     f2.flush()
     f2.close()
+
+
+def test_growing_memmap(tmpdir):
+    from torchmdnet.datasets.memdataset import _GrowingMemmap
+
+    fname = join(tmpdir, "test.mmap")
+    writer = _GrowingMemmap(fname, np.float32, (None, 3), chunk_bytes=16)
+    values = [np.random.random((n, 3)) for n in [1, 5, 2, 0, 7]]
+    for v in values:
+        writer.append(v)
+    writer.close()
+    stored = np.fromfile(fname, dtype=np.float32).reshape(-1, 3)
+    assert np.allclose(stored, np.concatenate(values).astype(np.float32))
+
+
+def test_ace_shards(tmpdir):
+    tmpfilename = join(tmpdir, "molecule.h5")
+    with h5py.File(tmpfilename, "w") as f:
+        f.attrs["layout"] = "Ace"
+        f.attrs["layout_version"] = "2.0"
+        master_mol_group = f.create_group("master_molecule_group")
+        for m in range(3):
+            mol = master_mol_group.create_group(f"mol_{m+1}")
+            mol["atomic_numbers"] = [1, 6, 8][: m + 1]
+            mol["formal_charges"] = [0, 0, 0][: m + 1]
+            mol["positions"] = np.random.random((2, m + 1, 3))
+            mol["positions"].attrs["units"] = "Å"
+            mol["formation_energies"] = np.random.random(2)
+            mol["formation_energies"].attrs["units"] = "eV"
+            mol["forces"] = np.random.random((2, m + 1, 3))
+            mol["forces"].attrs["units"] = "eV/Å"
+            mol["partial_charges"] = np.random.random((2, m + 1))
+            mol["partial_charges"].attrs["units"] = "e"
+            mol["dipole_moments"] = np.random.random((2, 3))
+            mol["dipole_moments"].attrs["units"] = "e*Å"
+
+    # Each file is a shard, they are merged in order
+    dataset = Ace(root=tmpdir, paths=[tmpfilename, tmpfilename])
+    assert len(dataset) == 12
+    assert np.array_equal(dataset.sizes, [1, 1, 2, 2, 3, 3] * 2)
+    for i in range(6):
+        a, b = dataset[i], dataset[i + 6]
+        for key in ["z", "pos", "y", "neg_dy", "q", "pq", "dp"]:
+            assert np.allclose(a[key], b[key])
+    assert not os.path.exists(join(dataset.processed_dir, f"{dataset.name}.shards"))
+
+    # Fetching whole batches gives the same result as collating the samples
+    from torch_geometric.data import Batch
+
+    for indices in [[3, 0, 7, 11], [2, 3, 4, 5]]:
+        expected = Batch.from_data_list([dataset[i] for i in indices])
+        batch = dataset.get_batch(indices)
+        for key in ["z", "pos", "y", "neg_dy", "q", "pq", "dp", "batch", "ptr"]:
+            assert batch[key].dtype == expected[key].dtype
+            assert np.allclose(batch[key], expected[key])
+
+
+@mark.parametrize("compression, pos_dtype", [("zlib", "float32"), ("lzma", "float16"), ("none", "int16")])
+def test_ace_chunked(compression, pos_dtype, tmpdir):
+    tmpfilename = join(tmpdir, "molecule.h5")
+    with h5py.File(tmpfilename, "w") as f:
+        f.attrs["layout"] = "Ace"
+        f.attrs["layout_version"] = "2.0"
+        master_mol_group = f.create_group("master_molecule_group")
+        for m in range(4):
+            mol = master_mol_group.create_group(f"mol_{m+1}")
+            mol["atomic_numbers"] = [1, 6, 8, 7][: m + 1]
+            mol["formal_charges"] = [0, 0, 0, 1][: m + 1]
+            mol["positions"] = 10 * np.random.random((3, m + 1, 3)) - 5
+            mol["positions"].attrs["units"] = "Å"
+            mol["formation_energies"] = np.random.random(3)
+            mol["formation_energies"].attrs["units"] = "eV"
+            mol["forces"] = np.random.random((3, m + 1, 3))
+            mol["forces"].attrs["units"] = "eV/Å"
+            mol["partial_charges"] = np.random.random((3, m + 1))
+            mol["partial_charges"].attrs["units"] = "e"
+            mol["dipole_moments"] = np.random.random((3, 3))
+            mol["dipole_moments"].attrs["units"] = "e*Å"
+
+    paths = [tmpfilename, tmpfilename]
+    dataset = Ace(root=tmpdir, paths=paths)
+    chunked = Ace(root=tmpdir, paths=paths, storage="chunked", compression=compression,
+                  pos_dtype=pos_dtype, chunk_size=5, chunk_cache_size=2)
+    assert len(chunked) == len(dataset) == 24
+    assert np.array_equal(chunked.sizes, dataset.sizes)
+    # Chunks do not span shards
+    assert np.array_equal(chunked.chunks_mm[:, 0], [0, 5, 10, 12, 17, 22, 24])
+
+    # Only the positions are stored with loss
+    pos_tol = {"float32": 0, "float16": 1e-2, "int16": 5 / 32767}[pos_dtype]
+    for i in np.random.permutation(len(dataset)):
+        a, b = dataset[i], chunked[i]
+        for key in ["z", "y", "neg_dy", "q", "pq", "dp"]:
+            assert a[key].dtype == b[key].dtype
+            assert np.array_equal(a[key], b[key])
+        assert b.pos.dtype == a.pos.dtype
+        assert np.allclose(a.pos, b.pos, rtol=0, atol=pos_tol)
+    assert len(chunked._chunk_cache) == 2
+
+    for indices in [[3, 0, 17, 11, 23], [5, 6, 7, 8, 9]]:
+        expected = dataset.get_batch(indices)
+        batch = chunked.get_batch(indices)
+        for key in ["z", "y", "neg_dy", "q", "pq", "dp", "batch", "ptr"]:
+            assert batch[key].dtype == expected[key].dtype
+            assert np.array_equal(batch[key], expected[key])
+        assert np.allclose(batch.pos, expected.pos, rtol=0, atol=pos_tol)
+
+    # Loading the chunks with different options is an error
+    with pytest.raises(ValueError):
+        Ace(root=tmpdir, paths=paths, storage="chunked", compression=compression, pos_dtype=pos_dtype, chunk_size=6)
+
+
+def test_ace_neighbor_pairs(tmpdir):
+    tmpfilename = join(tmpdir, "molecule.h5")
+    with h5py.File(tmpfilename, "w") as f:
+        f.attrs["layout"] = "Ace"
+        f.attrs["layout_version"] = "2.0"
+        master_mol_group = f.create_group("master_molecule_group")
+        for m in range(3):
+            mol = master_mol_group.create_group(f"mol_{m+1}")
+            mol["atomic_numbers"] = [1, 6, 8, 7, 1][: m + 3]
+            mol["formal_charges"] = [0, 0, 0, 0, 0][: m + 3]
+            mol["positions"] = 3 * np.random.random((2, m + 3, 3))
+            mol["positions"].attrs["units"] = "Å"
+            mol["formation_energies"] = np.random.random(2)
+            mol["formation_energies"].attrs["units"] = "eV"
+            mol["forces"] = np.random.random((2, m + 3, 3))
+            mol["forces"].attrs["units"] = "eV/Å"
+            mol["partial_charges"] = np.random.random((2, m + 3))
+            mol["partial_charges"].attrs["units"] = "e"
+            mol["dipole_moments"] = np.random.random((2, 3))
+            mol["dipole_moments"].attrs["units"] = "e*Å"
+
+    cutoff = 2.5
+    dataset = Ace(root=tmpdir, paths=tmpfilename, neighbor_cutoff=cutoff)
+    assert os.path.isfile(join(dataset.processed_dir, f"{dataset.name}.edge_idx_2.5.mmap"))
+    for data in dataset:
+        distance = np.linalg.norm(data.pos[:, None] - data.pos[None, :], axis=-1)
+        expected = {(i, j) for i, j in zip(*np.nonzero(distance < cutoff)) if i != j}
+        assert set(map(tuple, data.neighbor_index.T.tolist())) == expected
+    assert np.array_equal(np.diff(dataset.edge_ptr), dataset.neighbor_counts(cutoff))
+
+    # The pairs are offset by the atoms of the previous samples when batched
+    from torch_geometric.data import Batch
+
+    indices = [4, 0, 5, 2]
+    expected = Batch.from_data_list([dataset[i] for i in indices])
+    batch = dataset.get_batch(indices)
+    assert batch.neighbor_index.dtype == expected.neighbor_index.dtype
+    assert np.array_equal(batch.neighbor_index, expected.neighbor_index)
@@ -11,7 +11,7 @@ import lightning as pl
 from torchmdnet import models
 from torchmdnet.models.model import create_model
 from torchmdnet.models import output_modules
-from torchmdnet.models.utils import dtype_mapping
+from torchmdnet.models.utils import dtype_mapping, tabulate_radial_functions
 
 from utils import load_example_args, create_example_batch
 
@@ -227,3 +227,217 @@ def test_gradients(model_name):
     torch.autograd.gradcheck(
         model, (z, pos, batch), eps=1e-4, atol=1e-3, rtol=1e-2, nondet_tol=1e-3
     )
+
+
+@mark.parametrize("model_name", models.__all_models__)
+def test_precomputed_neighbors(model_name):
+    args = load_example_args(model_name, remove_prior=True, derivative=True, precision=64)
+    pl.seed_everything(1234)
+    model = create_model(args)
+    pl.seed_everything(1234)
+    model_precomputed = create_model(dict(args, precomputed_neighbors=True))
+    z, pos, batch = create_example_batch(n_atoms=10)
+    pos = pos.to(torch.float64)
+
+    # All pairs of atoms of the same sample, in any order, the model keeps the ones within its cutoff
+    i, j = torch.nonzero((batch[:, None] == batch[None, :]) & ~torch.eye(len(z), dtype=torch.bool)).T
+    perm = torch.randperm(len(i))
+    neighbor_index = torch.stack([i[perm], j[perm]])
+
+    y, neg_dy = model(z, pos, batch)
+    y_pre, neg_dy_pre = model_precomputed(z, pos, batch, extra_args={"neighbor_index": neighbor_index})
+    torch.testing.assert_close(y_pre, y)
+    torch.testing.assert_close(neg_dy_pre, neg_dy)
+    # Without the pairs the model searches for them
+    y_search, _ = model_precomputed(z, pos, batch)
+    torch.testing.assert_close(y_search, y)
+
+
+@mark.parametrize("option", ["fused_message_passing", "compact_representation"])
+@mark.parametrize("equivariance_invariance_group", ["O(3)", "SO(3)"])
+@mark.parametrize("script", [False, True])
+def test_tensornet_compact(option, equivariance_invariance_group, script):
+    args = load_example_args(
+        "tensornet",
+        remove_prior=True,
+        derivative=True,
+        precision=64,
+        equivariance_invariance_group=equivariance_invariance_group,
+    )
+    pl.seed_everything(1234)
+    model = create_model(args)
+    pl.seed_everything(1234)
+    model_fused = create_model(dict(args, **{option: True}))
+    if script:
+        model_fused = torch.jit.script(model_fused)
+    z, pos, batch = create_example_batch(n_atoms=10)
+    pos = pos.to(torch.float64)
+
+    y, neg_dy = model(z, pos, batch)
+    y_fused, neg_dy_fused = model_fused(z, pos, batch)
+    torch.testing.assert_close(y_fused, y)
+    torch.testing.assert_close(neg_dy_fused, neg_dy)
+
+    # Training with forces differentiates the forces with respect to the parameters
+    params = list(model.parameters())
+    params_fused = list(model_fused.parameters())
+    grads = torch.autograd.grad((y.sum() + neg_dy.pow(2).sum()), params)
+    grads_fused = torch.autograd.grad((y_fused.sum() + neg_dy_fused.pow(2).sum()), params_fused)
+    for grad, grad_fused in zip(grads, grads_fused):
+        torch.testing.assert_close(grad_fused, grad)
+
+
+@mark.parametrize("distance_influence", ["none", "keys", "values", "both"])
+@mark.parametrize("vector_cutoff", [False, True])
+def test_et_fused_attention(distance_influence, vector_cutoff):
+    args = load_example_args(
+        "equivariant-transformer",
+        remove_prior=True,
+        derivative=True,
+        precision=64,
+        distance_influence=distance_influence,
+        vector_cutoff=vector_cutoff,
+    )
+    pl.seed_everything(1234)
+    model = create_model(args)
+    pl.seed_everything(1234)
+    model_fused = create_model(dict(args, fused_attention=True))
+    z, pos, batch = create_example_batch(n_atoms=10)
+    pos = pos.to(torch.float64)
+
+    y, neg_dy = model(z, pos, batch)
+    y_fused, neg_dy_fused = model_fused(z, pos, batch)
+    torch.testing.assert_close(y_fused, y)
+    torch.testing.assert_close(neg_dy_fused, neg_dy)
+
+    # Training with forces differentiates the forces with respect to the parameters
+    grads = torch.autograd.grad(y.sum() + neg_dy.pow(2).sum(), list(model.parameters()))
+    grads_fused = torch.autograd.grad(
+        y_fused.sum() + neg_dy_fused.pow(2).sum(), list(model_fused.parameters())
+    )
+    for grad, grad_fused in zip(grads, grads_fused):
+        torch.testing.assert_close(grad_fused, grad)
+
+
+@mark.parametrize("model_name", models.__all_models__)
+def test_sorted_edges(model_name):
+    args = load_example_args(model_name, remove_prior=True, derivative=True, precision=64)
+    pl.seed_everything(1234)
+    model = create_model(args)
+    pl.seed_everything(1234)
+    model_sorted = create_model(dict(args, sorted_edges=True))
+    z, pos, batch = create_example_batch(n_atoms=10)
+    pos = pos.to(torch.float64)
+
+    y, neg_dy = model(z, pos, batch)
+    y_sorted, neg_dy_sorted = model_sorted(z, pos, batch)
+    torch.testing.assert_close(y_sorted, y)
+    torch.testing.assert_close(neg_dy_sorted, neg_dy)
+
+    # Training with forces differentiates the forces with respect to the parameters
+    grads = torch.autograd.grad(y.sum() + neg_dy.pow(2).sum(), list(model.parameters()))
+    grads_sorted = torch.autograd.grad(
+        y_sorted.sum() + neg_dy_sorted.pow(2).sum(), list(model_sorted.parameters())
+    )
+    for grad, grad_sorted in zip(grads, grads_sorted):
+        torch.testing.assert_close(grad_sorted, grad)
+    # The sorted models can be scripted
+    torch.jit.script(model_sorted)(z, pos, batch)
+
+
+@mark.parametrize(
+    ("model_name", "static_shapes"),
+    [("graph-network", False), ("transformer", False), ("tensornet", False), ("tensornet", True)],
+)
+@mark.parametrize("sorted_edges", [False, True])
+def test_half_list(model_name, static_shapes, sorted_edges):
+    args = load_example_args(model_name, remove_prior=True, derivative=True, precision=64)
+    args = dict(args, static_shapes=static_shapes, sorted_edges=sorted_edges)
+    pl.seed_everything(1234)
+    model = create_model(args)
+    pl.seed_everything(1234)
+    model_half = create_model(dict(args, half_list=True))
+    z, pos, batch = create_example_batch(n_atoms=10)
+    pos = pos.to(torch.float64)
+
+    y, neg_dy = model(z, pos, batch)
+    y_half, neg_dy_half = model_half(z, pos, batch)
+    torch.testing.assert_close(y_half, y)
+    torch.testing.assert_close(neg_dy_half, neg_dy)
+
+    grads = torch.autograd.grad(y.sum() + neg_dy.pow(2).sum(), list(model.parameters()))
+    grads_half = torch.autograd.grad(
+        y_half.sum() + neg_dy_half.pow(2).sum(), list(model_half.parameters())
+    )
+    for grad, grad_half in zip(grads, grads_half):
+        torch.testing.assert_close(grad_half, grad)
+    torch.jit.script(model_half)(z, pos, batch)
+
+
+@mark.parametrize("model_name", models.__all_models__)
+def test_tabulated_radial_functions(model_name):
+    args = load_example_args(model_name, remove_prior=True, derivative=True, precision=64)
+    model = create_model(args)
+    z, pos, batch = create_example_batch(n_atoms=10)
+    pos = pos.to(torch.float64)
+    y, neg_dy = model(z, pos, batch)
+
+    model = torch.jit.script(tabulate_radial_functions(model))
+    y_tab, neg_dy_tab = model(z, pos, batch)
+    torch.testing.assert_close(y_tab, y, rtol=1e-5, atol=1e-6)
+    torch.testing.assert_close(neg_dy_tab, neg_dy, rtol=1e-4, atol=1e-5)
+
+
+@mark.parametrize("model_name", ["graph-network", "equivariant-transformer", "tensornet"])
+def test_checkpoint_layers(model_name):
+    args = load_example_args(model_name, remove_prior=True, derivative=True, precision=64)
+    pl.seed_everything(1234)
+    model = create_model(args)
+    pl.seed_everything(1234)
+    model_ckpt = create_model(dict(args, checkpoint_layers=True))
+    z, pos, batch = create_example_batch(n_atoms=10)
+    pos = pos.to(torch.float64)
+
+    # Checkpointing is only active in training mode, where the forces are part of the graph
+    model.train()
+    model_ckpt.train()
+    y, neg_dy = model(z, pos, batch)
+    y_ckpt, neg_dy_ckpt = model_ckpt(z, pos, batch)
+    torch.testing.assert_close(y_ckpt, y)
+    torch.testing.assert_close(neg_dy_ckpt, neg_dy)
+
+    grads = torch.autograd.grad(y.sum() + neg_dy.pow(2).sum(), list(model.parameters()))
+    grads_ckpt = torch.autograd.grad(
+        y_ckpt.sum() + neg_dy_ckpt.pow(2).sum(), list(model_ckpt.parameters())
+    )
+    for grad, grad_ckpt in zip(grads, grads_ckpt):
+        torch.testing.assert_close(grad_ckpt, grad)
+    torch.jit.script(model_ckpt.eval())(z, pos, batch)
+
+
+@mark.parametrize("model_name", models.__all_models__)
+def test_edge_forces(model_name):
+    args = load_example_args(model_name, remove_prior=True, derivative=True, precision=64)
+    pl.seed_everything(1234)
+    model = create_model(args)
+    pl.seed_everything(1234)
+    model_edge = create_model(dict(args, edge_forces=True))
+    z, pos, batch = create_example_batch(n_atoms=10)
+    pos = pos.to(torch.float64)
+
+    model.train()
+    model_edge.train()
+    y, neg_dy = model(z, pos, batch)
+    y_edge, neg_dy_edge = model_edge(z, pos, batch)
+    torch.testing.assert_close(y_edge, y)
+    torch.testing.assert_close(neg_dy_edge, neg_dy)
+
+    grads = torch.autograd.grad(y.sum() + neg_dy.pow(2).sum(), list(model.parameters()))
+    grads_edge = torch.autograd.grad(
+        y_edge.sum() + neg_dy_edge.pow(2).sum(), list(model_edge.parameters())
+    )
+    for grad, grad_edge in zip(grads, grads_edge):
+        torch.testing.assert_close(grad_edge, grad)
+
+    y_edge, neg_dy_edge = torch.jit.script(model_edge.eval())(z, pos, batch)
+    torch.testing.assert_close(neg_dy_edge, neg_dy.detach())
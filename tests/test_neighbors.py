@@ -7,7 +7,7 @@ import pytest
 import torch
 import torch.jit
 import numpy as np
-from torchmdnet.models.utils import OptimizedDistance
+from torchmdnet.models.utils import OptimizedDistance, edge_ptr
 
 def sort_neighbors(neighbors, deltas, distances):
     i_sorted = np.lexsort(neighbors)
@@ -69,7 +69,7 @@ def compute_ref_neighbors(pos, batch, loop, include_transpose, cutoff, box_vecto
     return ref_neighbors, ref_distance_vecs, ref_distances
 
 
-@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cuda", "brute"), ("cuda", "shared"), ("cuda", "cell")])
+@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cpu", "cell"), ("cuda", "brute"), ("cuda", "shared"), ("cuda", "cell")])
 @pytest.mark.parametrize("n_batches", [1, 2, 3, 4, 128])
 @pytest.mark.parametrize("cutoff", [0.1, 1.0, 3.0, 4.9])
 @pytest.mark.parametrize("loop", [True, False])
@@ -81,10 +81,8 @@ def test_neighbors(
 ):
     if device == "cuda" and not torch.cuda.is_available():
         pytest.skip("CUDA not available")
-    if box_type == "triclinic" and strategy == "cell":
-        pytest.skip("Triclinic not supported for cell")
-    if device == "cpu" and strategy != "brute":
-        pytest.skip("Only brute force supported on CPU")
+    if device == "cuda" and box_type == "triclinic" and strategy == "cell":
+        pytest.skip("Triclinic not supported for cell on CUDA")
     torch.manual_seed(4321)
     n_atoms_per_batch = torch.randint(3, 100, size=(n_batches,))
     batch = torch.repeat_interleave(
@@ -141,7 +139,7 @@ def test_neighbors(
     assert np.allclose(distances, ref_distances)
     assert np.allclose(distance_vecs, ref_distance_vecs)
 
-@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cuda", "brute"), ("cuda", "shared"), ("cuda", "cell")])
+@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cpu", "cell"), ("cuda", "brute"), ("cuda", "shared"), ("cuda", "cell")])
 @pytest.mark.parametrize("loop", [True, False])
 @pytest.mark.parametrize("include_transpose", [True, False])
 @pytest.mark.parametrize("dtype", [torch.float32, torch.float64])
@@ -153,10 +151,8 @@ def test_neighbor_grads(
 ):
     if not torch.cuda.is_available() and device == "cuda":
         pytest.skip("No GPU")
-    if device == "cpu" and strategy != "brute":
-        pytest.skip("Only brute force supported on CPU")
-    if box_type == "triclinic" and strategy == "cell":
-        pytest.skip("Triclinic only supported for brute force")
+    if device == "cuda" and box_type == "triclinic" and strategy == "cell":
+        pytest.skip("Triclinic not supported for cell on CUDA")
     cutoff = 4.999999
     lbox = 10.0
     torch.random.manual_seed(1234)
@@ -249,7 +245,7 @@ def test_neighbor_grads(
     else:
         assert np.allclose(ref_pos_grad_sorted, pos_grad_sorted, atol=1e-8, rtol=1e-5)
 
-@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cuda", "brute"), ("cuda", "shared"), ("cuda", "cell")])
+@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cpu", "cell"), ("cuda", "brute"), ("cuda", "shared"), ("cuda", "cell")])
 @pytest.mark.parametrize("loop", [True, False])
 @pytest.mark.parametrize("include_transpose", [True, False])
 @pytest.mark.parametrize("num_atoms", [1,2,10])
@@ -259,10 +255,8 @@ def test_neighbor_autograds(
 ):
     if not torch.cuda.is_available() and device == "cuda":
         pytest.skip("No GPU")
-    if device == "cpu" and strategy != "brute":
-        pytest.skip("Only brute force supported on CPU")
-    if box_type == "triclinic" and strategy == "cell":
-        pytest.skip("Triclinic only supported for brute force")
+    if device == "cuda" and box_type == "triclinic" and strategy == "cell":
+        pytest.skip("Triclinic not supported for cell on CUDA")
     dtype = torch.float64
     cutoff = 4.999999
     lbox = 10.0
@@ -353,7 +347,7 @@ def test_large_size(strategy, n_batches):
     assert np.allclose(distances, ref_distances)
     assert np.allclose(distance_vecs, ref_distance_vecs)
 
-@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cuda", "brute"), ("cuda", "shared"), ("cuda", "cell")])
+@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cpu", "cell"), ("cuda", "brute"), ("cuda", "shared"), ("cuda", "cell")])
 @pytest.mark.parametrize("n_batches", [1, 128])
 @pytest.mark.parametrize("cutoff", [1.0])
 @pytest.mark.parametrize("loop", [True, False])
@@ -365,10 +359,8 @@ def test_jit_script_compatible(
 ):
     if device == "cuda" and not torch.cuda.is_available():
         pytest.skip("CUDA not available")
-    if box_type == "triclinic" and strategy == "cell":
-        pytest.skip("Triclinic only supported for brute force")
-    if device == "cpu" and strategy != "brute":
-        pytest.skip("Only brute force supported on CPU")
+    if device == "cuda" and box_type == "triclinic" and strategy == "cell":
+        pytest.skip("Triclinic not supported for cell on CUDA")
     torch.manual_seed(4321)
     n_atoms_per_batch = torch.randint(3, 100, size=(n_batches,))
     batch = torch.repeat_interleave(
@@ -578,7 +570,7 @@ def test_cuda_graph_compatible_backward(
         torch.cuda.synchronize()
 
 
-@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cuda", "brute"), ("cuda", "shared")])
+@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cpu", "cell"), ("cuda", "brute"), ("cuda", "shared")])
 @pytest.mark.parametrize("n_batches", [1, 128])
 @pytest.mark.parametrize("use_forward", [True, False])
 def test_per_batch_box(
@@ -590,8 +582,6 @@ def test_per_batch_box(
     loop = True
     if device == "cuda" and not torch.cuda.is_available():
         pytest.skip("CUDA not available")
-    if device == "cpu" and strategy != "brute":
-        pytest.skip("Only brute force supported on CPU")
     torch.manual_seed(4321)
     n_atoms_per_batch = torch.randint(3, 100, size=(n_batches,))
     batch = torch.repeat_interleave(
@@ -639,3 +629,137 @@ def test_per_batch_box(
     assert np.allclose(neighbors, ref_neighbors)
     assert np.allclose(distances, ref_distances)
     assert np.allclose(distance_vecs, ref_distance_vecs)
+
+
+@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cpu", "cell"), ("cuda", "brute"), ("cuda", "shared"), ("cuda", "cell")])
+@pytest.mark.parametrize("include_transpose", [True, False])
+def test_max_num_pairs_exceeded(device, strategy, include_transpose):
+    if device == "cuda" and not torch.cuda.is_available():
+        pytest.skip("CUDA not available")
+    torch.manual_seed(4321)
+    n_atoms = 50
+    cutoff = 3.0
+    pos = torch.rand(n_atoms, 3, device=device) * 5.0
+    batch = torch.zeros(n_atoms, dtype=torch.long, device=device)
+    ref_neighbors, _, _ = compute_ref_neighbors(
+        pos, batch, False, include_transpose, cutoff, None
+    )
+    num_ref_pairs = ref_neighbors.shape[1]
+    max_num_pairs = num_ref_pairs // 2
+    nl = OptimizedDistance(
+        cutoff_lower=0.0,
+        cutoff_upper=cutoff,
+        max_num_pairs=max_num_pairs,
+        strategy=strategy,
+        include_transpose=include_transpose,
+        check_errors=True,
+    )
+    with pytest.raises(AssertionError):
+        nl(pos, batch)
+    nl.check_errors = False
+    neighbors, distances, _ = nl(pos, batch)
+    assert neighbors.shape == (2, max_num_pairs)
+    assert distances.shape == (max_num_pairs,)
+    assert (distances < cutoff).all()
+
+
+@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cpu", "cell"), ("cuda", "brute"), ("cuda", "shared"), ("cuda", "cell")])
+@pytest.mark.parametrize("loop", [True, False])
+@pytest.mark.parametrize("include_transpose", [True, False])
+@pytest.mark.parametrize("box_type", [None, "rectangular"])
+@pytest.mark.parametrize("resize_to_fit", [True, False])
+def test_verlet_skin(device, strategy, loop, include_transpose, box_type, resize_to_fit):
+    if device == "cuda" and not torch.cuda.is_available():
+        pytest.skip("CUDA not available")
+    torch.manual_seed(4321)
+    n_atoms = 100
+    cutoff = 2.0
+    skin = 0.5
+    lbox = 10.0
+    box = None
+    if box_type == "rectangular":
+        box = torch.eye(3, device=device) * lbox
+    pos = torch.rand(n_atoms, 3, device=device) * lbox
+    batch = torch.zeros(n_atoms, dtype=torch.long, device=device)
+    args = dict(
+        cutoff_lower=0.1,
+        cutoff_upper=cutoff,
+        max_num_pairs=-n_atoms,
+        loop=loop,
+        strategy=strategy,
+        box=box,
+        return_vecs=True,
+        include_transpose=include_transpose,
+        resize_to_fit=resize_to_fit,
+    )
+    nl_ref = OptimizedDistance(**args)
+    nl = torch.jit.script(OptimizedDistance(skin=skin, **args))
+    for step in range(20):
+        # Small random displacements trigger a rebuild every few steps
+        pos = pos + (torch.rand_like(pos) - 0.5) * 0.1
+        pos.requires_grad_(True)
+        ref = [t.cpu().detach().numpy() for t in nl_ref(pos, batch)]
+        neighbors, distances, distance_vecs = nl(pos, batch)
+        distances.sum().backward()
+        grad = pos.grad.clone()
+        pos.grad = None
+        # Padding is only compared through the valid pairs
+        neighbors = neighbors.cpu().numpy()
+        mask = neighbors[0] != -1
+        neighbors, distance_vecs, distances = sort_neighbors(
+            neighbors[:, mask],
+            distance_vecs.cpu().detach().numpy()[mask],
+            distances.cpu().detach().numpy()[mask],
+        )
+        mask = ref[0][0] != -1
+        ref_neighbors, ref_distance_vecs, ref_distances = sort_neighbors(
+            ref[0][:, mask], ref[2][mask], ref[1][mask]
+        )
+        assert np.array_equal(neighbors, ref_neighbors)
+        assert np.allclose(distances, ref_distances, atol=1e-5)
+        assert np.allclose(distance_vecs, ref_distance_vecs, atol=1e-5)
+        ref_grad = torch.autograd.grad(nl_ref(pos, batch)[1].sum(), pos)[0]
+        assert torch.allclose(grad, ref_grad, atol=1e-5)
+        pos = pos.detach()
+
+
+@pytest.mark.parametrize(("device", "strategy"), [("cpu", "brute"), ("cpu", "cell"), ("cuda", "brute"), ("cuda", "shared"), ("cuda", "cell")])
+@pytest.mark.parametrize("resize_to_fit", [True, False])
+def test_sort_edges(device, strategy, resize_to_fit):
+    if device == "cuda" and not torch.cuda.is_available():
+        pytest.skip("CUDA not available")
+    torch.manual_seed(4321)
+    n_atoms = 100
+    pos = torch.rand(n_atoms, 3, device=device) * 10.0
+    batch = torch.zeros(n_atoms, dtype=torch.long, device=device)
+    args = dict(
+        cutoff_upper=2.0,
+        max_num_pairs=-n_atoms,
+        loop=True,
+        strategy=strategy,
+        return_vecs=True,
+        resize_to_fit=resize_to_fit,
+    )
+    ref = OptimizedDistance(**args)(pos, batch)
+    neighbors, distances, distance_vecs = torch.jit.script(
+        OptimizedDistance(sort_edges=True, **args)
+    )(pos, batch)
+    num_pairs = int((neighbors[0] != -1).sum())
+    # Valid pairs first, sorted by their first atom, then the padding
+    assert (neighbors[:, num_pairs:] == -1).all()
+    assert (neighbors[0, :num_pairs].diff() >= 0).all()
+    ptr = edge_ptr(neighbors[0, :num_pairs].contiguous(), n_atoms)
+    assert torch.equal(ptr.diff(), torch.bincount(neighbors[0, :num_pairs], minlength=n_atoms))
+
+    mask = ref[0][0] != -1
+    ref_neighbors, ref_vecs, ref_distances = sort_neighbors(
+        ref[0][:, mask].cpu().numpy(), ref[2][mask].cpu().numpy(), ref[1][mask].cpu().numpy()
+    )
+    neighbors, vecs, distances = sort_neighbors(
+        neighbors[:, :num_pairs].cpu().numpy(),
+        distance_vecs[:num_pairs].cpu().numpy(),
+        distances[:num_pairs].cpu().numpy(),
+    )
+    assert np.array_equal(neighbors, ref_neighbors)
+    assert np.allclose(distances, ref_distances)
+    assert np.allclose(vecs, ref_vecs)
@@ -8,6 +8,7 @@ import torch as pt
 from torchmdnet.models.model import create_model
 from torchmdnet.optimize import optimize
 from torchmdnet.models.utils import dtype_mapping
+from utils import load_example_args, create_example_batch
 
 @mark.parametrize("device", ["cpu", "cuda"])
 @mark.parametrize("num_atoms", [10, 100])
@@ -58,3 +59,46 @@ def test_gn(device, num_atoms):
 
     pt.testing.assert_close(ref_energy, energy, rtol=1e-5, atol=1e-5)
     pt.testing.assert_close(ref_gradient, gradient, rtol=1e-4, atol=1e-5)
+
+
+@mark.parametrize("device", ["cpu", "cuda"])
+@mark.parametrize("aggr", ["add", "mean", "max"])
+@mark.parametrize(
+    ["activation", "rbf_type", "trainable_rbf", "cutoff_lower"],
+    [("ssp", "gauss", False, 0.0), ("silu", "expnorm", True, 0.5)],
+)
+def test_gn_fused_cfconv(device, aggr, activation, rbf_type, trainable_rbf, cutoff_lower):
+
+    if not pt.cuda.is_available() and device == "cuda":
+        pytest.skip("No GPU")
+
+    args = load_example_args(
+        "graph-network",
+        remove_prior=True,
+        derivative=True,
+        precision=64,
+        aggr=aggr,
+        activation=activation,
+        rbf_type=rbf_type,
+        trainable_rbf=trainable_rbf,
+        cutoff_lower=cutoff_lower,
+    )
+    pt.manual_seed(1234)
+    ref_model = create_model(args).to(device)
+    pt.manual_seed(1234)
+    model = create_model(dict(args, fused_cfconv=True)).to(device)
+    z, pos, batch = create_example_batch(n_atoms=10)
+    z, pos, batch = z.to(device), pos.to(device, pt.float64), batch.to(device)
+
+    ref_energy, ref_neg_dy = ref_model(z, pos, batch)
+    energy, neg_dy = model(z, pos, batch)
+    pt.testing.assert_close(energy, ref_energy)
+    pt.testing.assert_close(neg_dy, ref_neg_dy)
+
+    # Training with forces differentiates the forces with respect to the parameters
+    ref_grads = pt.autograd.grad(
+        ref_energy.sum() + ref_neg_dy.pow(2).sum(), list(ref_model.parameters())
+    )
+    grads = pt.autograd.grad(energy.sum() + neg_dy.pow(2).sum(), list(model.parameters()))
+    for grad, ref_grad in zip(grads, ref_grads):
+        pt.testing.assert_close(grad, ref_grad)
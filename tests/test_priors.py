@@ -115,6 +115,34 @@ def test_coulomb(dtype):
     torch.testing.assert_allclose(expected, energy)
 
 
+@pytest.mark.parametrize("method", ["ewald", "pme"])
+def test_coulomb_ewald(method):
+    torch.manual_seed(1234)
+    n_atoms = 20
+    box = torch.tensor([[3.0, 0.0, 0.0], [0.4, 3.2, 0.0], [-0.3, 0.5, 3.5]], dtype=torch.float64)
+    pos = torch.rand(n_atoms, 3, dtype=torch.float64) @ box
+    charge = torch.rand(n_atoms, dtype=torch.float64) - 0.5
+    charge -= charge.mean()
+    types = torch.zeros(n_atoms, dtype=torch.long)
+    batch = torch.zeros(n_atoms, dtype=torch.long)
+    extra_args = {"partial_charges": charge}
+
+    def compute_energy(method, cutoff_distance, pos):
+        coulomb = Coulomb(0.2, 0.4, 50, distance_scale=1e-9, energy_scale=1000.0/6.02214076e23, box_vecs=box,
+                          method=method, cutoff_distance=cutoff_distance, ewald_error_tolerance=1e-6)
+        return coulomb.post_reduce(torch.zeros((1, 1), dtype=pos.dtype), types, pos, batch, extra_args=extra_args)
+
+    # The splitting between real and reciprocal space must not change the result
+    energy = compute_energy(method, 1.0, pos)
+    torch.testing.assert_close(compute_energy(method, 1.4, pos), energy, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(compute_energy("ewald", 1.2, pos), energy, rtol=1e-4, atol=1e-4)
+
+    # Nor moving an atom to a periodic image
+    shifted = pos.clone()
+    shifted[0] += box[1] - box[2]
+    torch.testing.assert_close(compute_energy(method, 1.0, shifted), energy, rtol=1e-6, atol=1e-6)
+
+
 @pytest.mark.parametrize("dtype", [torch.float32, torch.float64])
 def test_multiple_priors(dtype):
     # Create a model from a config file.
@@ -153,3 +181,34 @@ def test_multiple_priors(dtype):
         assert priors2[0].max_num_neighbors == priors[0].max_num_neighbors
         assert priors2[1].cutoff_distance == priors[1].cutoff_distance
         assert priors2[1].max_num_neighbors == priors[1].max_num_neighbors
+
+
+@pytest.mark.parametrize("model_name", models.__all_models__)
+def test_shared_neighbors(model_name):
+    dataset = DummyDataset(has_atomref=True)
+    args = load_example_args(model_name)
+    args["derivative"] = True
+    args["prior_model"] = [
+        {"ZBL": {"cutoff_distance": 4.0, "max_num_neighbors": 50}},
+        {"D2": {"cutoff_distance": 10.0, "max_num_neighbors": 100}},
+    ]
+    prior_models = create_prior_models(args, dataset)
+    z, pos, batch = create_example_batch()
+
+    pl.seed_everything(1234)
+    model = create_model(args, prior_model=prior_models)
+    pl.seed_everything(1234)
+    model_shared = create_model(dict(args, share_neighbors=True), prior_model=prior_models)
+    assert model.shared_distance is None
+    # The list must cover the largest cutoff, the one of D2
+    assert model_shared.shared_distance.cutoff_upper == 10.0
+
+    y, neg_dy = model(z, pos, batch)
+    y_shared, neg_dy_shared = model_shared(z, pos, batch)
+    torch.testing.assert_close(y_shared, y)
+    torch.testing.assert_close(neg_dy_shared, neg_dy)
+
+    model_shared = torch.jit.script(model_shared)
+    y_shared, neg_dy_shared = model_shared(z, pos, batch)
+    torch.testing.assert_close(y_shared, y)
+    torch.testing.assert_close(neg_dy_shared, neg_dy)
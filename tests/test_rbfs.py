@@ -2,9 +2,14 @@
 # Distributed under the MIT License.
 # (See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
 
-from pytest import mark
+from pytest import mark, raises
 import torch
-from torchmdnet.models.utils import rbf_class_mapping
+from torchmdnet.models.utils import (
+    rbf_class_mapping,
+    CosineCutoff,
+    TabulatedFunction,
+    tabulate_radial_functions,
+)
 
 
 @mark.parametrize("name,rbf_class", list(rbf_class_mapping.items()))
@@ -32,3 +37,31 @@ def test_cutoff(name, rbf_class, cutoff_lower, cutoff_upper, y_tol=0.3, x_tol=0.
     ).all(), (
         f"Found entries larger than {y_tol:.1e} above cutoff distance using {name}."
     )
+
+
+@mark.parametrize("cutoff_lower,cutoff_upper", [(0, 5), (1, 5)])
+@mark.parametrize("name,rbf_class", list(rbf_class_mapping.items()))
+def test_tabulated(name, rbf_class, cutoff_lower, cutoff_upper):
+    rbf = rbf_class(cutoff_lower=cutoff_lower, cutoff_upper=cutoff_upper, dtype=torch.float64)
+    cutoff = CosineCutoff(cutoff_lower, cutoff_upper)
+    model = torch.nn.ModuleDict(dict(rbf=rbf, cutoff1=cutoff, cutoff2=CosineCutoff(cutoff_lower, cutoff_upper)))
+    tabulated = tabulate_radial_functions(model)
+    assert isinstance(tabulated.rbf, TabulatedFunction)
+    # Identical cutoffs share a table
+    assert tabulated.cutoff1 is tabulated.cutoff2
+
+    x = torch.linspace(0, cutoff_upper, 1000, dtype=torch.float64, requires_grad=True)
+    for ref, table in [(rbf, tabulated.rbf), (cutoff, tabulated.cutoff1)]:
+        y_ref = ref(x)
+        y = torch.jit.script(table)(x)
+        assert y.shape == y_ref.shape
+        torch.testing.assert_close(y, y_ref, rtol=0, atol=1e-6)
+        dy_ref = torch.autograd.grad(y_ref.sum(), x)[0]
+        dy = torch.autograd.grad(y.sum(), x)[0]
+        torch.testing.assert_close(dy, dy_ref, rtol=0, atol=1e-4 * dy_ref.abs().max().item())
+
+
+def test_tabulated_accuracy_check():
+    model = torch.nn.ModuleDict(dict(rbf=rbf_class_mapping["expnorm"](dtype=torch.float64)))
+    with raises(ValueError):
+        tabulate_radial_functions(model, num_points=16)
@@ -4,6 +4,7 @@
 
 import torch
 from torchmdnet.models.model import load_model
+from torchmdnet.models.utils import tabulate_radial_functions
 import warnings
 
 # dict of preset transforms
@@ -31,7 +32,7 @@ class External:
     netfile : str or torch.nn.Module
         Path to the checkpoint file of the model or the model itself.
     embeddings : torch.Tensor
-        Embeddings of the atoms in the system.
+        Embeddings of the atoms in the system, with shape (n_systems, n_atoms).
     device : str, optional
         Device on which the model should be run. Default: "cpu"
     output_transform : str or callable, optional
@@ -45,6 +46,19 @@ class External:
         Number of steps to run as warmup before recording the CUDA graph. Default: 12
     dtype : torch.dtype or str, optional
         Cast the input to this dtype if defined. If passed as a string it should be a valid torch dtype. Default: torch.float32
+    num_replicas : int, optional
+        Number of replicas of the systems to evaluate together, e.g. for replica exchange or ensembles.
+        The embeddings and batch vector are built once for all replicas, which are evaluated in a single
+        forward pass. Positions are then expected with shape (num_replicas * n_systems, n_atoms, 3), and
+        the box can be shared or given per replica. Default: 1
+    reuse_buffers : bool, optional
+        Copy the inputs and outputs of :meth:`calculate` into buffers that are allocated on the first call and
+        reused afterwards, instead of casting and cloning them every step. The returned energy and forces are then
+        overwritten by the next call. Default: False
+    tabulated_rbf_points : int, optional
+        If positive, the radial basis expansions and cutoff functions of the model are replaced by interpolation
+        tables with this number of points, see :func:`torchmdnet.models.utils.tabulate_radial_functions`.
+        Default: 0
     kwargs : dict, optional
         Extra arguments to pass to the model when loading it.
     """
@@ -58,6 +72,9 @@ class External:
         use_cuda_graph=False,
         cuda_graph_warmup_steps=12,
         dtype=torch.float32,
+        num_replicas=1,
+        reuse_buffers=False,
+        tabulated_rbf_points=0,
         **kwargs,
     ):
         if isinstance(netfile, str):
@@ -84,11 +101,18 @@ class External:
             raise ValueError(
                 f"Expected a path to a checkpoint file or a torch.nn.Module, got {type(netfile)}"
             )
+        if tabulated_rbf_points > 0:
+            self.model = tabulate_radial_functions(self.model, tabulated_rbf_points)
         self.device = device
+        if num_replicas < 1:
+            raise ValueError(f"num_replicas must be positive, got {num_replicas}")
+        embeddings = embeddings.reshape(-1, embeddings.size(-1)).repeat(num_replicas, 1)
+        self.num_replicas = num_replicas
+        self.n_samples = embeddings.size(0)
         self.n_atoms = embeddings.size(1)
         self.embeddings = embeddings.reshape(-1).to(device)
-        self.batch = torch.arange(embeddings.size(0), device=device).repeat_interleave(
-            embeddings.size(1)
+        self.batch = torch.arange(self.n_samples, device=device).repeat_interleave(
+            self.n_atoms
         )
         self.model.eval()
 
@@ -110,6 +134,11 @@ class External:
         self.forces = None
         self.box = None
         self.pos = None
+        self.reuse_buffers = reuse_buffers
+        self._pos_buffer = None
+        self._box_buffer = None
+        self._energy_buffer = None
+        self._forces_buffer = None
         if isinstance(dtype, str):
             try:
                 dtype = getattr(torch, dtype)
@@ -130,26 +159,60 @@ class External:
                     self.embeddings, self.pos, self.batch, self.box
                 )
 
-    def calculate(self, pos, box=None):
+    @staticmethod
+    def _to_buffer(buffer, value, device, dtype):
+        """Copies value into buffer, allocating the buffer only if it does not exist yet or its shape changed."""
+        if buffer is None or buffer.shape != value.shape:
+            buffer = torch.empty(value.shape, device=device, dtype=dtype)
+        buffer.copy_(value)
+        return buffer
+
+    def calculate(self, pos, box=None, out=None):
         """Calculate the energy and forces of the system.
 
         Parameters
         ----------
         pos : torch.Tensor
-            Positions of the atoms in the system.
+            Positions of the atoms in the system, with shape (n_samples, n_atoms, 3), where n_samples is
+            the number of systems times the number of replicas.
         box : torch.Tensor, optional
-            Box vectors of the system. Default: None
+            Box vectors of the system, either shared with shape (3, 3) or one per sample with shape (n_samples, 3, 3). Default: None
+        out : tuple of torch.Tensor, optional
+            Tensors of shape (n_samples, 1) and (n_samples, n_atoms, 3) to write the energy and forces to. They are returned instead
+            of new tensors. Default: None
 
         Returns
         -------
         energy : torch.Tensor
-            Energy of the system.
+            Energy of each sample, with shape (n_samples, 1).
         forces : torch.Tensor
-            Forces on the atoms in the system.
+            Forces on the atoms of each sample, with shape (n_samples, n_atoms, 3).
         """
-        pos = pos.to(self.device).to(self.dtype).reshape(-1, 3)
+        if self.reuse_buffers:
+            self._pos_buffer = self._to_buffer(
+                self._pos_buffer, pos.reshape(-1, 3), self.device, self.dtype
+            )
+            pos = self._pos_buffer
+        else:
+            pos = pos.to(self.device).to(self.dtype).reshape(-1, 3)
+        if pos.size(0) != self.embeddings.size(0):
+            raise ValueError(
+                f"Expected positions for {self.n_samples} samples of {self.n_atoms} atoms, got {pos.size(0)} atoms"
+            )
         if box is not None:
-            box = box.to(self.device).to(self.dtype)
+            if box.dim() == 3 and box.size(0) not in (1, self.n_samples):
+                raise ValueError(
+                    f"Expected a box of shape (3, 3) or ({self.n_samples}, 3, 3), got {tuple(box.shape)}"
+                )
+            if box.dim() == 3 and box.size(0) == 1:
+                box = box[0]
+            if self.reuse_buffers:
+                self._box_buffer = self._to_buffer(
+                    self._box_buffer, box, self.device, self.dtype
+                )
+                box = self._box_buffer
+            else:
+                box = box.to(self.device).to(self.dtype)
         if self.use_cuda_graph:
             if self.pos is None:
                 self.pos = (
@@ -174,7 +237,20 @@ class External:
             self.energy, self.forces = self.model(self.embeddings, pos, self.batch, box)
         assert self.forces is not None, "The model is not returning forces"
         assert self.energy is not None, "The model is not returning energy"
-        return self.output_transformer(
-            self.energy.clone().detach(),
-            self.forces.clone().reshape(-1, self.n_atoms, 3).detach(),
-        )
+        energy = self.energy.detach()
+        forces = self.forces.detach().reshape(-1, self.n_atoms, 3)
+        if out is None and not self.reuse_buffers:
+            return self.output_transformer(energy.clone(), forces.clone())
+        # The outputs are copied into their buffers, so they are not overwritten by the next replay of a CUDA graph
+        energy, forces = self.output_transformer(energy, forces)
+        if out is None:
+            self._energy_buffer = self._to_buffer(
+                self._energy_buffer, energy, energy.device, energy.dtype
+            )
+            self._forces_buffer = self._to_buffer(
+                self._forces_buffer, forces, forces.device, forces.dtype
+            )
+            return self._energy_buffer, self._forces_buffer
+        out[0].copy_(energy)
+        out[1].copy_(forces)
+        return out[0], out[1]
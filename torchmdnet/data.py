@@ -4,16 +4,229 @@
 
 from os.path import join
 from tqdm import tqdm
+import numpy as np
 import torch
-from torch.utils.data import Subset
+import torch.distributed as dist
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler, Subset, Sampler
 from torch_geometric.loader import DataLoader
 from lightning import LightningDataModule
 from lightning_utilities.core.rank_zero import rank_zero_warn
 from torchmdnet import datasets
+from torchmdnet.datasets.memdataset import MemmappedDataset
 from torchmdnet.utils import make_splits, MissingEnergyException
 from torchmdnet.models.utils import scatter
 import warnings
 
+def get_sample_sizes(dataset):
+    """Returns the number of atoms of each sample in a dataset as a numpy array.
+
+    Datasets can provide the sizes of their stored samples through a `sizes` attribute, otherwise they are collected
+    iterating the dataset. Subsets are resolved to the sizes of the underlying dataset.
+
+    Args:
+        dataset (torch.utils.data.Dataset): The dataset.
+    """
+    if isinstance(dataset, Subset):
+        return get_sample_sizes(dataset.dataset)[np.asarray(dataset.indices)]
+    sizes = getattr(dataset, "sizes", None)
+    if sizes is not None:
+        sizes = np.asarray(sizes)
+        # Datasets created with index_select
+        if getattr(dataset, "_indices", None) is not None:
+            sizes = sizes[np.asarray(dataset.indices())]
+        return sizes
+    return np.array([dataset[i].z.numel() for i in range(len(dataset))], dtype=np.int64)
+
+
+def _resolve_subset(dataset):
+    """Returns the dataset underlying a (possibly nested) Subset and the indices of the subset in it."""
+    indices = np.arange(len(dataset))
+    while isinstance(dataset, Subset):
+        indices = np.asarray(dataset.indices)[indices]
+        dataset = dataset.dataset
+    return dataset, indices
+
+
+class _BatchFetcher(torch.utils.data.Dataset):
+    """Fetches whole batches from a dataset that implements `get_batch`, to be indexed with lists of indices."""
+
+    def __init__(self, dataset):
+        self.dataset, self.indices = _resolve_subset(dataset)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, indices):
+        return self.dataset.get_batch(self.indices[indices])
+
+
+class _EpochBatchSampler(BatchSampler):
+    """A BatchSampler that forwards set_epoch to its sampler."""
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+
+def _supports_get_batch(dataset):
+    dataset, _ = _resolve_subset(dataset)
+    return (
+        hasattr(dataset, "get_batch")
+        and getattr(dataset, "transform", None) is None
+        and getattr(dataset, "_indices", None) is None
+    )
+
+
+class DynamicBatchSampler(Sampler):
+    """A batch sampler that packs samples into batches with a bounded total size, instead of a fixed number of samples.
+
+    The size of a sample is its number of atoms or an estimate of its number of edges, :math:`n \\min(n-1, k)`, with
+    :math:`k` the maximum number of neighbors. Samples are visited in (optionally shuffled) order and added to the
+    current batch until the next one would exceed `max_size`. A sample larger than `max_size` gets a batch of its own.
+
+    In distributed training all processes build the same batches and each takes every `num_replicas`-th one, so that
+    every process sees the same number of batches per epoch. Call :meth:`set_epoch` to get a different shuffle per epoch,
+    Lightning does this automatically.
+
+    Args:
+        sizes (np.ndarray): Number of atoms of each sample.
+        max_size (int): Maximum total size of a batch.
+        metric (str, optional): Either "atoms" or "edges". Defaults to "atoms".
+        max_num_neighbors (int, optional): Maximum number of neighbors per atom, used to estimate the number of edges.
+            Defaults to None, meaning all atoms in a sample are neighbors.
+        shuffle (bool, optional): Whether to shuffle the samples every epoch. Defaults to False.
+        seed (int, optional): Seed for the shuffling. Defaults to 0.
+        num_replicas (int, optional): Number of processes in distributed training. Defaults to the world size.
+        rank (int, optional): Rank of the current process. Defaults to the global rank.
+        drop_last (bool, optional): In distributed training, drop the batches that do not fill a round over all processes
+            instead of repeating batches from the start. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        sizes,
+        max_size,
+        metric="atoms",
+        max_num_neighbors=None,
+        shuffle=False,
+        seed=0,
+        num_replicas=None,
+        rank=None,
+        drop_last=False,
+    ):
+        if max_size <= 0:
+            raise ValueError(f"max_size must be positive, got {max_size}")
+        if metric not in ["atoms", "edges"]:
+            raise ValueError(f"Unknown metric {metric}. Choose from atoms, edges.")
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        sizes = np.asarray(sizes, dtype=np.int64)
+        if metric == "edges":
+            neighbors = sizes - 1 if max_num_neighbors is None else np.minimum(sizes - 1, max_num_neighbors)
+            sizes = sizes * neighbors
+        self.sizes = sizes
+        self.max_size = max_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self._batches = None
+        self.epoch = epoch
+
+    def _all_batches(self):
+        if self._batches is None:
+            self._batches = self._pack()
+        return self._batches
+
+    def _pack(self):
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + self.epoch).permutation(len(self.sizes))
+        else:
+            order = np.arange(len(self.sizes))
+        # A new batch starts wherever the running total exceeds the limit
+        batches = []
+        start, total = 0, 0
+        for i, size in enumerate(self.sizes[order]):
+            if total + size > self.max_size and i > start:
+                batches.append(order[start:i])
+                start, total = i, 0
+            total += size
+        if start < len(order):
+            batches.append(order[start:])
+        return batches
+
+    def _num_batches(self, num_batches):
+        if self.drop_last:
+            return num_batches // self.num_replicas
+        return -(-num_batches // self.num_replicas)
+
+    def __iter__(self):
+        batches = self._all_batches()
+        num_batches = self._num_batches(len(batches))
+        for i in range(num_batches):
+            yield batches[(i * self.num_replicas + self.rank) % len(batches)].tolist()
+
+    def __len__(self):
+        return self._num_batches(len(self._all_batches()))
+
+
+class ChunkedShuffleSampler(Sampler):
+    """A sampler that shuffles samples while reading them from storage in nearly sequential order.
+
+    The samples are sorted by their position in the underlying dataset and split into contiguous blocks of
+    `block_size` samples. The order of the blocks is shuffled, consecutive groups of `window_blocks` blocks are
+    merged, and the samples of each group are shuffled. At any time only a window of about
+    `block_size * window_blocks` neighboring samples is being read, which turns random page faults in memory-mapped
+    files into almost sequential reads.
+
+    Args:
+        dataset (torch.utils.data.Dataset): The dataset, possibly a Subset.
+        block_size (int): Number of consecutive samples in a block.
+        window_blocks (int, optional): Number of blocks whose samples are shuffled together. Defaults to 4.
+        seed (int, optional): Seed for the shuffling. Defaults to 0.
+        prefetch (bool, optional): Ask the operating system to read each window ahead, using the `prefetch` method
+            of the dataset if it has one. Defaults to False.
+    """
+
+    def __init__(self, dataset, block_size, window_blocks=4, seed=0, prefetch=False):
+        if block_size <= 0 or window_blocks <= 0:
+            raise ValueError("block_size and window_blocks must be positive")
+        base, base_indices = _resolve_subset(dataset)
+        # Positions in the dataset, sorted by position in the underlying storage
+        self.order = np.argsort(base_indices, kind="stable")
+        self.base_indices = base_indices
+        self.block_size = block_size
+        self.window_blocks = window_blocks
+        self.seed = seed
+        self.epoch = 0
+        self.prefetch_fn = getattr(base, "prefetch", None) if prefetch else None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        blocks = [self.order[i : i + self.block_size] for i in range(0, len(self.order), self.block_size)]
+        block_order = rng.permutation(len(blocks))
+        for start in range(0, len(blocks), self.window_blocks):
+            window = [blocks[b] for b in block_order[start : start + self.window_blocks]]
+            if self.prefetch_fn is not None:
+                for block in window:
+                    self.prefetch_fn(self.base_indices[block[0]], self.base_indices[block[-1]] + 1)
+            yield from rng.permutation(np.concatenate(window)).tolist()
+
+    def __len__(self):
+        return len(self.order)
+
+
 class DataModule(LightningDataModule):
     """A LightningDataModule for loading datasets from the torchmdnet.datasets module.
 
@@ -41,6 +254,7 @@ class DataModule(LightningDataModule):
                     self.hparams["energy_files"],
                     self.hparams["force_files"],
                     self.hparams["dataset_preload_limit"],
+                    preload_shared=self.hparams.get("dataset_preload_shared", False),
                 )
             else:
                 dataset_arg = {}
@@ -50,7 +264,17 @@ class DataModule(LightningDataModule):
                     dataset_arg["dataset_preload_limit"] = self.hparams[
                         "dataset_preload_limit"
                     ]
-                self.dataset = getattr(datasets, self.hparams["dataset"])(
+                    dataset_arg["preload_shared"] = self.hparams.get(
+                        "dataset_preload_shared", False
+                    )
+                dataset_class = getattr(datasets, self.hparams["dataset"])
+                if self.hparams.get("precomputed_neighbors", False):
+                    if not issubclass(dataset_class, MemmappedDataset):
+                        raise ValueError(
+                            f"Precomputed neighbors are not supported by the {self.hparams['dataset']} dataset"
+                        )
+                    dataset_arg["neighbor_cutoff"] = self.hparams["cutoff_upper"]
+                self.dataset = dataset_class(
                     self.hparams["dataset_root"], **dataset_arg
                 )
 
@@ -129,14 +353,57 @@ class DataModule(LightningDataModule):
             batch_size = self.hparams["inference_batch_size"]
 
         shuffle = stage == "train"
-        dl = DataLoader(
-            dataset=dataset,
-            batch_size=batch_size,
-            num_workers=self.hparams["num_workers"],
-            persistent_workers=True,
-            pin_memory=True,
-            shuffle=shuffle,
-        )
+        dynamic_batch_size = self.hparams.get("dynamic_batch_size")
+        batch_sampler = None
+        if dynamic_batch_size:
+            batch_sampler = DynamicBatchSampler(
+                get_sample_sizes(dataset),
+                dynamic_batch_size,
+                metric=self.hparams.get("dynamic_batch_metric", "atoms"),
+                max_num_neighbors=self.hparams.get("max_num_neighbors"),
+                shuffle=shuffle,
+                seed=self.hparams["seed"],
+            )
+        distributed = dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+        sampler = None
+        shuffle_block_size = self.hparams.get("shuffle_block_size")
+        if shuffle and shuffle_block_size and batch_sampler is None:
+            sampler = ChunkedShuffleSampler(
+                dataset,
+                shuffle_block_size,
+                window_blocks=self.hparams.get("shuffle_window_blocks", 4),
+                seed=self.hparams["seed"],
+                prefetch=self.hparams.get("shuffle_prefetch", False),
+            )
+        if _supports_get_batch(dataset) and (batch_sampler is not None or not distributed):
+            # Fetch whole batches at once, collating in the dataset. Lightning cannot shard this loader, so in
+            # distributed training it is only used with the dynamic batch sampler, which shards by itself.
+            if batch_sampler is None:
+                if sampler is None:
+                    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+                batch_sampler = _EpochBatchSampler(sampler, batch_size, drop_last=False)
+            dl = torch.utils.data.DataLoader(
+                dataset=_BatchFetcher(dataset),
+                sampler=batch_sampler,
+                batch_size=None,
+                num_workers=self.hparams["num_workers"],
+                persistent_workers=True,
+                pin_memory=True,
+            )
+        else:
+            if batch_sampler is not None:
+                batch_args = dict(batch_sampler=batch_sampler)
+            elif sampler is not None:
+                batch_args = dict(batch_size=batch_size, sampler=sampler)
+            else:
+                batch_args = dict(batch_size=batch_size, shuffle=shuffle)
+            dl = DataLoader(
+                dataset=dataset,
+                num_workers=self.hparams["num_workers"],
+                persistent_workers=True,
+                pin_memory=True,
+                **batch_args,
+            )
 
         if store_dataloader:
             self._saved_dataloaders[stage] = dl
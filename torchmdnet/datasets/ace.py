@@ -62,6 +62,7 @@ class Ace(MemmappedDataset):
         paths (string or list): Path to the HDF5 files or directory containing the HDF5 files.
         max_gradient (float, optional): Maximum gradient norm. Samples with larger gradients are discarded.
         subsample_molecules (int, optional): Subsample molecules. Only every `subsample_molecules` molecule is used.
+        kwargs: Storage options of :class:`torchmdnet.datasets.memdataset.MemmappedDataset`, e.g. `storage="chunked"`.
 
     Examples::
         >>> import numpy as np
@@ -123,6 +124,8 @@ class Ace(MemmappedDataset):
         12
     """
 
+    shard_by_file = True
+
     def __init__(
         self,
         root=None,
@@ -132,6 +135,7 @@ class Ace(MemmappedDataset):
         paths=None,
         max_gradient=None,
         subsample_molecules=1,
+        **kwargs,
     ):
         assert isinstance(paths, (str, list))
 
@@ -147,6 +151,7 @@ class Ace(MemmappedDataset):
             pre_transform,
             pre_filter,
             properties=("y", "neg_dy", "q", "pq", "dp"),
+            **kwargs,
         )
 
     @property
@@ -227,10 +232,10 @@ class Ace(MemmappedDataset):
 
             yield pos, y, neg_dy, pq, dp
 
-    def sample_iter(self, mol_ids=False):
+    def sample_iter(self, mol_ids=False, paths=None):
         assert self.subsample_molecules > 0
 
-        for path in tqdm(self.raw_paths, desc="Files"):
+        for path in tqdm(self.raw_paths if paths is None else paths, desc="Files"):
             h5 = h5py.File(path)
             assert h5.attrs["layout"] == "Ace"
             version = h5.attrs["layout_version"]
@@ -67,6 +67,7 @@ class ANIBase(MemmappedDataset):
         pre_transform=None,
         pre_filter=None,
         properties=("y", "neg_dy"),
+        **kwargs,
     ):
         self.name = self.__class__.__name__
         super().__init__(
@@ -75,6 +76,7 @@ class ANIBase(MemmappedDataset):
             pre_transform,
             pre_filter,
             properties=properties,
+            **kwargs,
         )
 
     def filter_and_pre_transform(self, data):
@@ -89,6 +91,7 @@ class ANIBase(MemmappedDataset):
 
 class ANI1(ANIBase):
     __doc__ = ANIBase.__doc__
+    shard_by_file = True
     _ELEMENT_ENERGIES = {
         1: -0.500607632585,
         6: -37.8302333826,
@@ -102,6 +105,7 @@ class ANI1(ANIBase):
         transform=None,
         pre_transform=None,
         pre_filter=None,
+        **kwargs,
     ):
         self.name = self.__class__.__name__
         super().__init__(
@@ -110,6 +114,7 @@ class ANI1(ANIBase):
             pre_transform,
             pre_filter,
             properties=("y",),
+            **kwargs,
         )
 
     @property
@@ -127,10 +132,10 @@ class ANI1(ANIBase):
         extract_tar(archive, self.raw_dir)
         os.remove(archive)
 
-    def sample_iter(self, mol_ids=False):
+    def sample_iter(self, mol_ids=False, paths=None):
         atomic_numbers = {b"H": 1, b"C": 6, b"N": 7, b"O": 8}
 
-        for path in tqdm(self.raw_paths, desc="Files"):
+        for path in tqdm(self.raw_paths if paths is None else paths, desc="Files"):
             molecules = list(h5py.File(path).values())[0].items()
 
             for mol_id, mol in tqdm(molecules, desc="Molecules", leave=False):
@@ -232,6 +237,7 @@ class ANI1CCX(ANI1XBase):
         transform=None,
         pre_transform=None,
         pre_filter=None,
+        **kwargs,
     ):
         self.name = self.__class__.__name__
         super().__init__(
@@ -240,6 +246,7 @@ class ANI1CCX(ANI1XBase):
             pre_transform,
             pre_filter,
             properties=("y",),
+            **kwargs,
         )
 
     def sample_iter(self, mol_ids=False):
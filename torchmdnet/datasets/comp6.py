@@ -23,6 +23,7 @@ For more details check:
 
 
 class COMP6Base(MemmappedDataset):
+    shard_by_file = True
     _ELEMENT_ENERGIES = {
         1: -0.500607632585,
         6: -37.8302333826,
@@ -38,6 +39,7 @@ class COMP6Base(MemmappedDataset):
         transform=None,
         pre_transform=None,
         pre_filter=None,
+        **kwargs,
     ):
         self.name = self.__class__.__name__
         super().__init__(
@@ -46,6 +48,7 @@ class COMP6Base(MemmappedDataset):
             pre_transform,
             pre_filter,
             properties=("y", "neg_dy"),
+            **kwargs,
         )
 
     @property
@@ -78,8 +81,8 @@ class COMP6Base(MemmappedDataset):
         for url in self.raw_url:
             download_url(url, self.raw_dir)
 
-    def sample_iter(self, mol_ids=False):
-        for path in tqdm(self.raw_paths, desc="Files"):
+    def sample_iter(self, mol_ids=False, paths=None):
+        for path in tqdm(self.raw_paths if paths is None else paths, desc="Files"):
             molecules = list(h5py.File(path).values())[0].items()
 
             for mol_id, mol in tqdm(molecules, desc="Molecules", leave=False):
@@ -261,6 +264,11 @@ class COMP6v1(Dataset):
     def len(self):
         return self.num_samples
 
+    @property
+    def sizes(self):
+        """Number of atoms of each sample, as a numpy array."""
+        return np.concatenate([subset.sizes for subset in self.subsets])
+
     def get(self, idx):
         i_subset, i_sample = self.subset_indices[idx]
         return self.subsets[i_subset][i_sample]
@@ -6,6 +6,7 @@ import glob
 import numpy as np
 import torch
 from torch_geometric.data import Dataset, Data
+from torchmdnet.utils import shared_memory_arrays, read_only_tensor
 
 __all__ = ["Custom"]
 
@@ -27,7 +28,8 @@ class Custom(Dataset):
         transform (callable, optional): A function/transform that takes in an :obj:`torch_geometric.data.Data` object and returns a transformed version. The data object will be transformed before every access.
         pre_transform (callable, optional): A function/transform that takes in an :obj:`torch_geometric.data.Data` object and returns a transformed version. The data object will be transformed before being saved to disk.
         pre_filter (callable, optional): A function that takes in an :obj:`torch_geometric.data.Data` object and returns a boolean value, indicating whether the data object should be included in the final dataset.
-
+        preload_shared (bool, optional): Preload the dataset once per node into :obj:`shared_memory_dir`, where all DDP ranks and DataLoader workers map it read-only, instead of into the memory of each process. See :func:`torchmdnet.utils.shared_memory_arrays`. (default: :obj:`False`)
+        shared_memory_dir (string, optional): Directory of the shared preloaded data. (default: :obj:`/dev/shm`)
 
     Example:
         >>> data = Custom(coordglob="coords_files*npy", embedglob="embed_files*npy")
@@ -52,8 +54,12 @@ class Custom(Dataset):
         transform=None,
         pre_transform=None,
         pre_filter=None,
+        preload_shared=False,
+        shared_memory_dir="/dev/shm",
     ):
         super().__init__(None, transform, pre_transform, pre_filter)
+        self.preload_shared = preload_shared
+        self.shared_memory_dir = shared_memory_dir
         assert energyglob is not None or forceglob is not None, (
             "Either energies, forces or both must " "be specified as the target"
         )
@@ -87,7 +93,7 @@ class Custom(Dataset):
         print("Number of files: ", len(self.files["pos"]))
         self.cached = False
         total_data_size = self._initialize_index()
-        print(f"Combined dataset size {len(self.index)}")
+        print(f"Combined dataset size {self.file_offsets[-1]}")
         # If the dataset is small enough, load it whole into CPU memory
         data_size_limit = preload_memory_limit * 1024 * 1024
         if total_data_size < data_size_limit:
@@ -103,23 +109,40 @@ class Custom(Dataset):
         """Load the input files as Torch tensors.
         Each file can have different number of atoms, so each one is stored in a different tensor.
         """
+        if self.preload_shared:
+            files = [f for key in self.files for f in self.files[key]]
+            arrays = shared_memory_arrays(
+                files,
+                lambda: {
+                    f"{key}.{i}": np.load(f).astype(int) if key == "z" else np.load(f)
+                    for key in self.files
+                    for i, f in enumerate(self.files[key])
+                },
+                description="Custom",
+                directory=self.shared_memory_dir,
+            )
+            load = lambda key, i, f: read_only_tensor(arrays[f"{key}.{i}"])
+        else:
+            load = lambda key, i, f: torch.from_numpy(
+                np.load(f).astype(int) if key == "z" else np.load(f)
+            )
         self.stored_data = {}
         self.stored_data["pos"] = [
-            torch.from_numpy(np.load(f)) for f in self.files["pos"]
+            load("pos", i, f) for i, f in enumerate(self.files["pos"])
         ]
         self.stored_data["z"] = [
-            torch.from_numpy(np.load(f).astype(int))
+            load("z", i, f)
             .unsqueeze(0)
             .expand(self.stored_data["pos"][i].shape[0], -1)
             for i, f in enumerate(self.files["z"])
         ]
         if self.has_energies:
             self.stored_data["y"] = [
-                torch.from_numpy(np.load(f)) for f in self.files["y"]
+                load("y", i, f) for i, f in enumerate(self.files["y"])
             ]
         if self.has_forces:
             self.stored_data["neg_dy"] = [
-                torch.from_numpy(np.load(f)) for f in self.files["neg_dy"]
+                load("neg_dy", i, f) for i, f in enumerate(self.files["neg_dy"])
             ]
 
     def _store_numpy_memmaps(self):
@@ -143,12 +166,13 @@ class Custom(Dataset):
 
     def _initialize_index(self):
         """Initialize the index for the dataset.
-        The index relates a sample to the file it belongs to and the index within that file.
+        The index relates a sample to the file it belongs to and the index within that file. It is stored as the
+        cumulative number of samples of the files, the samples of file i are file_offsets[i]:file_offsets[i + 1].
         Returns:
             int: Total size of the dataset in bytes.
         """
         # create index
-        self.index = []
+        sizes = []
         nfiles = len(self.files["pos"])
         total_data_size = 0  # Number of bytes in the dataset
         for i in range(nfiles):
@@ -156,7 +180,7 @@ class Custom(Dataset):
             embed_data = np.load(self.files["z"][i]).astype(int)
             size = coord_data.shape[0]
             total_data_size += coord_data.nbytes + embed_data.nbytes
-            self.index.extend(list(zip([i] * size, range(size))))
+            sizes.append(np.full(size, embed_data.shape[0]))
             # consistency check
             assert coord_data.shape[1] == embed_data.shape[0], (
                 f"Number of atoms in coordinate file {i} ({coord_data.shape[1]}) "
@@ -176,17 +200,26 @@ class Custom(Dataset):
                     f"Data shape of coordinate file {i} {coord_data.shape} "
                     f"does not match the shape of force file {i} {force_data.shape}."
                 )
+        # Number of atoms of each sample
+        self.sizes = np.concatenate(sizes) if sizes else np.zeros(0, dtype=np.int64)
+        self.file_offsets = np.zeros(nfiles + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in sizes], out=self.file_offsets[1:])
         return total_data_size
 
     def get(self, idx):
-        fileid, index = self.index[idx]
+        fileid = int(np.searchsorted(self.file_offsets, idx, side="right")) - 1
+        index = int(idx - self.file_offsets[fileid])
         data = Data()
         for field in self.fields:
             # The dataset is stored as mem mapped numpy arrays unless it is cached,
             # in which case it is already stored as torch tensors
             f = self.stored_data[field[0]][fileid][index]
-            data[field[0]] = f if self.cached else torch.from_numpy(np.array(f))
+            if not self.cached:
+                data[field[0]] = torch.from_numpy(np.array(f))
+            else:
+                # Shared data is read-only, the samples must not be views of it
+                data[field[0]] = f.clone() if self.preload_shared else f
         return data
 
     def len(self):
-        return len(self.index)
+        return int(self.file_offsets[-1])
@@ -33,6 +33,7 @@ class GenentechTorsions(MemmappedDataset):
         paths=None,
         theory="CCSD_T_CBS_MP2",
         energy_field="deltaE",
+        **kwargs,
     ):
         self.name = self.__class__.__name__
         self.paths = str(paths)
@@ -45,6 +46,7 @@ class GenentechTorsions(MemmappedDataset):
             pre_filter,
             remove_ref_energy=False,
             properties=("y"),
+            **kwargs,
         )
 
     @property
@@ -6,6 +6,7 @@ import torch
 from torch_geometric.data import Dataset, Data
 import h5py
 import numpy as np
+from torchmdnet.utils import shared_memory_arrays, read_only_tensor
 
 
 class HDF5(Dataset):
@@ -23,15 +24,28 @@ class HDF5(Dataset):
     Args:
         filename (string): A semicolon separated list of HDF5 files.
         dataset_preload_limit (int, optional): If the dataset is smaller than this limit (in MB), preload it into CPU memory. (default: :obj:`1024`)
+        preload_shared (bool, optional): Preload the dataset once per node into :obj:`shared_memory_dir`, where all DDP ranks and DataLoader
+            workers map it read-only, instead of into the memory of each process. See :func:`torchmdnet.utils.shared_memory_arrays`. (default: :obj:`False`)
+        shared_memory_dir (string, optional): Directory of the shared preloaded data. (default: :obj:`/dev/shm`)
 
     """
 
-    def __init__(self, filename, dataset_preload_limit=1024, **kwargs):
+    def __init__(
+        self,
+        filename,
+        dataset_preload_limit=1024,
+        preload_shared=False,
+        shared_memory_dir="/dev/shm",
+        **kwargs,
+    ):
         super(HDF5, self).__init__()
         self.filename = filename
-        self.index = None
+        self.preload_shared = preload_shared
+        self.shared_memory_dir = shared_memory_dir
+        self.group_data = None
         self.fields = None
         self.num_molecules = 0
+        sizes = []
         files = [h5py.File(f, "r") for f in self.filename.split(";")]
         total_file_size = sum([f.id.get_filesize() for f in files])
         print(f"Loading {len(files)} HDF5 files ({total_file_size / 1024**2:.2f} MB)")
@@ -43,6 +57,7 @@ class HDF5(Dataset):
                         setattr(self, name, torch.tensor(np.array(group[name])))
                 else:
                     self.num_molecules += len(group["pos"])
+                    sizes.append(np.full(len(group["pos"]), group["pos"].shape[1]))
                     if self.fields is None:
                         # Record which data fields are present in this file.
                         self.fields = [
@@ -61,6 +76,11 @@ class HDF5(Dataset):
                             "forces" in group
                         ), "Each group must contain at least energies or forces"
             file.close()
+        # Number of atoms of each sample
+        self.sizes = np.concatenate(sizes) if sizes else np.zeros(0, dtype=np.int64)
+        # Samples of group g are group_offsets[g]:group_offsets[g + 1]
+        self.group_offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in sizes], out=self.group_offsets[1:])
         self.cached = False
         if total_file_size <= dataset_preload_limit * 1024**2:
             print(
@@ -69,59 +89,86 @@ class HDF5(Dataset):
             self.cached = True
             self._preload_data()
 
+    def _read_groups(self):
+        """Read every field of every group as a tensor, in the same order as group_offsets."""
+        groups = []
+        files = [h5py.File(f, "r") for f in self.filename.split(";")]
+        for file in files:
+            for group_name, group in file.items():
+                if group_name != "_metadata":
+                    groups.append(
+                        [
+                            torch.tensor(np.array(group[field[1]]), dtype=field[2])
+                            for field in self.fields
+                        ]
+                    )
+            file.close()
+        return groups
+
     def _preload_data(self):
         """Preload the entire dataset into memory.
         Store it in a dictionary of torch tensors. The dictionary has an entry for each field and group.
         """
+        if self.preload_shared:
+            arrays = shared_memory_arrays(
+                self.filename.split(";"),
+                lambda: {
+                    f"{g}.{j}": tensor.numpy()
+                    for g, tensors in enumerate(self._read_groups())
+                    for j, tensor in enumerate(tensors)
+                },
+                description=f"HDF5 {self.fields}",
+                directory=self.shared_memory_dir,
+            )
+            groups = [
+                [read_only_tensor(arrays[f"{g}.{j}"]) for j in range(len(self.fields))]
+                for g in range(len(self.group_offsets) - 1)
+            ]
+        else:
+            groups = self._read_groups()
         self.stored_data = {}
         for field in self.fields:
             self.stored_data[field] = []
-        self.index = []
-        files = [h5py.File(f, "r") for f in self.filename.split(";")]
-        i = 0
-        for file in files:
-            for group_name, group in file.items():
-                if group_name != "_metadata":
-                    size = len(group["pos"])
-                    for field in self.fields:
-                        data = group[field[1]]
-                        dtype = field[2]
-                        # Watchout for the 1D case, embed can be shared for all samples
-                        tmp = torch.tensor(np.array(data), dtype=dtype)
-                        if tmp.ndim == 1:
-                            tmp = tmp.unsqueeze(0).expand(size, -1)
-                        self.stored_data[field].append(tmp)
-                    self.index.extend(list(zip([i] * size, range(size))))
-                    i += 1
-            file.close()
+        for g, tensors in enumerate(groups):
+            size = int(self.group_offsets[g + 1] - self.group_offsets[g])
+            for field, tmp in zip(self.fields, tensors):
+                # Watchout for the 1D case, embed can be shared for all samples
+                if tmp.ndim == 1:
+                    tmp = tmp.unsqueeze(0).expand(size, -1)
+                self.stored_data[field].append(tmp)
 
     def _setup_index(self):
+        """Open the files and store the datasets of each group, in the same order as group_offsets."""
         files = [h5py.File(f, "r") for f in self.filename.split(";")]
-        self.index = []
+        self.group_data = []
         for file in files:
             for group_name, group in file.items():
                 if group_name != "_metadata":
-                    data = [group[field[1]] for field in self.fields]
-                    self.index.extend(
-                        [tuple(data + [i]) for i in range(len(group["pos"]))]
-                    )
-        assert self.num_molecules == len(
-            self.index
-        ), f"Mismatch between previously calculated molecule count ({self.num_molecules}) and actual molecule count ({len(self.index)})"
+                    self.group_data.append([group[field[1]] for field in self.fields])
+        num_molecules = sum(len(data[0]) for data in self.group_data)
+        assert (
+            self.num_molecules == num_molecules
+        ), f"Mismatch between previously calculated molecule count ({self.num_molecules}) and actual molecule count ({num_molecules})"
+
+    def _locate(self, idx):
+        """Returns the group of a sample and its row within the group."""
+        group = int(np.searchsorted(self.group_offsets, idx, side="right")) - 1
+        return group, int(idx - self.group_offsets[group])
 
     def get(self, idx):
         data = Data()
+        group, i = self._locate(idx)
         if self.cached:
-            # If the dataset is cached, the index is just a list of indices into the stored data.
-            fileid, index = self.index[idx]
             for field in self.fields:
-                data[field[0]] = self.stored_data[field][fileid][index]
+                value = self.stored_data[field][group][i]
+                # Shared data is read-only, the samples must not be views of it
+                data[field[0]] = value.clone() if self.preload_shared else value
         else:
             # only open files here to avoid copying objects of this class to another
             # process with open file handles (potentially corrupts h5py loading)
-            if self.index is None:
+            if self.group_data is None:
                 self._setup_index()
-            *fields_data, i = self.index[idx]
+            fields_data = self.group_data[group]
             for (name, _, dtype), d in zip(self.fields, fields_data):
                 tensor_input = [[d[i]]] if d.ndim == 1 else d[i]
                 data[name] = torch.tensor(tensor_input, dtype=dtype)
@@ -7,6 +7,7 @@ import os.path as osp
 from typing import Callable, List, Optional
 import numpy as np
 import torch
+from torchmdnet.utils import sizes_from_slices
 from torch_geometric.data import (
     Data,
     InMemoryDataset,
@@ -51,6 +52,10 @@ class MD22(InMemoryDataset):
     def mean(self) -> float:
         return float(self._data.energy.mean())
 
+    @property
+    def sizes(self) -> np.ndarray:
+        return sizes_from_slices(self.slices)
+
     @property
     def raw_dir(self) -> str:
         return osp.join(self.root, self.name, 'raw')
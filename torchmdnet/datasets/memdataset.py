@@ -2,10 +2,130 @@
 # Distributed under the MIT License.
 # (See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
 
-from torch_geometric.data import Data, Dataset
+from torch_geometric.data import Batch, Data, Dataset
+from collections import OrderedDict
+import json
+import lzma
+import mmap
+import multiprocessing as mp
 import numpy as np
 import torch as pt
 import os
+import shutil
+import zlib
+
+# Storage of each property: dtype and shape of the values of a sample (None stands for the number of atoms)
+_PROPERTY_FORMATS = {
+    "size": (np.int64, (1,)),
+    "z": (np.int8, (None,)),
+    "pos": (np.float32, (None, 3)),
+    "y": (np.float64, (1,)),
+    "neg_dy": (np.float32, (None, 3)),
+    "q": (np.int8, (1,)),
+    "pq": (np.float32, (None,)),
+    "dp": (np.float32, (1, 3)),
+}
+
+# Compression functions of the chunked storage, as (compress, decompress)
+_COMPRESSORS = {
+    "none": (bytes, bytes),
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+# Types in which the positions can be stored by the chunked storage. int16 positions are quantized with a per-chunk scale.
+_POSITION_DTYPES = {"float32": np.float32, "float16": np.float16, "int16": np.int16}
+
+
+def _num_rows(prop, num_atoms, num_confs):
+    return num_atoms if _PROPERTY_FORMATS[prop][1][0] is None else num_confs
+
+
+def _encode_chunk(arrays, properties, pos_dtype):
+    """Serializes the values of the conformations of a chunk, field after field.
+
+    The positions are preceded by the float32 scale they are multiplied by when decoded.
+    """
+    parts = []
+    for prop in ["z", "pos"] + list(properties):
+        values = np.ascontiguousarray(arrays[prop], dtype=_PROPERTY_FORMATS[prop][0])
+        if prop == "pos":
+            scale = 1.0
+            if pos_dtype == "int16":
+                max_abs = float(np.abs(values).max()) if values.size > 0 else 0.0
+                scale = max_abs / np.iinfo(np.int16).max if max_abs > 0 else 1.0
+                limit = np.iinfo(np.int16).max
+                values = np.clip(np.round(values / scale), -limit, limit)
+            values = values.astype(_POSITION_DTYPES[pos_dtype])
+            parts.append(np.array([scale], dtype=np.float32).tobytes())
+        parts.append(values.tobytes())
+    return b"".join(parts)
+
+
+def _decode_chunk(raw, properties, pos_dtype, num_atoms, num_confs):
+    """Inverse of :func:`_encode_chunk`, returns a dictionary with the values of each field."""
+    arrays = {}
+    offset = 0
+    for prop in ["z", "pos"] + list(properties):
+        dtype, shape = _PROPERTY_FORMATS[prop]
+        if prop == "pos":
+            scale = np.frombuffer(raw, dtype=np.float32, count=1, offset=offset)[0]
+            offset += 4
+            dtype = _POSITION_DTYPES[pos_dtype]
+        shape = (_num_rows(prop, num_atoms, num_confs),) + shape[1:]
+        count = int(np.prod(shape))
+        values = np.frombuffer(raw, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += count * np.dtype(dtype).itemsize
+        if prop == "pos":
+            values = values.astype(np.float32)
+            if pos_dtype == "int16":
+                values *= scale
+        arrays[prop] = values
+    return arrays
+
+
+class _GrowingMemmap:
+    """Writes an array to a file, growing its memory map in chunks as values are appended.
+
+    Args:
+        filename (str): The file to write.
+        dtype (np.dtype): The type of the values.
+        shape (tuple): Shape of the values appended each time, which only matters for the size of the rows.
+        chunk_bytes (int, optional): The file grows by at least this size.
+    """
+
+    def __init__(self, filename, dtype, shape, chunk_bytes=64 * 1024**2):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.row_size = int(np.prod([n for n in shape if n is not None]))
+        self.chunk = max(chunk_bytes // self.dtype.itemsize, self.row_size)
+        self.length = 0
+        self.mm = np.memmap(filename, mode="w+", dtype=self.dtype, shape=(self.chunk,))
+
+    def append(self, values):
+        values = np.asarray(values).astype(self.dtype, copy=False).reshape(-1)
+        end = self.length + len(values)
+        if end > len(self.mm):
+            capacity = max(end, len(self.mm) + self.chunk)
+            self.mm.flush()
+            del self.mm
+            self.mm = np.memmap(self.filename, mode="r+", dtype=self.dtype, shape=(capacity,))
+        self.mm[self.length : end] = values
+        self.length = end
+
+    def close(self):
+        self.mm.flush()
+        del self.mm
+        with open(self.filename, "r+b") as f:
+            f.truncate(self.length * self.dtype.itemsize)
+
+
+_converting_dataset = None
+
+
+def _convert_shard_worker(i_shard):
+    dataset, shard_dir, shards = _converting_dataset
+    dataset._convert_shard(shard_dir, i_shard, shards[i_shard])
 
 
 class MemmappedDataset(Dataset):
@@ -32,6 +152,23 @@ class MemmappedDataset(Dataset):
         - :obj:`name.pq.mmap`: Partial charges of all the atoms.
         - :obj:`name.dp.mmap`: Dipole moment of each conformation.
 
+    Alternatively, with :obj:`storage="chunked"`, consecutive conformations are grouped in chunks that are stored
+    compressed, which reduces the disk and page cache footprint at the cost of decompressing the chunks when they are
+    read, in the DataLoader workers. The data is then stored in the following files:
+
+        - :obj:`name.idx.mmap`: Index of the first atom of each conformation.
+        - :obj:`name.chunks.mmap`: Index of the first conformation of each chunk and offset of the chunk in the data file.
+        - :obj:`name.data.mmap`: The compressed chunks.
+        - :obj:`name.format.json`: The properties and storage options of the chunks.
+
+    The last decompressed chunks are cached, so samples should be read in an order that keeps conformations of the
+    same chunk together, e.g. with :class:`torchmdnet.data.ChunkedShuffleSampler` and a block size that is a multiple
+    of :obj:`chunk_size`.
+
+    The raw data is converted in a single pass. If :obj:`shard_by_file` is set in a subclass, each raw file is
+    converted in parallel to temporary files in :obj:`name.shards`, which are merged at the end. Completed files are
+    kept if the conversion is interrupted and skipped when it is restarted.
+
     Args:
         root (str): Root directory where the dataset should be stored.
         transform (callable, optional): A function/transform that takes in an
@@ -47,8 +184,25 @@ class MemmappedDataset(Dataset):
         properties (tuple of str, optional): The properties to include in the
             dataset. Can be any subset of :obj:`y`, :obj:`neg_dy`, :obj:`q`,
             :obj:`pq`, and :obj:`dp`.
+        storage (str, optional): Either :obj:`"mmap"` to store each field uncompressed in its own file, or
+            :obj:`"chunked"` to store compressed chunks of conformations. (default: :obj:`"mmap"`)
+        compression (str, optional): Compression of the chunks, one of :obj:`"zlib"`, :obj:`"lzma"` or
+            :obj:`"none"`. (default: :obj:`"zlib"`)
+        pos_dtype (str, optional): Type in which the chunks store the positions. One of :obj:`"float32"`,
+            :obj:`"float16"` or :obj:`"int16"`, which quantizes the positions with a per-chunk scale. The other fields
+            are stored without loss. (default: :obj:`"float32"`)
+        chunk_size (int, optional): Number of conformations per chunk. (default: :obj:`128`)
+        chunk_cache_size (int, optional): Number of decompressed chunks kept in memory. (default: :obj:`4`)
+        neighbor_cutoff (float, optional): If given, the pairs of atoms of each conformation closer than this cutoff
+            are computed once and stored next to the processed files, see :meth:`neighbor_pairs`. The data objects
+            then include them as :obj:`neighbor_index`, which the model uses instead of searching for neighbors if
+            created with :obj:`precomputed_neighbors`. Only the indices are stored, the distances are computed by the
+            model from the positions, so that they can be differentiated. (default: :obj:`None`)
     """
 
+    # Whether sample_iter accepts a list of raw files, so that they can be converted independently
+    shard_by_file = False
+
     def __init__(
         self,
         root,
@@ -56,14 +210,41 @@ class MemmappedDataset(Dataset):
         pre_transform=None,
         pre_filter=None,
         properties=("y", "neg_dy", "q", "pq", "dp"),
+        storage="mmap",
+        compression="zlib",
+        pos_dtype="float32",
+        chunk_size=128,
+        chunk_cache_size=4,
+        neighbor_cutoff=None,
     ):
+        if storage not in ("mmap", "chunked"):
+            raise ValueError(f"Unknown storage {storage}, expected 'mmap' or 'chunked'")
+        if compression not in _COMPRESSORS:
+            raise ValueError(f"Unknown compression {compression}, expected one of {list(_COMPRESSORS)}")
+        if pos_dtype not in _POSITION_DTYPES:
+            raise ValueError(f"Unknown pos_dtype {pos_dtype}, expected one of {list(_POSITION_DTYPES)}")
+        assert chunk_size > 0 and chunk_cache_size > 0
         self.name = self.__class__.__name__
         self.properties = properties
+        self.storage = storage
+        self.compression = compression
+        self.pos_dtype = pos_dtype
+        self.chunk_size = int(chunk_size)
+        self.chunk_cache_size = int(chunk_cache_size)
         super().__init__(root, transform, pre_transform, pre_filter)
 
         fnames = self.processed_paths_dict
 
         self.idx_mm = np.memmap(fnames["idx"], mode="r", dtype=np.int64)
+        if self.storage == "chunked":
+            self._open_chunks(fnames)
+        else:
+            self._open_memmaps(fnames)
+        self.neighbor_cutoff = None
+        if neighbor_cutoff is not None:
+            self._open_neighbors(neighbor_cutoff)
+
+    def _open_memmaps(self, fnames):
         self.z_mm = np.memmap(fnames["z"], mode="r", dtype=np.int8)
         num_all_confs = self.idx_mm.shape[0] - 1
         num_all_atoms = self.z_mm.shape[0]
@@ -89,141 +270,287 @@ class MemmappedDataset(Dataset):
         assert self.idx_mm[-1] == len(self.z_mm)
         assert len(self.idx_mm) == len(self.y_mm) + 1
 
+    def _open_chunks(self, fnames):
+        with open(fnames["format"]) as f:
+            stored = json.load(f)
+        if stored != self._chunk_format():
+            raise ValueError(
+                f"The chunks in {self.processed_dir} were stored with {stored}, but {self._chunk_format()} was "
+                "requested. Remove the processed files to convert the dataset again."
+            )
+        self.chunks_mm = np.memmap(fnames["chunks"], mode="r", dtype=np.int64).reshape(-1, 2)
+        # An empty file cannot be memory mapped
+        if os.path.getsize(fnames["data"]) > 0:
+            self.data_mm = np.memmap(fnames["data"], mode="r", dtype=np.uint8)
+        else:
+            self.data_mm = np.zeros(0, dtype=np.uint8)
+        self._chunk_cache = OrderedDict()
+        assert self.idx_mm[0] == 0
+        assert self.chunks_mm[-1, 0] == len(self)
+        assert self.chunks_mm[-1, 1] == len(self.data_mm)
+
+    def _chunk_format(self):
+        return {
+            "properties": list(self.properties),
+            "compression": self.compression,
+            "pos_dtype": self.pos_dtype,
+            "chunk_size": self.chunk_size,
+        }
+
+    @property
+    def _processed_keys(self):
+        if self.storage == "chunked":
+            return ["idx", "chunks", "data", "format"]
+        return ["idx", "z", "pos"] + list(self.properties)
+
     @property
     def processed_file_names(self):
         return [
-            f"{self.name}.{prop}.mmap"
-            for prop in ["idx", "z", "pos"] + list(self.properties)
+            f"{self.name}.{key}.{'json' if key == 'format' else 'mmap'}"
+            for key in self._processed_keys
         ]
 
     @property
     def processed_paths_dict(self):
-        return {
-            prop: fname
-            for prop, fname in zip(
-                ["idx", "z", "pos"] + list(self.properties), self.processed_paths
-            )
-        }
+        return dict(zip(self._processed_keys, self.processed_paths))
 
-    def sample_iter(self, mol_ids=False):
+    def sample_iter(self, mol_ids=False, paths=None):
         raise NotImplementedError()
 
+    def raw_shards(self):
+        """Parts of the raw data that are converted independently, in parallel and with resumable progress.
+
+        If :obj:`shard_by_file` is set, each raw file is a shard and :meth:`sample_iter` must accept a
+        :obj:`paths` argument restricting it to a list of raw files. Otherwise the whole dataset is a single shard.
+        """
+        return list(self.raw_paths) if self.shard_by_file else [None]
+
+    def _shard_iter(self, shard):
+        if shard is None:
+            return self.sample_iter()
+        return self.sample_iter(paths=[shard])
+
+    def _convert_shard(self, shard_dir, i_shard, shard):
+        """Writes the samples of a shard to its own memory-mapped files, in a single pass."""
+        prefix = os.path.join(shard_dir, f"{i_shard}")
+        writers = {
+            prop: _GrowingMemmap(f"{prefix}.{prop}.mmap", *_PROPERTY_FORMATS[prop][:2])
+            for prop in ["size", "z", "pos"] + list(self.properties)
+        }
+        for data in self._shard_iter(shard):
+            writers["size"].append(np.array([data.z.shape[0]]))
+            for prop, writer in writers.items():
+                if prop != "size":
+                    writer.append(data[prop].detach().cpu().numpy())
+        for writer in writers.values():
+            writer.close()
+        if self.storage == "chunked":
+            self._compress_shard(prefix)
+        # Mark the shard as complete, so it is not converted again if the process is interrupted
+        open(f"{prefix}.done", "w").close()
+
+    def _compress_shard(self, prefix):
+        """Replaces the memory-mapped files of a converted shard by its compressed chunks."""
+        sizes = np.fromfile(f"{prefix}.size.mmap", dtype=np.int64)
+        ptr = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=ptr[1:])
+        props = ["z", "pos"] + list(self.properties)
+        arrays = {}
+        for prop in props:
+            dtype, shape = _PROPERTY_FORMATS[prop]
+            shape = (_num_rows(prop, ptr[-1], len(sizes)),) + shape[1:]
+            if np.prod(shape) > 0:
+                arrays[prop] = np.memmap(f"{prefix}.{prop}.mmap", mode="r", dtype=dtype, shape=shape)
+            else:
+                arrays[prop] = np.zeros(shape, dtype=dtype)
+
+        compress = _COMPRESSORS[self.compression][0]
+        chunks = []
+        offset = 0
+        with open(f"{prefix}.data.mmap", "wb") as f:
+            for start in range(0, len(sizes), self.chunk_size):
+                stop = min(start + self.chunk_size, len(sizes))
+                atoms, confs = slice(ptr[start], ptr[stop]), slice(start, stop)
+                rows = {prop: values[_num_rows(prop, atoms, confs)] for prop, values in arrays.items()}
+                blob = compress(_encode_chunk(rows, self.properties, self.pos_dtype))
+                chunks.append((start, offset))
+                f.write(blob)
+                offset += len(blob)
+        chunks.append((len(sizes), offset))
+        np.array(chunks, dtype=np.int64).tofile(f"{prefix}.chunks.mmap")
+        del arrays
+        for prop in props:
+            os.remove(f"{prefix}.{prop}.mmap")
+
+    def _merge_chunks(self, shard_dir, num_shards):
+        """Concatenates the compressed chunks of all shards and their index."""
+        fnames = self.processed_paths_dict
+        tables = []
+        num_confs = 0
+        num_bytes = 0
+        with open(fnames["data"] + ".tmp", "wb") as out:
+            for i in range(num_shards):
+                table = np.fromfile(os.path.join(shard_dir, f"{i}.chunks.mmap"), dtype=np.int64).reshape(-1, 2)
+                tables.append(table[:-1] + [num_confs, num_bytes])
+                num_confs += table[-1, 0]
+                num_bytes += table[-1, 1]
+                with open(os.path.join(shard_dir, f"{i}.data.mmap"), "rb") as f:
+                    shutil.copyfileobj(f, out)
+        tables.append(np.array([[num_confs, num_bytes]], dtype=np.int64))
+        np.concatenate(tables).astype(np.int64).tofile(fnames["chunks"] + ".tmp")
+        os.rename(fnames["data"] + ".tmp", fnames["data"])
+        os.rename(fnames["chunks"] + ".tmp", fnames["chunks"])
+        with open(fnames["format"], "w") as f:
+            json.dump(self._chunk_format(), f)
+
     def process(self):
-        print("Gathering statistics...")
-        num_all_confs = 0
-        num_all_atoms = 0
-        for data in self.sample_iter():
-            num_all_confs += 1
-            num_all_atoms += data.z.shape[0]
+        shards = self.raw_shards()
+        fnames = self.processed_paths_dict
+        shard_dir = os.path.join(self.processed_dir, f"{self.name}.shards")
+        os.makedirs(shard_dir, exist_ok=True)
 
+        # Completed shards are only reused if they come from the same raw data and properties
+        manifest = os.path.join(shard_dir, "manifest.txt")
+        storage = repr(self._chunk_format()) if self.storage == "chunked" else self.storage
+        description = "\n".join([repr(self.properties), storage] + [str(shard) for shard in shards])
+        if not os.path.exists(manifest) or open(manifest).read() != description:
+            shutil.rmtree(shard_dir)
+            os.makedirs(shard_dir)
+            with open(manifest, "w") as f:
+                f.write(description)
+
+        pending = [
+            i
+            for i in range(len(shards))
+            if not os.path.exists(os.path.join(shard_dir, f"{i}.done"))
+        ]
+        if len(pending) < len(shards):
+            print(f"Resuming conversion, {len(shards) - len(pending)} of {len(shards)} shards done")
+        num_workers = min(len(pending), os.cpu_count() or 1)
+        if num_workers > 1 and "fork" in mp.get_all_start_methods():
+            # The workers inherit the dataset when forked, so it does not need to be picklable
+            global _converting_dataset
+            _converting_dataset = (self, shard_dir, shards)
+            with mp.get_context("fork").Pool(num_workers) as pool:
+                for _ in pool.imap_unordered(_convert_shard_worker, pending):
+                    pass
+            _converting_dataset = None
+        else:
+            for i in pending:
+                self._convert_shard(shard_dir, i, shards[i])
+
+        # Merge the shards
+        sizes = [
+            np.fromfile(os.path.join(shard_dir, f"{i}.size.mmap"), dtype=np.int64)
+            for i in range(len(shards))
+        ]
+        num_all_confs = sum(len(s) for s in sizes)
+        num_all_atoms = int(sum(s.sum() for s in sizes))
         print(f"  Total number of conformers: {num_all_confs}")
         print(f"  Total number of atoms: {num_all_atoms}")
         print(f"  Properties available: {self.properties}")
 
-        fnames = self.processed_paths_dict
-
         idx_mm = np.memmap(
             fnames["idx"] + ".tmp",
             mode="w+",
             dtype=np.int64,
             shape=(num_all_confs + 1,),
         )
-        z_mm = np.memmap(
-            fnames["z"] + ".tmp", mode="w+", dtype=np.int8, shape=(num_all_atoms,)
-        )
-        pos_mm = np.memmap(
-            fnames["pos"] + ".tmp",
-            mode="w+",
-            dtype=np.float32,
-            shape=(num_all_atoms, 3),
-        )
-        if "y" in self.properties:
-            y_mm = np.memmap(
-                fnames["y"] + ".tmp",
-                mode="w+",
-                dtype=np.float64,
-                shape=(num_all_confs,),
-            )
-        if "neg_dy" in self.properties:
-            neg_dy_mm = np.memmap(
-                fnames["neg_dy"] + ".tmp",
-                mode="w+",
-                dtype=np.float32,
-                shape=(num_all_atoms, 3),
-            )
-        if "q" in self.properties:
-            q_mm = np.memmap(
-                fnames["q"] + ".tmp", mode="w+", dtype=np.int8, shape=num_all_confs
-            )
-        if "pq" in self.properties:
-            pq_mm = np.memmap(
-                fnames["pq"] + ".tmp",
-                mode="w+",
-                dtype=np.float32,
-                shape=num_all_atoms,
-            )
-        if "dp" in self.properties:
-            dp_mm = np.memmap(
-                fnames["dp"] + ".tmp",
-                mode="w+",
-                dtype=np.float32,
-                shape=(num_all_confs, 3),
-            )
-
-        print("Storing data...")
-        i_atom = 0
-        for i_conf, data in enumerate(self.sample_iter()):
-            i_next_atom = i_atom + data.z.shape[0]
-
-            idx_mm[i_conf] = i_atom
-            z_mm[i_atom:i_next_atom] = data.z.to(pt.int8)
-            pos_mm[i_atom:i_next_atom] = data.pos
-            if "y" in self.properties:
-                y_mm[i_conf] = data.y
-            if "neg_dy" in self.properties:
-                neg_dy_mm[i_atom:i_next_atom] = data.neg_dy
-            if "q" in self.properties:
-                q_mm[i_conf] = data.q.to(pt.int8)
-            if "pq" in self.properties:
-                pq_mm[i_atom:i_next_atom] = data.pq
-            if "dp" in self.properties:
-                dp_mm[i_conf] = data.dp
-            i_atom = i_next_atom
-
-        idx_mm[-1] = num_all_atoms
-        assert i_atom == num_all_atoms
-
+        idx_mm[0] = 0
+        if num_all_confs > 0:
+            np.cumsum(np.concatenate(sizes), out=idx_mm[1:])
         idx_mm.flush()
-        z_mm.flush()
-        pos_mm.flush()
-        if "y" in self.properties:
-            y_mm.flush()
-        if "neg_dy" in self.properties:
-            neg_dy_mm.flush()
-        if "q" in self.properties:
-            q_mm.flush()
-        if "pq" in self.properties:
-            pq_mm.flush()
-        if "dp" in self.properties:
-            dp_mm.flush()
-
         os.rename(idx_mm.filename, fnames["idx"])
-        os.rename(z_mm.filename, fnames["z"])
-        os.rename(pos_mm.filename, fnames["pos"])
-        if "y" in self.properties:
-            os.rename(y_mm.filename, fnames["y"])
-        if "neg_dy" in self.properties:
-            os.rename(neg_dy_mm.filename, fnames["neg_dy"])
-        if "q" in self.properties:
-            os.rename(q_mm.filename, fnames["q"])
-        if "pq" in self.properties:
-            os.rename(pq_mm.filename, fnames["pq"])
-        if "dp" in self.properties:
-            os.rename(dp_mm.filename, fnames["dp"])
+        if self.storage == "chunked":
+            self._merge_chunks(shard_dir, len(shards))
+        else:
+            for prop in ["z", "pos"] + list(self.properties):
+                with open(fnames[prop] + ".tmp", "wb") as out:
+                    for i in range(len(shards)):
+                        with open(os.path.join(shard_dir, f"{i}.{prop}.mmap"), "rb") as f:
+                            shutil.copyfileobj(f, out)
+                os.rename(fnames[prop] + ".tmp", fnames[prop])
+        shutil.rmtree(shard_dir)
 
     def len(self):
         return len(self.idx_mm) - 1
 
+    @property
+    def sizes(self):
+        """Number of atoms of each conformation, as a numpy array."""
+        return np.diff(self.idx_mm)
+
+    def neighbor_counts(self, cutoff):
+        """Number of neighbor pairs of each conformation within a cutoff, as a numpy array.
+
+        Pairs are counted in both directions, as in the edges of the models. The counts are computed once and stored
+        next to the processed files, in :obj:`name.neighbors_{cutoff}.mmap`.
+
+        Args:
+            cutoff (float): Cutoff distance, in the units of the positions.
+        """
+        fname = os.path.join(self.processed_dir, f"{self.name}.neighbors_{cutoff:g}.mmap")
+        if not os.path.exists(fname):
+            counts = np.memmap(
+                fname + ".tmp", mode="w+", dtype=np.int32, shape=(len(self),)
+            )
+            for i in range(len(self)):
+                pos = self.get(i).pos.numpy()
+                distance2 = ((pos[:, None, :] - pos[None, :, :]) ** 2).sum(-1)
+                counts[i] = (distance2 < cutoff**2).sum() - len(pos)
+            counts.flush()
+            os.rename(counts.filename, fname)
+        return np.memmap(fname, mode="r", dtype=np.int32)
+
+    def neighbor_pairs(self, cutoff):
+        """Pairs of atoms of each conformation within a cutoff, computed once and stored next to the processed files.
+
+        Pairs are listed in both directions, excluding self-interactions, with the indices of the atoms within their
+        conformation. They are stored in :obj:`name.edge_idx_{cutoff}.mmap`, with shape (num_pairs, 2), and the pairs
+        of conformation :obj:`i` are rows :obj:`edge_ptr[i]:edge_ptr[i + 1]`, stored in
+        :obj:`name.edge_ptr_{cutoff}.mmap`.
+
+        Args:
+            cutoff (float): Cutoff distance, in the units of the positions.
+
+        Returns:
+            tuple of numpy arrays: The pairs and the offsets of the pairs of each conformation.
+        """
+        prefix = os.path.join(self.processed_dir, f"{self.name}")
+        fnames = (f"{prefix}.edge_idx_{cutoff:g}.mmap", f"{prefix}.edge_ptr_{cutoff:g}.mmap")
+        if not all(os.path.exists(f) for f in fnames):
+            # Pairs slightly beyond the cutoff are kept, the model checks the distances again
+            cutoff2 = (cutoff * (1 + 1e-5)) ** 2
+            tmp = [f"{f}.{os.getpid()}.tmp" for f in fnames]
+            writer = _GrowingMemmap(tmp[0], np.int32, (None, 2))
+            counts = np.zeros(len(self), dtype=np.int64)
+            for i in range(len(self)):
+                pos = self.get(i).pos.numpy().astype(np.float64)
+                distance2 = ((pos[:, None, :] - pos[None, :, :]) ** 2).sum(-1)
+                np.fill_diagonal(distance2, np.inf)
+                pairs = np.stack(np.nonzero(distance2 < cutoff2), axis=1)
+                writer.append(pairs)
+                counts[i] = len(pairs)
+            writer.close()
+            ptr = np.zeros(len(self) + 1, dtype=np.int64)
+            np.cumsum(counts, out=ptr[1:])
+            ptr.tofile(tmp[1])
+            # Another process may have written them concurrently, the result is the same
+            for t, f in zip(tmp, fnames):
+                os.replace(t, f)
+        ptr = np.fromfile(fnames[1], dtype=np.int64)
+        pairs = (
+            np.memmap(fnames[0], mode="r", dtype=np.int32, shape=(ptr[-1], 2))
+            if ptr[-1] > 0
+            else np.zeros((0, 2), dtype=np.int32)
+        )
+        return pairs, ptr
+
+    def _open_neighbors(self, cutoff):
+        self.edge_idx_mm, self.edge_ptr = self.neighbor_pairs(cutoff)
+        assert len(self.edge_ptr) == len(self) + 1
+        self.neighbor_cutoff = cutoff
+
     def get(self, idx):
         """Gets the data object at index :obj:`idx`.
 
@@ -236,6 +563,7 @@ class MemmappedDataset(Dataset):
             - :obj:`q`: Total charge of the molecule.
             - :obj:`pq`: Partial charges of the atoms.
             - :obj:`dp`: Dipole moment of the molecule.
+            - :obj:`neighbor_index`: Precomputed pairs of neighbors, if :obj:`neighbor_cutoff` was given.
 
         Args:
             idx (int): Index of the data object.
@@ -243,19 +571,144 @@ class MemmappedDataset(Dataset):
         Returns:
             :obj:`torch_geometric.data.Data`: The data object.
         """
-        atoms = slice(self.idx_mm[idx], self.idx_mm[idx + 1])
-        z = pt.tensor(self.z_mm[atoms], dtype=pt.long)
-        pos = pt.tensor(self.pos_mm[atoms])
+        arrays, (conf,), (start,) = self._locate([idx])
+        atoms = slice(start, start + self.idx_mm[idx + 1] - self.idx_mm[idx])
+        z = pt.tensor(arrays["z"][atoms], dtype=pt.long)
+        pos = pt.tensor(arrays["pos"][atoms])
 
         props = {}
         if "y" in self.properties:
-            props["y"] = pt.tensor(self.y_mm[idx]).view(1, 1)
+            props["y"] = pt.tensor(arrays["y"][conf]).view(1, 1)
         if "neg_dy" in self.properties:
-            props["neg_dy"] = pt.tensor(self.neg_dy_mm[atoms])
+            props["neg_dy"] = pt.tensor(arrays["neg_dy"][atoms])
         if "q" in self.properties:
-            props["q"] = pt.tensor(self.q_mm[idx], dtype=pt.long)
+            props["q"] = pt.tensor(arrays["q"][conf], dtype=pt.long)
         if "pq" in self.properties:
-            props["pq"] = pt.tensor(self.pq_mm[atoms])
+            props["pq"] = pt.tensor(arrays["pq"][atoms])
         if "dp" in self.properties:
-            props["dp"] = pt.tensor(self.dp_mm[idx])
+            props["dp"] = pt.tensor(arrays["dp"][conf])
+        if self.neighbor_cutoff is not None:
+            pairs = self.edge_idx_mm[self.edge_ptr[idx] : self.edge_ptr[idx + 1]]
+            props["neighbor_index"] = pt.tensor(pairs.T, dtype=pt.long)
         return Data(z=z, pos=pos, **props)
+
+    def _load_chunk(self, i_chunk):
+        """Decompresses a chunk, or returns it from the cache of the last decompressed chunks."""
+        if i_chunk in self._chunk_cache:
+            self._chunk_cache.move_to_end(i_chunk)
+            return self._chunk_cache[i_chunk]
+        (first, begin), (last, end) = self.chunks_mm[i_chunk], self.chunks_mm[i_chunk + 1]
+        raw = _COMPRESSORS[self.compression][1](self.data_mm[begin:end])
+        num_atoms = int(self.idx_mm[last] - self.idx_mm[first])
+        arrays = _decode_chunk(raw, self.properties, self.pos_dtype, num_atoms, int(last - first))
+        self._chunk_cache[i_chunk] = arrays
+        if len(self._chunk_cache) > self.chunk_cache_size:
+            self._chunk_cache.popitem(last=False)
+        return arrays
+
+    def _locate(self, indices):
+        """Finds the arrays holding some conformations.
+
+        Returns:
+            A dictionary with the arrays of each field, the rows of the conformations in the per-conformation arrays
+            and the rows of their first atoms in the per-atom arrays.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = np.asarray(self.idx_mm[indices])
+        if self.storage == "mmap":
+            arrays = {prop: getattr(self, f"{prop}_mm") for prop in ["z", "pos"] + list(self.properties)}
+            return arrays, indices, starts
+
+        # Gather the chunks holding the conformations, one after the other
+        chunks = np.searchsorted(self.chunks_mm[:, 0], indices, side="right") - 1
+        unique, inverse = np.unique(chunks, return_inverse=True)
+        decoded = [self._load_chunk(i) for i in unique]
+        if len(decoded) == 1:
+            arrays = decoded[0]
+        else:
+            arrays = {prop: np.concatenate([d[prop] for d in decoded]) for prop in decoded[0]}
+        first_conf = self.chunks_mm[unique, 0]
+        num_confs = self.chunks_mm[unique + 1, 0] - first_conf
+        first_atom = self.idx_mm[first_conf]
+        num_atoms = self.idx_mm[first_conf + num_confs] - first_atom
+        conf_shift = np.cumsum(num_confs) - num_confs - first_conf
+        atom_shift = np.cumsum(num_atoms) - num_atoms - first_atom
+        return arrays, indices + conf_shift[inverse], starts + atom_shift[inverse]
+
+    def prefetch(self, start, stop):
+        """Advises the operating system that conformations :obj:`start` to :obj:`stop` will be read soon.
+
+        The pages of all memory-mapped files holding these conformations are read ahead in the background. This is a
+        no-op on platforms without :obj:`madvise`.
+        """
+        if not hasattr(mmap, "MADV_WILLNEED") or stop <= start:
+            return
+        if self.storage == "chunked":
+            chunks = np.searchsorted(self.chunks_mm[:, 0], [start, stop - 1], side="right") - 1
+            byte_range = (int(self.chunks_mm[chunks[0], 1]), int(self.chunks_mm[chunks[1] + 1, 1]))
+            ranges = [(self.data_mm, byte_range)] if isinstance(self.data_mm, np.memmap) else []
+        else:
+            atoms = (int(self.idx_mm[start]), int(self.idx_mm[stop]))
+            ranges = [(self.z_mm, atoms), (self.pos_mm, atoms)]
+            for prop in self.properties:
+                per_atom = _PROPERTY_FORMATS[prop][1][0] is None
+                ranges.append((getattr(self, f"{prop}_mm"), atoms if per_atom else (start, stop)))
+        for array, (first, last) in ranges:
+            row_bytes = array.itemsize * int(np.prod(array.shape[1:]))
+            begin = array.offset + first * row_bytes
+            aligned = begin - begin % mmap.PAGESIZE
+            length = array.offset + last * row_bytes - aligned
+            if length > 0:
+                array._mmap.madvise(mmap.MADV_WILLNEED, aligned, length)
+
+    def get_batch(self, indices):
+        """Gets a batch of conformations at once.
+
+        The result is the same as collating the data objects returned by :meth:`get`, but the atoms of all
+        conformations are gathered with a single vectorized read per field, without creating a data object per
+        conformation. Transforms are not applied.
+
+        Args:
+            indices (sequence of int): Indices of the conformations.
+
+        Returns:
+            :obj:`torch_geometric.data.Batch`: The batch, including the :obj:`batch` and :obj:`ptr` vectors.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        arrays, confs, starts = self._locate(indices)
+        counts = np.asarray(self.idx_mm[indices + 1]) - np.asarray(self.idx_mm[indices])
+        ends = starts + counts
+        ptr = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=ptr[1:])
+        if len(indices) > 0 and np.array_equal(starts[1:], ends[:-1]):
+            # Consecutive conformations are read as a single block
+            atoms = slice(starts[0], ends[-1])
+        else:
+            atoms = np.repeat(starts - ptr[:-1], counts) + np.arange(ptr[-1])
+
+        props = {}
+        if "y" in self.properties:
+            props["y"] = pt.from_numpy(np.array(arrays["y"][confs])).view(-1, 1)
+        if "neg_dy" in self.properties:
+            props["neg_dy"] = pt.from_numpy(np.array(arrays["neg_dy"][atoms]))
+        if "q" in self.properties:
+            props["q"] = pt.from_numpy(arrays["q"][confs].astype(np.int64))
+        if "pq" in self.properties:
+            props["pq"] = pt.from_numpy(np.array(arrays["pq"][atoms]))
+        if "dp" in self.properties:
+            props["dp"] = pt.from_numpy(np.array(arrays["dp"][confs])).view(-1)
+        if self.neighbor_cutoff is not None:
+            first, last = self.edge_ptr[indices], self.edge_ptr[indices + 1]
+            num_pairs = last - first
+            offsets = np.cumsum(num_pairs) - num_pairs
+            rows = np.repeat(first - offsets, num_pairs) + np.arange(num_pairs.sum())
+            # Pairs are stored with atom indices within their conformation
+            pairs = self.edge_idx_mm[rows].astype(np.int64) + np.repeat(ptr[:-1], num_pairs)[:, None]
+            props["neighbor_index"] = pt.from_numpy(np.ascontiguousarray(pairs.T))
+        return Batch(
+            z=pt.from_numpy(arrays["z"][atoms].astype(np.int64)),
+            pos=pt.from_numpy(np.array(arrays["pos"][atoms])),
+            batch=pt.arange(len(indices)).repeat_interleave(pt.from_numpy(counts)),
+            ptr=pt.from_numpy(ptr),
+            **props,
+        )
@@ -6,6 +6,7 @@ import torch
 from torch_geometric.transforms import Compose
 from torch_geometric.datasets import QM9 as QM9_geometric
 from torch_geometric.nn.models.schnet import qm9_target_dict
+from torchmdnet.utils import sizes_from_slices
 
 
 class QM9(QM9_geometric):
@@ -46,6 +47,10 @@ class QM9(QM9_geometric):
             return tmp
         return atomref
 
+    @property
+    def sizes(self):
+        return sizes_from_slices(self.slices)
+
     def _filter_label(self, batch):
         batch.y = batch.y[:, self.label_idx].unsqueeze(1)
         return batch
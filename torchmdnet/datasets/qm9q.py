@@ -15,6 +15,7 @@ class QM9q(MemmappedDataset):
     HARTREE_TO_EV = 27.211386246  #::meta private:
     BORH_TO_ANGSTROM = 0.529177  #::meta private:
     DEBYE_TO_EANG = 0.2081943  #::meta private: Debey -> e*A
+    shard_by_file = True
 
     # Ion energies of elements
     ELEMENT_ENERGIES = {
@@ -38,6 +39,7 @@ class QM9q(MemmappedDataset):
         pre_transform=None,
         pre_filter=None,
         paths=None,
+        **kwargs,
     ):
         self.name = self.__class__.__name__
         self.paths = str(paths)
@@ -48,6 +50,7 @@ class QM9q(MemmappedDataset):
             pre_filter,
             remove_ref_energy=False,
             properties=("y", "neg_dy", "q", "pq", "dp"),
+            **kwargs,
         )
 
     @property
@@ -99,8 +102,8 @@ class QM9q(MemmappedDataset):
 
         return energy * QM9q.HARTREE_TO_EV
 
-    def sample_iter(self, mol_ids=False):
-        for path in tqdm(self.raw_paths, desc="Files"):
+    def sample_iter(self, mol_ids=False, paths=None):
+        for path in tqdm(self.raw_paths if paths is None else paths, desc="Files"):
             molecules = list(h5py.File(path).values())[0].items()
 
             for mol_id, mol in tqdm(molecules, desc="Molecules", leave=False):
@@ -89,6 +89,7 @@ class SPICE(MemmappedDataset):
         subsets=None,
         max_gradient=None,
         subsample_molecules=1,
+        **kwargs,
     ):
         arg_hash = f"{version}{subsets}{max_gradient}{subsample_molecules}"
         arg_hash = hashlib.md5(arg_hash.encode()).hexdigest()
@@ -105,6 +106,7 @@ class SPICE(MemmappedDataset):
             pre_filter,
             remove_ref_energy=False,
             properties=("y", "neg_dy"),
+            **kwargs,
         )
 
     def sample_iter(self, mol_ids=False):
@@ -1,5 +1,6 @@
 from torch_geometric.data import InMemoryDataset, Data
 import torch
+from torchmdnet.utils import sizes_from_slices
 import numpy as np
 import os
 import requests
@@ -64,6 +65,10 @@ class WaterBox(InMemoryDataset):
         super(WaterBox, self).__init__(root, transform, pre_transform)
         self.load(self.processed_paths[0])
 
+    @property
+    def sizes(self):
+        return sizes_from_slices(self.slices)
+
     @property
     def raw_file_names(self):
         return ['dataset_1593.xyz']
@@ -2,6 +2,8 @@
  * Distributed under the MIT License.
  *(See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
 */
+#include "neighbors_cpu_brute.h"
+#include "neighbors_cpu_cell.h"
 #include <torch/extension.h>
 #include <tuple>
 
@@ -22,9 +24,9 @@ using torch::indexing::None;
 using torch::indexing::Slice;
 
 static tuple<Tensor, Tensor, Tensor, Tensor>
-forward(const Tensor& positions, const Tensor& batch, const Tensor& in_box_vectors,
-        bool use_periodic, const Scalar& cutoff_lower, const Scalar& cutoff_upper,
-        const Scalar& max_num_pairs, bool loop, bool include_transpose) {
+forward(const std::string& strategy, const Tensor& positions, const Tensor& batch,
+        const Tensor& in_box_vectors, bool use_periodic, const Scalar& cutoff_lower,
+        const Scalar& cutoff_upper, const Scalar& max_num_pairs, bool loop, bool include_transpose) {
     TORCH_CHECK(positions.dim() == 2, "Expected \"positions\" to have two dimensions");
     TORCH_CHECK(positions.size(0) > 0,
                 "Expected the 1nd dimension size of \"positions\" to be more than 0");
@@ -64,16 +66,25 @@ forward(const Tensor& positions, const Tensor& batch, const Tensor& in_box_vecto
                     "Invalid box vectors: box_vectors[1][1] < 2*box_vectors[2][1]");
     }
     TORCH_CHECK(max_num_pairs.toLong() > 0, "Expected \"max_num_neighbors\" to be positive");
+    // There is no distinction between the brute and shared strategies on the CPU
+    TORCH_CHECK(strategy == "brute" || strategy == "shared" || strategy == "cell",
+                "Unknown strategy \"" + strategy + "\", expected brute, shared or cell");
     const int n_atoms = positions.size(0);
-    Tensor neighbors = torch::empty({0}, positions.options().dtype(kInt32));
-    Tensor distances = torch::empty({0}, positions.options());
-    Tensor deltas = torch::empty({0}, positions.options());
-    neighbors = torch::vstack((torch::tril_indices(n_atoms, n_atoms, -1, neighbors.options())));
-    auto mask = index_select(batch, 0, neighbors.index({0, Slice()})) ==
-                index_select(batch, 0, neighbors.index({1, Slice()}));
-    neighbors = neighbors.index({Slice(), mask}).to(kInt32);
-    deltas = index_select(positions, 0, neighbors.index({0, Slice()})) -
-             index_select(positions, 0, neighbors.index({1, Slice()}));
+    // The candidate pairs are found in parallel in double precision, the exact cutoff is applied
+    // below to the much smaller list of candidates
+    const cpu::Input input =
+        cpu::prepareInput(positions, batch, box_vectors, use_periodic, cutoff_lower.to<double>(),
+                          cutoff_upper.to<double>(), n_batch);
+    Tensor neighbors;
+    if (strategy == "cell") {
+        neighbors = cpu_cell::findCandidatePairs(input, positions.options());
+    } else {
+        neighbors = cpu_brute::findCandidatePairs(input, positions.options());
+    }
+    // The distances are computed with differentiable operations, so that the candidate pairs
+    // found by any strategy are treated in the same way
+    Tensor deltas = index_select(positions, 0, neighbors.index({0, Slice()})) -
+                    index_select(positions, 0, neighbors.index({1, Slice()}));
     if (use_periodic) {
         const auto pair_batch = batch.index({neighbors.index({0, Slice()})});
         const auto scale3 =
@@ -95,8 +106,8 @@ forward(const Tensor& positions, const Tensor& batch, const Tensor& in_box_vecto
         deltas.index_put_({Slice(), 0}, deltas.index({Slice(), 0}) -
                                             scale1 * box_vectors.index({pair_batch, 0, 0}));
     }
-    distances = frobenius_norm(deltas, 1);
-    mask = (distances < cutoff_upper) * (distances >= cutoff_lower);
+    Tensor distances = frobenius_norm(deltas, 1);
+    const auto mask = (distances < cutoff_upper) * (distances >= cutoff_lower);
     neighbors = neighbors.index({Slice(), mask});
     deltas = deltas.index({mask, Slice()});
     distances = distances.index({mask});
@@ -113,6 +124,13 @@ forward(const Tensor& positions, const Tensor& batch, const Tensor& in_box_vecto
     }
     Tensor num_pairs_found = torch::empty(1, distances.options().dtype(kInt32));
     num_pairs_found[0] = distances.size(0);
+    // Pairs after the max number of pairs are ignored, although they are counted
+    const int64_t max_pairs = max_num_pairs.toLong();
+    if (distances.size(0) > max_pairs) {
+        neighbors = neighbors.index({Slice(), Slice(0, max_pairs)});
+        deltas = deltas.index({Slice(0, max_pairs), Slice()});
+        distances = distances.index({Slice(0, max_pairs)});
+    }
     return {neighbors, deltas, distances, num_pairs_found};
 }
 
@@ -122,7 +140,7 @@ TORCH_LIBRARY_IMPL(torchmdnet_extensions, CPU, m) {
               const Tensor& box_vectors, bool use_periodic, const Scalar& cutoff_lower,
               const Scalar& cutoff_upper, const Scalar& max_num_pairs, bool loop,
               bool include_transpose) {
-               return forward(positions, batch, box_vectors, use_periodic, cutoff_lower,
+               return forward(strategy, positions, batch, box_vectors, use_periodic, cutoff_lower,
                               cutoff_upper, max_num_pairs, loop, include_transpose);
            });
 }
@@ -0,0 +1,39 @@
+/* Copyright Universitat Pompeu Fabra 2020-2023  https://www.compscience.org
+ * Distributed under the MIT License.
+ *(See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
+ * Multithreaded brute force neighbor search for the CPU.
+ */
+#ifndef NEIGHBORS_CPU_BRUTE_H
+#define NEIGHBORS_CPU_BRUTE_H
+#include "neighbors_cpu_common.h"
+
+namespace cpu_brute {
+
+using torch::Tensor;
+
+/*
+ * @brief Finds the candidate neighbor pairs testing all pairs of atoms in each sample.
+ * Each row is an atom, which is tested against all the atoms with a lower index in its sample.
+ * @param in Inputs prepared with cpu::prepareInput
+ * @param options Options of the returned tensor
+ * @return A tensor of shape (2, num_pairs) with the pairs (i, j), i > j, as int32.
+ */
+static Tensor findCandidatePairs(const cpu::Input& in, const torch::TensorOptions& options) {
+    const int64_t n_atoms = in.atoms.size();
+    std::vector<int64_t> cost(n_atoms);
+    for (int64_t k = 0; k < n_atoms; k++) {
+        cost[k] = k - in.sample_start[in.sample_of_atom[k]] + 1;
+    }
+    auto process_row = [&](int64_t k, std::vector<int32_t>& pairs) {
+        const int64_t sample = in.sample_of_atom[k];
+        const double* box = in.box ? in.box + 9 * sample : nullptr;
+        const int64_t i = in.atoms[k];
+        for (int64_t l = in.sample_start[sample]; l < k; l++) {
+            cpu::testPair(in, i, in.atoms[l], box, pairs);
+        }
+    };
+    return cpu::findPairsInParallel(cost, process_row, options);
+}
+
+} // namespace cpu_brute
+#endif
@@ -0,0 +1,248 @@
+/* Copyright Universitat Pompeu Fabra 2020-2023  https://www.compscience.org
+ * Distributed under the MIT License.
+ *(See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
+ * Batched cell list neighbor search for the CPU.
+ */
+#ifndef NEIGHBORS_CPU_CELL_H
+#define NEIGHBORS_CPU_CELL_H
+#include "neighbors_cpu_common.h"
+
+namespace cpu_cell {
+
+using torch::Tensor;
+
+/*
+ * @brief Geometry of the cell grid of a single sample.
+ * With periodic boundary conditions the grid is laid out in fractional coordinates of the
+ * (possibly triclinic) box. Without them it covers the bounding box of the sample.
+ */
+struct Grid {
+    double box[3][3];  // Box vectors (rows). Only the diagonal (extents) is used without PBC.
+    double origin[3];  // Lower corner of the bounding box. Unused with PBC.
+    int dim[3];        // Number of cells in each direction
+    bool periodic;
+};
+
+/*
+ * @brief Number of cells that fit in a direction of length width, each of them at least cutoff
+ * wide.
+ */
+static inline int cellsInLength(double width, double cutoff) {
+    const double n = std::floor(width / cutoff);
+    // Also catches NaN (i.e. zero width and zero cutoff) and an infinite cutoff
+    if (!(n >= 1.0))
+        return 1;
+    return static_cast<int>(std::min(n, 1024.0));
+}
+
+/*
+ * @brief Builds the cell grid for a sample.
+ * @param pos Positions of all atoms, shape (N, 3)
+ * @param atoms Indices of the atoms in this sample
+ * @param n_atoms Number of atoms in this sample
+ * @param box Box vectors of the sample (ignored if periodic is false)
+ * @param cutoff Minimum width of a cell
+ * @param periodic Whether to apply periodic boundary conditions
+ */
+static Grid buildGrid(const double* pos, const int64_t* atoms, int64_t n_atoms, const double* box,
+                      double cutoff, bool periodic) {
+    Grid grid;
+    grid.periodic = periodic;
+    for (int i = 0; i < 3; i++) {
+        for (int j = 0; j < 3; j++) {
+            grid.box[i][j] = 0;
+        }
+    }
+    if (periodic) {
+        for (int i = 0; i < 3; i++) {
+            for (int j = 0; j < 3; j++) {
+                grid.box[i][j] = box[3 * i + j];
+            }
+        }
+        // The perpendicular width of the box along each reduced direction is V/|b_k x b_l|.
+        const auto& a = grid.box[0];
+        const auto& b = grid.box[1];
+        const auto& c = grid.box[2];
+        const double volume = std::abs(a[0] * b[1] * c[2]);
+        const double* vectors[3][2] = {{b, c}, {c, a}, {a, b}};
+        for (int k = 0; k < 3; k++) {
+            const double* u = vectors[k][0];
+            const double* v = vectors[k][1];
+            const double cx = u[1] * v[2] - u[2] * v[1];
+            const double cy = u[2] * v[0] - u[0] * v[2];
+            const double cz = u[0] * v[1] - u[1] * v[0];
+            const double area = std::sqrt(cx * cx + cy * cy + cz * cz);
+            grid.dim[k] = cellsInLength(volume / area, cutoff);
+            grid.origin[k] = 0;
+        }
+    } else {
+        double lo[3] = {INFINITY, INFINITY, INFINITY};
+        double hi[3] = {-INFINITY, -INFINITY, -INFINITY};
+        for (int64_t i = 0; i < n_atoms; i++) {
+            const int64_t i_atom = atoms[i];
+            for (int k = 0; k < 3; k++) {
+                lo[k] = std::min(lo[k], pos[3 * i_atom + k]);
+                hi[k] = std::max(hi[k], pos[3 * i_atom + k]);
+            }
+        }
+        for (int k = 0; k < 3; k++) {
+            grid.origin[k] = lo[k];
+            grid.box[k][k] = hi[k] - lo[k];
+            grid.dim[k] = cellsInLength(grid.box[k][k], cutoff);
+        }
+    }
+    // Merging cells keeps them wider than the cutoff, so the grid can be coarsened freely.
+    // Avoid having many more cells than atoms, which would only waste memory.
+    const int64_t max_cells = std::max<int64_t>(27, n_atoms);
+    while (int64_t(grid.dim[0]) * grid.dim[1] * grid.dim[2] > max_cells) {
+        const int k = std::max_element(grid.dim, grid.dim + 3) - grid.dim;
+        grid.dim[k] = (grid.dim[k] + 1) / 2;
+    }
+    return grid;
+}
+
+/*
+ * @brief Computes the (integer) cell coordinates of a position.
+ */
+static inline void getCell(const double* p, const Grid& grid, int cell[3]) {
+    double s[3];
+    if (grid.periodic) {
+        // Fractional coordinates for a box in reduced (lower triangular) form
+        s[2] = p[2] / grid.box[2][2];
+        s[1] = (p[1] - s[2] * grid.box[2][1]) / grid.box[1][1];
+        s[0] = (p[0] - s[1] * grid.box[1][0] - s[2] * grid.box[2][0]) / grid.box[0][0];
+        for (int k = 0; k < 3; k++) {
+            s[k] -= std::floor(s[k]);
+        }
+    } else {
+        for (int k = 0; k < 3; k++) {
+            s[k] = grid.box[k][k] > 0 ? (p[k] - grid.origin[k]) / grid.box[k][k] : 0;
+        }
+    }
+    for (int k = 0; k < 3; k++) {
+        // Positions exactly at the upper edge belong to the last cell
+        cell[k] = std::min(std::max(static_cast<int>(s[k] * grid.dim[k]), 0), grid.dim[k] - 1);
+    }
+}
+
+static inline int getCellIndex(const int cell[3], const Grid& grid) {
+    return cell[0] + grid.dim[0] * (cell[1] + grid.dim[1] * cell[2]);
+}
+
+/*
+ * @brief Offsets of the neighboring cells in one direction.
+ * With PBC and less than three cells some offsets refer to the same cell, they are only visited
+ * once so that each pair is found a single time.
+ */
+static inline std::vector<int> neighborOffsets(int dim, bool periodic) {
+    if (periodic && dim == 1) {
+        return {0};
+    }
+    if (periodic && dim == 2) {
+        return {0, 1};
+    }
+    return {-1, 0, 1};
+}
+
+/*
+ * @brief Binned atoms of a sample. Atoms in cell c are sorted_atoms[cell_start[c]:cell_start[c+1]]
+ */
+struct CellList {
+    Grid grid;
+    std::vector<int64_t> cell_start;
+    std::vector<int64_t> sorted_atoms; // Global atom indices sorted by cell
+};
+
+static CellList constructCellList(const double* pos, const int64_t* atoms, int64_t n_atoms,
+                                  const double* box, double cutoff, bool periodic) {
+    // Same three steps as the CUDA version: label atoms by cell, sort them by cell (here with a
+    // counting sort) and identify where each cell starts in the sorted array.
+    CellList cl;
+    cl.grid = buildGrid(pos, atoms, n_atoms, box, cutoff, periodic);
+    const int64_t num_cells = int64_t(cl.grid.dim[0]) * cl.grid.dim[1] * cl.grid.dim[2];
+    std::vector<int> cell_of_atom(n_atoms);
+    cl.cell_start.assign(num_cells + 1, 0);
+    for (int64_t i = 0; i < n_atoms; i++) {
+        int cell[3];
+        getCell(pos + 3 * atoms[i], cl.grid, cell);
+        cell_of_atom[i] = getCellIndex(cell, cl.grid);
+        cl.cell_start[cell_of_atom[i] + 1]++;
+    }
+    std::partial_sum(cl.cell_start.begin(), cl.cell_start.end(), cl.cell_start.begin());
+    std::vector<int64_t> fill(cl.cell_start.begin(), cl.cell_start.end() - 1);
+    cl.sorted_atoms.resize(n_atoms);
+    for (int64_t i = 0; i < n_atoms; i++) {
+        cl.sorted_atoms[fill[cell_of_atom[i]]++] = atoms[i];
+    }
+    return cl;
+}
+
+/*
+ * @brief Appends to pairs all pairs (i, j), i > j, with a distance (approximately) inside the
+ * cutoffs, visiting only the cells around the one containing i.
+ */
+static void addPairsForAtom(const cpu::Input& in, int64_t i_atom, const CellList& cl,
+                            const double* box, std::vector<int32_t>& pairs) {
+    const Grid& grid = cl.grid;
+    int cell_i[3];
+    getCell(in.pos + 3 * i_atom, grid, cell_i);
+    std::vector<int> offsets[3];
+    for (int k = 0; k < 3; k++) {
+        offsets[k] = neighborOffsets(grid.dim[k], grid.periodic);
+    }
+    for (const int ox : offsets[0]) {
+        for (const int oy : offsets[1]) {
+            for (const int oz : offsets[2]) {
+                int cell_j[3] = {cell_i[0] + ox, cell_i[1] + oy, cell_i[2] + oz};
+                bool outside = false;
+                for (int k = 0; k < 3; k++) {
+                    if (grid.periodic) {
+                        cell_j[k] = (cell_j[k] + grid.dim[k]) % grid.dim[k];
+                    } else if (cell_j[k] < 0 || cell_j[k] >= grid.dim[k]) {
+                        outside = true;
+                    }
+                }
+                if (outside)
+                    continue;
+                const int c = getCellIndex(cell_j, grid);
+                for (int64_t cur = cl.cell_start[c]; cur < cl.cell_start[c + 1]; cur++) {
+                    const int64_t j_atom = cl.sorted_atoms[cur];
+                    if (j_atom < i_atom) {
+                        cpu::testPair(in, i_atom, j_atom, box, pairs);
+                    }
+                }
+            }
+        }
+    }
+}
+
+/*
+ * @brief Finds the candidate neighbor pairs using a cell list, in O(N) time.
+ * Each sample in the batch is binned independently, using its own box if a box per sample is
+ * provided. The cell lists are built sequentially and then traversed using all threads.
+ * @param in Inputs prepared with cpu::prepareInput
+ * @param options Options of the returned tensor
+ * @return A tensor of shape (2, num_pairs) with the pairs (i, j), i > j, as int32.
+ */
+static Tensor findCandidatePairs(const cpu::Input& in, const torch::TensorOptions& options) {
+    const int64_t n_batch = in.sample_start.size() - 1;
+    const bool periodic = in.box != nullptr;
+    std::vector<CellList> cell_lists(n_batch);
+    for (int64_t b = 0; b < n_batch; b++) {
+        const int64_t first = in.sample_start[b];
+        cell_lists[b] = constructCellList(in.pos, in.atoms.data() + first,
+                                          in.sample_start[b + 1] - first,
+                                          periodic ? in.box + 9 * b : nullptr, in.cutoff_upper,
+                                          periodic);
+    }
+    const std::vector<int64_t> cost(in.atoms.size(), 1);
+    auto process_row = [&](int64_t k, std::vector<int32_t>& pairs) {
+        const int64_t sample = in.sample_of_atom[k];
+        addPairsForAtom(in, in.atoms[k], cell_lists[sample],
+                        periodic ? in.box + 9 * sample : nullptr, pairs);
+    };
+    return cpu::findPairsInParallel(cost, process_row, options);
+}
+
+} // namespace cpu_cell
+#endif
@@ -0,0 +1,165 @@
+/* Copyright Universitat Pompeu Fabra 2020-2023  https://www.compscience.org
+ * Distributed under the MIT License.
+ *(See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
+ * Utilities shared by the CPU neighbor search strategies.
+ */
+#ifndef NEIGHBORS_CPU_COMMON_H
+#define NEIGHBORS_CPU_COMMON_H
+#include <ATen/Parallel.h>
+#include <torch/extension.h>
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
+#include <numeric>
+#include <vector>
+
+namespace cpu {
+
+using torch::Tensor;
+using torch::TensorOptions;
+
+/*
+ * @brief Takes a distance vector to the unit cell using the minimum image convention.
+ * This is the same operation performed by triclinic::apply_pbc in the CUDA implementation.
+ */
+static inline void apply_pbc(double d[3], const double* box) {
+    const double scale3 = std::nearbyint(d[2] / box[8]);
+    d[0] -= scale3 * box[6];
+    d[1] -= scale3 * box[7];
+    d[2] -= scale3 * box[8];
+    const double scale2 = std::nearbyint(d[1] / box[4]);
+    d[0] -= scale2 * box[3];
+    d[1] -= scale2 * box[4];
+    const double scale1 = std::nearbyint(d[0] / box[0]);
+    d[0] -= scale1 * box[0];
+}
+
+/*
+ * @brief Host copies of the inputs in double precision.
+ * The pairs are only preselected with these, the distances are recomputed by the caller in the
+ * precision of the positions.
+ */
+struct Input {
+    Tensor positions;
+    Tensor box_vectors;
+    const double* pos;
+    const double* box; // nullptr if PBC are not used
+    // The atoms of sample b are atoms[sample_start[b]:sample_start[b+1]], sorted by index
+    std::vector<int64_t> atoms;
+    std::vector<int64_t> sample_start;
+    std::vector<int64_t> sample_of_atom; // Sample of atoms[k]
+    double cutoff_lower, cutoff_upper;
+    // Squared cutoffs used to preselect pairs, slightly loose so no pair is lost to rounding
+    double candidate_lower2, candidate_upper2;
+};
+
+static Input prepareInput(const Tensor& positions, const Tensor& batch, const Tensor& box_vectors,
+                          bool use_periodic, double cutoff_lower, double cutoff_upper,
+                          int n_batch) {
+    Input in;
+    in.positions = positions.detach().to(torch::kDouble).contiguous();
+    in.pos = in.positions.data_ptr<double>();
+    in.box = nullptr;
+    if (use_periodic) {
+        in.box_vectors = box_vectors.detach().to(torch::kDouble).contiguous();
+        in.box = in.box_vectors.data_ptr<double>();
+    }
+    // Counting sort of the atoms by sample
+    const Tensor batch_ = batch.to(torch::kLong).contiguous();
+    const int64_t* batch_ptr = batch_.data_ptr<int64_t>();
+    const int64_t n_atoms = in.positions.size(0);
+    in.sample_start.assign(n_batch + 1, 0);
+    for (int64_t i = 0; i < n_atoms; i++) {
+        in.sample_start[batch_ptr[i] + 1]++;
+    }
+    std::partial_sum(in.sample_start.begin(), in.sample_start.end(), in.sample_start.begin());
+    std::vector<int64_t> fill(in.sample_start.begin(), in.sample_start.end() - 1);
+    in.atoms.resize(n_atoms);
+    in.sample_of_atom.resize(n_atoms);
+    for (int64_t i = 0; i < n_atoms; i++) {
+        const int64_t k = fill[batch_ptr[i]]++;
+        in.atoms[k] = i;
+        in.sample_of_atom[k] = batch_ptr[i];
+    }
+    in.cutoff_lower = cutoff_lower;
+    in.cutoff_upper = cutoff_upper;
+    in.candidate_lower2 = cutoff_lower * cutoff_lower * (1 - 1e-4);
+    in.candidate_upper2 = cutoff_upper * cutoff_upper * (1 + 1e-4);
+    return in;
+}
+
+/*
+ * @brief Appends the pair (i, j) to pairs if it is (approximately) inside the cutoffs.
+ */
+static inline void testPair(const Input& in, int64_t i, int64_t j, const double* box,
+                            std::vector<int32_t>& pairs) {
+    const double* pi = in.pos + 3 * i;
+    const double* pj = in.pos + 3 * j;
+    double d[3] = {pi[0] - pj[0], pi[1] - pj[1], pi[2] - pj[2]};
+    if (box) {
+        apply_pbc(d, box);
+    }
+    const double distance2 = d[0] * d[0] + d[1] * d[1] + d[2] * d[2];
+    if (distance2 < in.candidate_upper2 && distance2 >= in.candidate_lower2) {
+        pairs.push_back(i);
+        pairs.push_back(j);
+    }
+}
+
+/*
+ * @brief Runs a pair search over a set of rows using all available threads.
+ * The rows are split into contiguous blocks with a similar total cost, several of them per
+ * thread. Each block collects its pairs in its own buffer, so no synchronization is needed, and
+ * the buffers are compacted once at the end. The order of the pairs does not depend on the number
+ * of threads.
+ * @param cost Estimated cost of each row
+ * @param process_row Function called as process_row(row, pairs), appending the pairs of a row to
+ * pairs as consecutive (i, j) values
+ * @param options Options of the returned tensor
+ * @return A tensor of shape (2, num_pairs) with the pairs found, as int32
+ */
+template <class RowFunction>
+static Tensor findPairsInParallel(const std::vector<int64_t>& cost, const RowFunction& process_row,
+                                  const TensorOptions& options) {
+    const int64_t num_rows = cost.size();
+    std::vector<int64_t> cumulative_cost(num_rows + 1, 0);
+    std::partial_sum(cost.begin(), cost.end(), cumulative_cost.begin() + 1);
+    const int64_t num_blocks =
+        std::max<int64_t>(1, std::min<int64_t>(num_rows, 8 * at::get_num_threads()));
+    std::vector<int64_t> block_start(num_blocks + 1, num_rows);
+    for (int64_t b = 0; b < num_blocks; b++) {
+        const int64_t target = cumulative_cost.back() * b / num_blocks;
+        const auto first = std::lower_bound(cumulative_cost.begin(), cumulative_cost.end() - 1,
+                                            target);
+        block_start[b] = first - cumulative_cost.begin();
+    }
+    std::vector<std::vector<int32_t>> block_pairs(num_blocks);
+    at::parallel_for(0, num_blocks, 1, [&](int64_t begin, int64_t end) {
+        for (int64_t b = begin; b < end; b++) {
+            for (int64_t row = block_start[b]; row < block_start[b + 1]; row++) {
+                process_row(row, block_pairs[b]);
+            }
+        }
+    });
+    std::vector<int64_t> offset(num_blocks + 1, 0);
+    for (int64_t b = 0; b < num_blocks; b++) {
+        offset[b + 1] = offset[b] + block_pairs[b].size() / 2;
+    }
+    const int64_t num_pairs = offset.back();
+    Tensor neighbors = torch::empty({2, num_pairs}, options.dtype(torch::kInt32));
+    int32_t* i_ptr = neighbors.data_ptr<int32_t>();
+    int32_t* j_ptr = i_ptr + num_pairs;
+    at::parallel_for(0, num_blocks, 1, [&](int64_t begin, int64_t end) {
+        for (int64_t b = begin; b < end; b++) {
+            const auto& pairs = block_pairs[b];
+            for (size_t p = 0; p < pairs.size() / 2; p++) {
+                i_ptr[offset[b] + p] = pairs[2 * p];
+                j_ptr[offset[b] + p] = pairs[2 * p + 1];
+            }
+        }
+    });
+    return neighbors;
+}
+
+} // namespace cpu
+#endif
@@ -2,14 +2,15 @@
 # Distributed under the MIT License.
 # (See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
 
+import math
 import re
 from typing import Optional, List, Tuple, Dict
 import torch
 from torch.autograd import grad
 from torch import nn, Tensor
 from torchmdnet.models import output_modules
-from torchmdnet.models.wrappers import AtomFilter
-from torchmdnet.models.utils import dtype_mapping
+from torchmdnet.models.wrappers import AtomFilter, BaseWrapper
+from torchmdnet.models.utils import OptimizedDistance, dtype_mapping
 from torchmdnet import priors
 from lightning_utilities.core.rank_zero import rank_zero_warn
 import warnings
@@ -38,6 +39,28 @@ def create_model(args, prior_model=None, mean=None, std=None):
         args["static_shapes"] = False
     if "vector_cutoff" not in args:
         args["vector_cutoff"] = False
+    if "neighbor_skin" not in args:
+        args["neighbor_skin"] = 0.0
+    if "share_neighbors" not in args:
+        args["share_neighbors"] = False
+    if "precomputed_neighbors" not in args:
+        args["precomputed_neighbors"] = False
+    if "fused_message_passing" not in args:
+        args["fused_message_passing"] = False
+    if "compact_representation" not in args:
+        args["compact_representation"] = False
+    if "fused_cfconv" not in args:
+        args["fused_cfconv"] = False
+    if "fused_attention" not in args:
+        args["fused_attention"] = False
+    if "sorted_edges" not in args:
+        args["sorted_edges"] = False
+    if "half_list" not in args:
+        args["half_list"] = False
+    if "checkpoint_layers" not in args:
+        args["checkpoint_layers"] = False
+    if "edge_forces" not in args:
+        args["edge_forces"] = False
 
     shared_args = dict(
         hidden_channels=args["embedding_dimension"],
@@ -56,6 +79,8 @@ def create_model(args, prior_model=None, mean=None, std=None):
             if args["box_vecs"] is not None
             else None
         ),
+        neighbor_skin=float(args["neighbor_skin"]),
+        sorted_edges=bool(args["sorted_edges"]),
         dtype=dtype,
     )
 
@@ -68,6 +93,9 @@ def create_model(args, prior_model=None, mean=None, std=None):
             num_filters=args["embedding_dimension"],
             aggr=args["aggr"],
             neighbor_embedding=args["neighbor_embedding"],
+            fused_cfconv=args["fused_cfconv"],
+            half_list=args["half_list"],
+            checkpoint_layers=args["checkpoint_layers"],
             **shared_args,
         )
     elif args["model"] == "transformer":
@@ -79,6 +107,7 @@ def create_model(args, prior_model=None, mean=None, std=None):
             num_heads=args["num_heads"],
             distance_influence=args["distance_influence"],
             neighbor_embedding=args["neighbor_embedding"],
+            half_list=args["half_list"],
             **shared_args,
         )
     elif args["model"] == "equivariant-transformer":
@@ -91,6 +120,8 @@ def create_model(args, prior_model=None, mean=None, std=None):
             distance_influence=args["distance_influence"],
             neighbor_embedding=args["neighbor_embedding"],
             vector_cutoff=args["vector_cutoff"],
+            fused_attention=args["fused_attention"],
+            checkpoint_layers=args["checkpoint_layers"],
             **shared_args,
         )
     elif args["model"] == "tensornet":
@@ -101,6 +132,10 @@ def create_model(args, prior_model=None, mean=None, std=None):
         representation_model = TensorNet(
             equivariance_invariance_group=args["equivariance_invariance_group"],
             static_shapes=args["static_shapes"],
+            fused_message_passing=args["fused_message_passing"],
+            compact_representation=args["compact_representation"],
+            half_list=args["half_list"],
+            checkpoint_layers=args["checkpoint_layers"],
             **shared_args,
         )
     else:
@@ -135,6 +170,9 @@ def create_model(args, prior_model=None, mean=None, std=None):
         std=std,
         derivative=args["derivative"],
         dtype=dtype,
+        share_neighbors=args["share_neighbors"],
+        precomputed_neighbors=args["precomputed_neighbors"],
+        edge_forces=args["edge_forces"],
     )
     return model
 
@@ -251,6 +289,47 @@ def create_prior_models(args, dataset=None):
     return prior_models
 
 
+def _create_shared_distance(representation_model, prior_model=None):
+    """Creates an OptimizedDistance whose neighbor list covers the ones of the representation model and
+    of all the priors with a finite cutoff.
+    """
+    model = representation_model
+    while isinstance(model, BaseWrapper):
+        model = model.model
+    distances = [model.distance]
+    if prior_model is not None:
+        for prior in prior_model:
+            distance = prior.get_neighbor_distance()
+            if distance is not None and math.isfinite(distance.cutoff_upper):
+                distances.append(distance)
+    max_num_pairs = [d.max_num_pairs for d in distances]
+    if all(m < 0 for m in max_num_pairs):
+        # Negative values are the maximum number of neighbors per atom
+        max_num_pairs = min(max_num_pairs)
+    elif all(m > 0 for m in max_num_pairs):
+        max_num_pairs = max(max_num_pairs)
+    else:
+        raise ValueError(
+            "Cannot share a neighbor list between modules with a maximum number of neighbors per atom "
+            "and modules with a total maximum number of pairs"
+        )
+    representation_distance = distances[0]
+    return OptimizedDistance(
+        cutoff_lower=min(float(d.cutoff_lower) for d in distances),
+        cutoff_upper=max(float(d.cutoff_upper) for d in distances),
+        max_num_pairs=max_num_pairs,
+        return_vecs=True,
+        loop=False,
+        strategy=representation_distance.strategy,
+        include_transpose=True,
+        resize_to_fit=True,
+        check_errors=representation_distance.check_errors,
+        box=representation_distance.box if representation_distance.use_periodic else None,
+        long_edge_index=True,
+        skin=representation_distance.skin,
+    )
+
+
 class TorchMD_Net(nn.Module):
     """The main TorchMD-Net model.
 
@@ -281,6 +360,25 @@ class TorchMD_Net(nn.Module):
         Whether to compute the derivative of the outputs via backpropagation. Defaults to False.
     dtype : torch.dtype, optional
         Data type of the model. Defaults to torch.float32.
+    share_neighbors : bool, optional
+        Whether to compute a single neighbor list, at the largest cutoff required by the representation model
+        and the priors using neighbors (see :meth:`BasePrior.get_neighbor_distance`), instead of one per module.
+        Each module receives the pairs within its own cutoffs. Priors with an infinite cutoff keep computing their
+        own list. The shared list uses the periodic box of the representation model, if any. Defaults to False.
+    precomputed_neighbors : bool, optional
+        Whether the representation model uses the pairs of neighbors passed in `extra_args["neighbor_index"]`, e.g.
+        precomputed by the dataset (see the `neighbor_cutoff` of :class:`torchmdnet.datasets.MemmappedDataset`),
+        instead of searching for them. The pairs must include both directions and cover the cutoff of the model, which
+        keeps the pairs within its cutoffs. Distances are computed from the positions, so that forces can be
+        differentiated through them. Periodic boundary conditions are not supported. When the pairs are not passed,
+        the model searches for them as usual. Defaults to False.
+    edge_forces : bool, optional
+        Whether to compute the forces from the gradient of the output with respect to the vector of each pair of
+        neighbors, scattered into the two atoms of the pair, instead of the gradient with respect to the positions.
+        The neighbor list is computed once here, as with `share_neighbors`, and its vectors are the inputs of the
+        representation model, so the force graph starts at the pairs and does not go through the neighbor search
+        and the periodic images. Contributions of modules using the positions directly, like some priors, are added
+        as usual. The forces are the same. Only used if `derivative` is True. Defaults to False.
 
     """
 
@@ -293,6 +391,9 @@ class TorchMD_Net(nn.Module):
         std=None,
         derivative=False,
         dtype=torch.float32,
+        share_neighbors=False,
+        precomputed_neighbors=False,
+        edge_forces=False,
     ):
         super(TorchMD_Net, self).__init__()
         self.representation_model = representation_model.to(dtype=dtype)
@@ -316,6 +417,14 @@ class TorchMD_Net(nn.Module):
 
         self.derivative = derivative
 
+        self.shared_distance = (
+            _create_shared_distance(self.representation_model, self.prior_model)
+            if share_neighbors or edge_forces
+            else None
+        )
+        self.precomputed_neighbors = precomputed_neighbors
+        self.edge_forces = edge_forces
+
         mean = torch.scalar_tensor(0) if mean is None else mean
         self.register_buffer("mean", mean.to(dtype=dtype))
         std = torch.scalar_tensor(1) if std is None else std
@@ -380,10 +489,49 @@ class TorchMD_Net(nn.Module):
 
         if self.derivative:
             pos.requires_grad_(True)
-        # run the potentially wrapped representation model
-        x, v, z, pos, batch = self.representation_model(
-            z, pos, batch, box=box, q=q, s=s
-        )
+        neighbors: Optional[Tuple[Tensor, Tensor, Tensor]] = None
+        # With edge_forces, the pairs and their vectors, from which the forces are computed
+        pair_index: Optional[Tensor] = None
+        pair_vec: Optional[Tensor] = None
+        if self.shared_distance is not None:
+            edge_index, edge_weight, edge_vec = self.shared_distance(pos, batch, box)
+            assert edge_vec is not None
+            if self.edge_forces and self.derivative:
+                edge_vec = edge_vec.detach().requires_grad_(True)
+                edge_weight = torch.linalg.vector_norm(edge_vec, dim=1)
+                pair_index = edge_index
+                pair_vec = edge_vec
+            neighbors = (edge_index, edge_weight, edge_vec)
+            # The priors receive the neighbor list through extra_args
+            extra_args = {} if extra_args is None else extra_args.copy()
+            extra_args["neighbor_edge_index"] = edge_index
+            extra_args["neighbor_edge_weight"] = edge_weight
+            extra_args["neighbor_edge_vec"] = edge_vec
+        if (
+            self.precomputed_neighbors
+            and extra_args is not None
+            and "neighbor_index" in extra_args
+        ):
+            assert box is None, "Precomputed neighbors do not support periodic boxes"
+            edge_index = extra_args["neighbor_index"].to(torch.long)
+            edge_vec = pos.index_select(0, edge_index[0]) - pos.index_select(
+                0, edge_index[1]
+            )
+            if self.edge_forces and self.derivative:
+                edge_vec = edge_vec.detach().requires_grad_(True)
+                pair_index = edge_index
+                pair_vec = edge_vec
+            edge_weight = torch.linalg.vector_norm(edge_vec, dim=1)
+            neighbors = (edge_index, edge_weight, edge_vec)
+        if neighbors is not None:
+            x, v, z, pos, batch = self.representation_model(
+                z, pos, batch, box=box, q=q, s=s, neighbors=neighbors
+            )
+        else:
+            # run the potentially wrapped representation model
+            x, v, z, pos, batch = self.representation_model(
+                z, pos, batch, box=box, q=q, s=s
+            )
         # apply the output network
         x = self.output_model.pre_reduce(x, v, z, pos, batch)
 
@@ -414,6 +562,23 @@ class TorchMD_Net(nn.Module):
 
         if self.derivative:
             grad_outputs: List[Optional[torch.Tensor]] = [torch.ones_like(y)]
+            if pair_index is not None and pair_vec is not None:
+                dy_pos, dy_vec = grad(
+                    [y],
+                    [pos, pair_vec],
+                    grad_outputs=grad_outputs,
+                    create_graph=self.training,
+                    retain_graph=self.training,
+                    allow_unused=True,
+                )
+                # Each pair vector is pos[i] - pos[j]
+                dy = torch.zeros_like(pos)
+                if dy_vec is not None:
+                    dy = dy.index_add(0, pair_index[0], dy_vec)
+                    dy = dy.index_add(0, pair_index[1], -dy_vec)
+                if dy_pos is not None:
+                    dy = dy + dy_pos
+                return y, -dy
             dy = grad(
                 [y],
                 [pos],
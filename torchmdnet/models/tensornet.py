@@ -3,13 +3,16 @@
 # (See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
 
 import torch
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 from torch import Tensor, nn
+from torch.utils.checkpoint import checkpoint
 from torchmdnet.models.utils import (
     CosineCutoff,
     OptimizedDistance,
     rbf_class_mapping,
     act_class_mapping,
+    segment_scatter,
+    expand_half_list,
 )
 
 __all__ = ["TensorNet"]
@@ -64,6 +67,273 @@ def tensor_norm(tensor):
     return (tensor**2).sum((-2, -1))
 
 
+# Component of the compact form of a tensor to which each of its 9 values belongs: I (1 value), A (3) and S (5)
+_COMPACT_GROUPS = [0, 1, 1, 1, 2, 2, 2, 2, 2]
+# Maximum number of values of the per-edge messages computed at once by the fused message passing
+_FUSED_CHUNK_NUMEL = 2**24
+
+
+def pack_tensor(I, A, S):
+    """Packs the irreducible components of tensors with shape (..., 3, 3) into their 9 independent values.
+
+    The result has shape (..., 9) and holds the scalar of I, the vector of A, and the diagonal (00, 11) and upper
+    triangle (01, 02, 12) of S.
+    """
+    return torch.stack(
+        (
+            I[..., 0, 0],
+            A[..., 2, 1],
+            A[..., 0, 2],
+            A[..., 1, 0],
+            S[..., 0, 0],
+            S[..., 1, 1],
+            S[..., 0, 1],
+            S[..., 0, 2],
+            S[..., 1, 2],
+        ),
+        dim=-1,
+    )
+
+
+def unpack_tensor(compact):
+    """Inverse of :func:`pack_tensor`, returns the full tensors I + A + S with shape (..., 3, 3)."""
+    t, a0, a1, a2, s00, s11, s01, s02, s12 = compact.unbind(-1)
+    rows = (
+        torch.stack((t + s00, s01 - a2, s02 + a1), dim=-1),
+        torch.stack((s01 + a2, t + s11, s12 - a0), dim=-1),
+        torch.stack((s02 - a1, s12 + a0, t - s00 - s11), dim=-1),
+    )
+    return torch.stack(rows, dim=-2)
+
+
+def _dot(a: List[Tensor], b: List[Tensor]) -> Tensor:
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+def _cross(a: List[Tensor], b: List[Tensor]) -> List[Tensor]:
+    return [
+        a[1] * b[2] - a[2] * b[1],
+        a[2] * b[0] - a[0] * b[2],
+        a[0] * b[1] - a[1] * b[0],
+    ]
+
+
+def _sym_rows(s: List[Tensor]) -> List[List[Tensor]]:
+    """Rows of the symmetric traceless matrix given by its 5 packed values."""
+    return [[s[0], s[2], s[3]], [s[2], s[1], s[4]], [s[3], s[4], -s[0] - s[1]]]
+
+
+def _matmul_rows(m1: List[List[Tensor]], m2: List[List[Tensor]]) -> List[List[Tensor]]:
+    rows: List[List[Tensor]] = []
+    for i in range(3):
+        row: List[Tensor] = []
+        for j in range(3):
+            row.append(m1[i][0] * m2[0][j] + m1[i][1] * m2[1][j] + m1[i][2] * m2[2][j])
+        rows.append(row)
+    return rows
+
+
+def _traceless_sym(m: List[List[Tensor]]) -> List[Tensor]:
+    """Packed values of the symmetric traceless part of the matrix with rows m."""
+    trace = (m[0][0] + m[1][1] + m[2][2]) / 3
+    return [
+        m[0][0] - trace,
+        m[1][1] - trace,
+        0.5 * (m[0][1] + m[1][0]),
+        0.5 * (m[0][2] + m[2][0]),
+        0.5 * (m[1][2] + m[2][1]),
+    ]
+
+
+def compact_matmul(x: Tensor, y: Tensor) -> Tensor:
+    """Matrix product of tensors in compact form, computed in closed form on the irreducible components.
+
+    Args:
+        x (Tensor): Packed tensors, with the 9 values of :func:`pack_tensor` along dimension 1.
+        y (Tensor): Packed tensors, with the same shape.
+
+    Returns:
+        Tensor: The packed products x @ y.
+    """
+    xs = x.unbind(1)
+    ys = y.unbind(1)
+    t, a, S = xs[0], [xs[1], xs[2], xs[3]], _sym_rows([xs[4], xs[5], xs[6], xs[7], xs[8]])
+    u, b, R = ys[0], [ys[1], ys[2], ys[3]], _sym_rows([ys[4], ys[5], ys[6], ys[7], ys[8]])
+    SR = _matmul_rows(S, R)
+    axb = _cross(a, b)
+    # (I_x + A_x + S_x)(I_y + A_y + S_y), with A_x A_y = b a^T - (a . b) 1 and the antisymmetric parts of
+    # A_x S_y and S_x A_y given by the vectors -S_y a / 2 and -S_x b / 2
+    values = [t * u + (SR[0][0] + SR[1][1] + SR[2][2] - 2 * _dot(a, b)) / 3]
+    antisym = [SR[2][1] - SR[1][2], SR[0][2] - SR[2][0], SR[1][0] - SR[0][1]]
+    for i in range(3):
+        values.append(
+            t * b[i]
+            + u * a[i]
+            + 0.5 * (axb[i] + antisym[i] - _dot(R[i], a) - _dot(S[i], b))
+        )
+    # Column j of A_x S_y is a x (S_y)_j and row i of S_x A_y is -b x (S_x)_i
+    axr = [_cross(a, R[0]), _cross(a, R[1]), _cross(a, R[2])]
+    m: List[List[Tensor]] = []
+    for i in range(3):
+        bxs = _cross(b, S[i])
+        row: List[Tensor] = []
+        for j in range(3):
+            row.append(b[i] * a[j] + axr[j][i] - bxs[j] + SR[i][j])
+        m.append(row)
+    sym = _traceless_sym(m)
+    for k in range(5):
+        values.append(t * ys[4 + k] + u * xs[4 + k] + sym[k])
+    return torch.stack(values, dim=1)
+
+
+def compact_anticommutator(x: Tensor, y: Tensor) -> Tensor:
+    """The packed x @ y + y @ x of tensors in compact form, see :func:`compact_matmul`."""
+    xs = x.unbind(1)
+    ys = y.unbind(1)
+    t, a, S = xs[0], [xs[1], xs[2], xs[3]], _sym_rows([xs[4], xs[5], xs[6], xs[7], xs[8]])
+    u, b, R = ys[0], [ys[1], ys[2], ys[3]], _sym_rows([ys[4], ys[5], ys[6], ys[7], ys[8]])
+    SR = _matmul_rows(S, R)
+    values = [2 * (t * u + (SR[0][0] + SR[1][1] + SR[2][2] - 2 * _dot(a, b)) / 3)]
+    for i in range(3):
+        values.append(2 * (t * b[i] + u * a[i]) - _dot(R[i], a) - _dot(S[i], b))
+    m: List[List[Tensor]] = []
+    for i in range(3):
+        row: List[Tensor] = []
+        for j in range(3):
+            row.append(a[i] * b[j] + SR[i][j])
+        m.append(row)
+    sym = _traceless_sym(m)
+    for k in range(5):
+        values.append(2 * (t * ys[4 + k] + u * xs[4 + k] + sym[k]))
+    return torch.stack(values, dim=1)
+
+
+def compact_norms(compact: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+    """Squared Frobenius norms of I, A and S of tensors in compact form, with the 9 values along dimension 1."""
+    t, a0, a1, a2, s00, s11, s01, s02, s12 = compact.unbind(1)
+    norm_I = 3 * t**2
+    norm_A = 2 * (a0**2 + a1**2 + a2**2)
+    norm_S = 2 * (s00**2 + s11**2 + s00 * s11 + s01**2 + s02**2 + s12**2)
+    return norm_I, norm_A, norm_S
+
+
+def _compact_scatter(
+    factor: Tensor, values: Tensor, src: Tensor, dst: Tensor, num_nodes: int
+) -> Tensor:
+    """Computes out[dst[e]] += factor[e] * values[src[e]] over edges e, in chunks of edges.
+
+    The factor has shape (num_edges, 3, channels), one value per irreducible component, and the values have shape
+    (num_values, 9, channels).
+    """
+    groups = torch.tensor(_COMPACT_GROUPS, device=factor.device)
+    out = values.new_zeros(num_nodes, 9, values.shape[2])
+    chunk = max(1, _FUSED_CHUNK_NUMEL // (9 * values.shape[2]))
+    for start in range(0, src.shape[0], chunk):
+        msg = factor[start : start + chunk].index_select(1, groups)
+        msg = msg * values.index_select(0, src[start : start + chunk])
+        out.index_add_(0, dst[start : start + chunk], msg)
+    return out
+
+
+def _compact_edge_dot(grad: Tensor, values: Tensor, a: Tensor, b: Tensor) -> Tensor:
+    """Computes out[e, g] = sum of grad[a[e], k] * values[b[e], k] over the values k of component g."""
+    out = grad.new_empty(a.shape[0], 3, grad.shape[2])
+    chunk = max(1, _FUSED_CHUNK_NUMEL // (9 * grad.shape[2]))
+    for start in range(0, a.shape[0], chunk):
+        prod = grad.index_select(0, a[start : start + chunk])
+        prod = prod * values.index_select(0, b[start : start + chunk])
+        out[start : start + chunk, 0] = prod[:, 0]
+        out[start : start + chunk, 1] = prod[:, 1:4].sum(1)
+        out[start : start + chunk, 2] = prod[:, 4:].sum(1)
+    return out
+
+
+class _CompactMessagePassing(torch.autograd.Function):
+    """Autograd function of :func:`_compact_scatter` that keeps no per-edge message for the backward pass.
+
+    The gradients are computed with the same chunked operations, through autograd functions themselves, so that higher
+    order derivatives, as required to train with forces, do not store per-edge messages either.
+    """
+
+    @staticmethod
+    def forward(ctx, factor, values, src, dst, num_nodes):
+        ctx.save_for_backward(factor, values, src, dst)
+        return _compact_scatter(factor, values, src, dst, num_nodes)
+
+    @staticmethod
+    def backward(ctx, grad):
+        factor, values, src, dst = ctx.saved_tensors
+        grad_factor = grad_values = None
+        if ctx.needs_input_grad[0]:
+            grad_factor = _CompactEdgeDot.apply(grad, values, dst, src)
+        if ctx.needs_input_grad[1]:
+            grad_values = _CompactMessagePassing.apply(
+                factor, grad, dst, src, values.shape[0]
+            )
+        return grad_factor, grad_values, None, None, None
+
+
+class _CompactEdgeDot(torch.autograd.Function):
+    """Autograd function of :func:`_compact_edge_dot`, the gradient of the factor of the message passing."""
+
+    @staticmethod
+    def forward(ctx, grad, values, a, b):
+        ctx.save_for_backward(grad, values, a, b)
+        return _compact_edge_dot(grad, values, a, b)
+
+    @staticmethod
+    def backward(ctx, out_grad):
+        grad, values, a, b = ctx.saved_tensors
+        grad_grad = grad_values = None
+        if ctx.needs_input_grad[0]:
+            grad_grad = _CompactMessagePassing.apply(
+                out_grad, values, b, a, grad.shape[0]
+            )
+        if ctx.needs_input_grad[1]:
+            grad_values = _CompactMessagePassing.apply(
+                out_grad, grad, a, b, values.shape[0]
+            )
+        return grad_grad, grad_values, None, None
+
+
+@torch.jit.unused
+def _fused_message_passing(
+    edge_index: Tensor, factor: Tensor, compact: Tensor, natoms: int
+) -> Tensor:
+    return _CompactMessagePassing.apply(
+        factor, compact, edge_index[1], edge_index[0], natoms
+    )
+
+
+def compact_message_passing(
+    edge_index: Tensor, factor: Tensor, compact: Tensor, natoms: int
+) -> Tensor:
+    """Message passing for tensors in compact form.
+
+    Equivalent to :func:`tensor_message_passing` applied to each irreducible component and summed, with the tensors
+    packed by :func:`pack_tensor`. Instead of per-edge 3x3 messages of each component, a single per-edge message of 9
+    values is computed. Outside TorchScript, they are computed in chunks of edges by a custom autograd function, so
+    that they are never stored for the backward pass.
+
+    Args:
+        edge_index (Tensor): Pairs of receiving and sending atoms, with shape (2, num_edges).
+        factor (Tensor): Weight of each irreducible component of each message, with shape (num_edges, 3, channels).
+        compact (Tensor): Packed tensors of the atoms, with shape (natoms, 9, channels).
+        natoms (int): Number of atoms.
+
+    Returns:
+        Tensor: The packed sum of the messages received by each atom, with shape (natoms, 9, channels).
+    """
+    if torch.jit.is_scripting():
+        groups = torch.tensor(_COMPACT_GROUPS, device=factor.device)
+        msg = factor.index_select(1, groups) * compact.index_select(0, edge_index[1])
+        out = torch.zeros(
+            natoms, 9, compact.shape[2], device=compact.device, dtype=compact.dtype
+        )
+        return out.index_add(0, edge_index[0], msg)
+    return _fused_message_passing(edge_index, factor, compact, natoms)
+
+
 class TensorNet(nn.Module):
     r"""TensorNet's architecture. From
     TensorNet: Cartesian Tensor Representations for Efficient Learning of Molecular Potentials; G. Simeon and G. de Fabritiis.
@@ -120,6 +390,35 @@ class TensorNet(nn.Module):
             (default: :obj:`True`)
         check_errors (bool, optional): Whether to check for errors in the distance module.
             (default: :obj:`True`)
+        neighbor_skin (float, optional): If positive, the neighbor list is built with a
+            cutoff of :obj:`cutoff_upper + neighbor_skin` and reused until an atom moves more
+            than half the skin. Only useful when evaluating consecutive MD frames.
+            (default: :obj:`0.0`)
+        fused_message_passing (bool, optional): Whether to compute the messages between atoms in a compact form
+            of the irreducible components, with 9 values per edge and channel instead of a 3x3 tensor for each
+            component, see :func:`compact_message_passing`. This saves most of the memory used by the edges during
+            training. The result is the same up to rounding errors.
+            (default: :obj:`False`)
+        compact_representation (bool, optional): Whether to keep the features of the atoms in compact form, as the
+            9 values of their irreducible components (see :func:`pack_tensor`) instead of 3x3 tensors, throughout the
+            network. Decompositions become slices, the linear layers act on the components without permuting them,
+            and matrix products are computed in closed form. Implies :obj:`fused_message_passing`. The parameters
+            are the same, so a model can be evaluated in either form.
+            (default: :obj:`False`)
+        sorted_edges (bool, optional): Whether to sort the edges by receiving atom and aggregate the messages with
+            deterministic segment reductions, see :func:`torchmdnet.models.utils.segment_scatter`. The fused message
+            passing keeps its own aggregation.
+            (default: :obj:`False`)
+        half_list (bool, optional): Whether to search each pair of neighbors once and compute the radial basis,
+            the distance projections of the embedding and the edge MLPs of the interaction layers once per pair,
+            sharing them between the two directions of the pair, see
+            :func:`torchmdnet.models.utils.expand_half_list`.
+            (default: :obj:`False`)
+        checkpoint_layers (bool, optional): Whether to recompute the activations of each interaction layer in the
+            backward pass instead of storing them, when training. Only the inputs of each layer are kept, which
+            reduces the memory of deep models trained on forces at the cost of one more forward pass of the layers.
+            Supports double backward.
+            (default: :obj:`False`)
     """
 
     def __init__(
@@ -139,6 +438,12 @@ class TensorNet(nn.Module):
         check_errors=True,
         dtype=torch.float32,
         box_vecs=None,
+        neighbor_skin=0.0,
+        fused_message_passing=False,
+        compact_representation=False,
+        sorted_edges=False,
+        half_list=False,
+        checkpoint_layers=False,
     ):
         super(TensorNet, self).__init__()
 
@@ -163,10 +468,17 @@ class TensorNet(nn.Module):
         self.activation = activation
         self.cutoff_lower = cutoff_lower
         self.cutoff_upper = cutoff_upper
+        self.fused_message_passing = fused_message_passing
+        self.compact_representation = compact_representation
+        self.sorted_edges = sorted_edges
+        self.half_list = half_list
+        self.checkpoint_layers = checkpoint_layers
         act_class = act_class_mapping[activation]
         self.distance_expansion = rbf_class_mapping[rbf_type](
             cutoff_lower, cutoff_upper, num_rbf, trainable_rbf
         )
+        # The cutoff is computed once per forward and shared by the embedding and all the layers
+        self.cutoff = CosineCutoff(cutoff_lower, cutoff_upper)
         self.tensor_embedding = TensorEmbedding(
             hidden_channels,
             num_rbf,
@@ -176,6 +488,9 @@ class TensorNet(nn.Module):
             trainable_rbf,
             max_z,
             dtype,
+            fused_message_passing,
+            compact_representation,
+            sorted_edges,
         )
 
         self.layers = nn.ModuleList()
@@ -190,6 +505,9 @@ class TensorNet(nn.Module):
                         cutoff_upper,
                         equivariance_invariance_group,
                         dtype,
+                        fused_message_passing,
+                        compact_representation,
+                        sorted_edges,
                     )
                 )
         self.linear = nn.Linear(3 * hidden_channels, hidden_channels, dtype=dtype)
@@ -198,17 +516,22 @@ class TensorNet(nn.Module):
         # Resize to fit set to false ensures Distance returns a statically-shaped tensor of size max_num_pairs=pos.size*max_num_neigbors
         # negative max_num_pairs argument means "per particle"
         # long_edge_index set to False saves memory and spares some kernel launches by keeping neighbor indices as int32.
+        # A half list with loops holds at most (max_num_neighbors + 1) / 2 pairs per atom when the full list fits,
+        # so that the full list of the static shapes keeps the same size.
         self.static_shapes = static_shapes
         self.distance = OptimizedDistance(
             cutoff_lower,
             cutoff_upper,
-            max_num_pairs=-max_num_neighbors,
+            max_num_pairs=-max_num_neighbors if not half_list else -((max_num_neighbors + 2) // 2),
             return_vecs=True,
             loop=True,
             check_errors=check_errors,
             resize_to_fit=not self.static_shapes,
             box=box_vecs,
             long_edge_index=True,
+            skin=neighbor_skin,
+            include_transpose=not half_list,
+            sort_edges=sorted_edges and not half_list,
         )
 
         self.reset_parameters()
@@ -228,9 +551,10 @@ class TensorNet(nn.Module):
         box: Optional[Tensor] = None,
         q: Optional[Tensor] = None,
         s: Optional[Tensor] = None,
+        neighbors: Optional[Tuple[Tensor, Tensor, Tensor]] = None,
     ) -> Tuple[Tensor, Optional[Tensor], Tensor, Tensor, Tensor]:
         # Obtain graph, with distances and relative position vectors
-        edge_index, edge_weight, edge_vec = self.distance(pos, batch, box)
+        edge_index, edge_weight, edge_vec = self.distance(pos, batch, box, neighbors)
         # This assert convinces TorchScript that edge_vec is a Tensor and not an Optional[Tensor]
         assert (
             edge_vec is not None
@@ -254,15 +578,35 @@ class TensorNet(nn.Module):
                 mask[0].unsqueeze(-1).expand_as(edge_vec), 0
             )
         edge_attr = self.distance_expansion(edge_weight)
+        edge_cutoff = self.cutoff(edge_weight)
         mask = edge_index[0] == edge_index[1]
         # Normalizing edge vectors by their length can result in NaNs, breaking Autograd.
         # I avoid dividing by zero by setting the weight of self edges and self loops to 1
         edge_vec = edge_vec / edge_weight.masked_fill(mask, 1).unsqueeze(1)
-        X = self.tensor_embedding(zp, edge_index, edge_weight, edge_vec, edge_attr)
-        for layer in self.layers:
-            X = layer(X, edge_index, edge_weight, edge_attr, q)
-        I, A, S = decompose_tensor(X)
-        x = torch.cat((tensor_norm(I), tensor_norm(A), tensor_norm(S)), dim=-1)
+        edge_pair: Optional[Tensor] = None
+        if self.half_list:
+            # The transposed self loops of the static shapes go to the extra atom
+            edge_index, pair, sign = expand_half_list(
+                edge_index, z.shape[0], self.static_shapes, self.sorted_edges
+            )
+            edge_vec = edge_vec.index_select(0, pair) * sign.unsqueeze(1)
+            edge_pair = pair
+        X = self.tensor_embedding(
+            zp, edge_index, edge_weight, edge_vec, edge_attr, edge_pair, edge_cutoff
+        )
+        for i, layer in enumerate(self.layers):
+            if self.checkpoint_layers and self.training and not torch.jit.is_scripting():
+                X = self._checkpointed_layer(
+                    i, X, edge_index, edge_weight, edge_attr, q, edge_pair, edge_cutoff
+                )
+            else:
+                X = layer(X, edge_index, edge_weight, edge_attr, q, edge_pair, edge_cutoff)
+        if self.compact_representation:
+            norm_I, norm_A, norm_S = compact_norms(X)
+            x = torch.cat((norm_I, norm_A, norm_S), dim=-1)
+        else:
+            I, A, S = decompose_tensor(X)
+            x = torch.cat((tensor_norm(I), tensor_norm(A), tensor_norm(S)), dim=-1)
         x = self.out_norm(x)
         x = self.act(self.linear((x)))
         # # Remove the extra atom
@@ -270,6 +614,31 @@ class TensorNet(nn.Module):
             x = x[:-1]
         return x, None, z, pos, batch
 
+    @torch.jit.unused
+    def _checkpointed_layer(
+        self,
+        i: int,
+        X: Tensor,
+        edge_index: Tensor,
+        edge_weight: Tensor,
+        edge_attr: Tensor,
+        q: Tensor,
+        edge_pair: Optional[Tensor],
+        edge_cutoff: Tensor,
+    ) -> Tensor:
+        # The non-reentrant checkpoint supports torch.autograd.grad and double backward
+        return checkpoint(
+            self.layers[i],
+            X,
+            edge_index,
+            edge_weight,
+            edge_attr,
+            q,
+            edge_pair,
+            edge_cutoff,
+            use_reentrant=False,
+        )
+
 
 class TensorEmbedding(nn.Module):
     """Tensor embedding layer.
@@ -287,8 +656,14 @@ class TensorEmbedding(nn.Module):
         trainable_rbf=False,
         max_z=128,
         dtype=torch.float32,
+        fused_message_passing=False,
+        compact_representation=False,
+        sorted_edges=False,
     ):
         super(TensorEmbedding, self).__init__()
+        self.fused_message_passing = fused_message_passing
+        self.compact_representation = compact_representation
+        self.sorted_edges = sorted_edges
 
         self.hidden_channels = hidden_channels
         self.distance_proj1 = nn.Linear(num_rbf, hidden_channels, dtype=dtype)
@@ -335,26 +710,77 @@ class TensorEmbedding(nn.Module):
         )[..., None, None]
         return Zij
 
+    def _get_distance_weights(
+        self,
+        edge_weight: Tensor,
+        edge_attr: Tensor,
+        edge_pair: Optional[Tensor],
+        edge_cutoff: Optional[Tensor],
+    ) -> Tensor:
+        """Weights of the I, A and S messages of each edge, with shape (num_edges, 3, hidden_channels).
+
+        If edge_pair is given, edge_weight and edge_attr belong to a half neighbor list and the weights are
+        computed once per pair, see :func:`torchmdnet.models.utils.expand_half_list`.
+        """
+        if edge_cutoff is None:
+            edge_cutoff = self.cutoff(edge_weight)
+        C = edge_cutoff.reshape(-1, 1, 1)
+        W = torch.stack(
+            (
+                self.distance_proj1(edge_attr),
+                self.distance_proj2(edge_attr),
+                self.distance_proj3(edge_attr),
+            ),
+            dim=1,
+        ) * C
+        if edge_pair is not None:
+            W = W.index_select(0, edge_pair)
+        return W
+
     def _get_tensor_messages(
-        self, Zij: Tensor, edge_weight: Tensor, edge_vec_norm: Tensor, edge_attr: Tensor
+        self, Zij: Tensor, W: Tensor, edge_vec_norm: Tensor
     ) -> Tuple[Tensor, Tensor, Tensor]:
-        C = self.cutoff(edge_weight).reshape(-1, 1, 1, 1) * Zij
         eye = torch.eye(3, 3, device=edge_vec_norm.device, dtype=edge_vec_norm.dtype)[
             None, None, ...
         ]
-        Iij = self.distance_proj1(edge_attr)[..., None, None] * C * eye
+        Iij = W[:, 0, :, None, None] * Zij * eye
         Aij = (
-            self.distance_proj2(edge_attr)[..., None, None]
-            * C
+            W[:, 1, :, None, None]
+            * Zij
             * vector_to_skewtensor(edge_vec_norm)[..., None, :, :]
         )
         Sij = (
-            self.distance_proj3(edge_attr)[..., None, None]
-            * C
+            W[:, 2, :, None, None]
+            * Zij
             * vector_to_symtensor(edge_vec_norm)[..., None, :, :]
         )
         return Iij, Aij, Sij
 
+    def _get_compact_messages(
+        self, z: Tensor, edge_index: Tensor, W: Tensor, edge_vec_norm: Tensor
+    ) -> Tensor:
+        """Sums the messages of :meth:`_get_tensor_messages` received by each atom, in compact form.
+
+        The messages are the product of a weight per edge, channel and component and a tensor per edge, so they are
+        computed with 9 values per edge and channel instead of three 3x3 tensors.
+        """
+        Zij = self._get_atomic_number_message(z, edge_index)[..., 0, 0]
+        factor = W * Zij.unsqueeze(1)
+        eye = torch.eye(3, 3, device=edge_vec_norm.device, dtype=edge_vec_norm.dtype)
+        basis = pack_tensor(
+            eye.expand(edge_vec_norm.shape[0], 3, 3),
+            vector_to_skewtensor(edge_vec_norm).view(-1, 3, 3),
+            vector_to_symtensor(edge_vec_norm),
+        )
+        groups = torch.tensor(_COMPACT_GROUPS, device=z.device)
+        msg = factor.index_select(1, groups) * basis.unsqueeze(-1)
+        compact = torch.zeros(
+            z.shape[0], 9, self.hidden_channels, device=z.device, dtype=msg.dtype
+        )
+        if self.sorted_edges:
+            return segment_scatter(msg, edge_index[0], z.shape[0])
+        return compact.index_add(0, edge_index[0], msg)
+
     def forward(
         self,
         z: Tensor,
@@ -362,17 +788,44 @@ class TensorEmbedding(nn.Module):
         edge_weight: Tensor,
         edge_vec_norm: Tensor,
         edge_attr: Tensor,
+        edge_pair: Optional[Tensor] = None,
+        edge_cutoff: Optional[Tensor] = None,
     ) -> Tensor:
-        Zij = self._get_atomic_number_message(z, edge_index)
-        Iij, Aij, Sij = self._get_tensor_messages(
-            Zij, edge_weight, edge_vec_norm, edge_attr
-        )
-        source = torch.zeros(
-            z.shape[0], self.hidden_channels, 3, 3, device=z.device, dtype=Iij.dtype
-        )
-        I = source.index_add(dim=0, index=edge_index[0], source=Iij)
-        A = source.index_add(dim=0, index=edge_index[0], source=Aij)
-        S = source.index_add(dim=0, index=edge_index[0], source=Sij)
+        """edge_cutoff is the cutoff function of edge_weight, if already computed."""
+        W = self._get_distance_weights(edge_weight, edge_attr, edge_pair, edge_cutoff)
+        if self.compact_representation:
+            X = self._get_compact_messages(z, edge_index, W, edge_vec_norm)
+            norm_I, norm_A, norm_S = compact_norms(X)
+            norm = self.init_norm(norm_I + norm_A + norm_S)
+            for linear_scalar in self.linears_scalar:
+                norm = self.act(linear_scalar(norm))
+            norm = norm.reshape(-1, self.hidden_channels, 3)
+            I = self.linears_tensor[0](X[:, :1]) * norm[:, None, :, 0]
+            A = self.linears_tensor[1](X[:, 1:4]) * norm[:, None, :, 1]
+            S = self.linears_tensor[2](X[:, 4:]) * norm[:, None, :, 2]
+            return torch.cat((I, A, S), dim=1)
+        if self.fused_message_passing:
+            compact = self._get_compact_messages(
+                z, edge_index, W, edge_vec_norm
+            ).transpose(1, 2)
+            groups = torch.tensor(_COMPACT_GROUPS, device=z.device)
+            I = unpack_tensor(compact * (groups == 0))
+            A = unpack_tensor(compact * (groups == 1))
+            S = unpack_tensor(compact * (groups == 2))
+        else:
+            Zij = self._get_atomic_number_message(z, edge_index)
+            Iij, Aij, Sij = self._get_tensor_messages(Zij, W, edge_vec_norm)
+            if self.sorted_edges:
+                I = segment_scatter(Iij, edge_index[0], z.shape[0])
+                A = segment_scatter(Aij, edge_index[0], z.shape[0])
+                S = segment_scatter(Sij, edge_index[0], z.shape[0])
+            else:
+                source = torch.zeros(
+                    z.shape[0], self.hidden_channels, 3, 3, device=z.device, dtype=Iij.dtype
+                )
+                I = source.index_add(dim=0, index=edge_index[0], source=Iij)
+                A = source.index_add(dim=0, index=edge_index[0], source=Aij)
+                S = source.index_add(dim=0, index=edge_index[0], source=Sij)
         norm = self.init_norm(tensor_norm(I + A + S))
         for linear_scalar in self.linears_scalar:
             norm = self.act(linear_scalar(norm))
@@ -394,10 +847,16 @@ class TensorEmbedding(nn.Module):
 
 
 def tensor_message_passing(
-    edge_index: Tensor, factor: Tensor, tensor: Tensor, natoms: int
+    edge_index: Tensor,
+    factor: Tensor,
+    tensor: Tensor,
+    natoms: int,
+    sorted_edges: bool = False,
 ) -> Tensor:
-    """Message passing for tensors."""
+    """Message passing for tensors. If sorted_edges, the edges must be sorted by edge_index[0]."""
     msg = factor * tensor.index_select(0, edge_index[1])
+    if sorted_edges:
+        return segment_scatter(msg, edge_index[0], natoms)
     shape = (natoms, tensor.shape[1], tensor.shape[2], tensor.shape[3])
     tensor_m = torch.zeros(*shape, device=tensor.device, dtype=tensor.dtype)
     tensor_m = tensor_m.index_add(0, edge_index[0], msg)
@@ -419,8 +878,14 @@ class Interaction(nn.Module):
         cutoff_upper,
         equivariance_invariance_group,
         dtype=torch.float32,
+        fused_message_passing=False,
+        compact_representation=False,
+        sorted_edges=False,
     ):
         super(Interaction, self).__init__()
+        self.fused_message_passing = fused_message_passing
+        self.compact_representation = compact_representation
+        self.sorted_edges = sorted_edges
 
         self.num_rbf = num_rbf
         self.hidden_channels = hidden_channels
@@ -450,6 +915,40 @@ class Interaction(nn.Module):
         for linear in self.linears_tensor:
             linear.reset_parameters()
 
+    def _compact_forward(
+        self, X: Tensor, edge_index: Tensor, edge_attr: Tensor, q: Tensor
+    ) -> Tensor:
+        """Same as :meth:`forward` for features in compact form, with shape (natoms, 9, hidden_channels)."""
+        norm_I, norm_A, norm_S = compact_norms(X)
+        X = X / (norm_I + norm_A + norm_S + 1).unsqueeze(1)
+        Y = torch.cat(
+            (
+                self.linears_tensor[0](X[:, :1]),
+                self.linears_tensor[1](X[:, 1:4]),
+                self.linears_tensor[2](X[:, 4:]),
+            ),
+            dim=1,
+        )
+        msg = compact_message_passing(
+            edge_index, edge_attr.transpose(1, 2), Y, X.shape[0]
+        )
+        Z = Y
+        if self.equivariance_invariance_group == "O(3)":
+            Z = (1 + 0.1 * q[..., None, None]) * compact_anticommutator(msg, Y)
+        if self.equivariance_invariance_group == "SO(3)":
+            Z = 2 * compact_matmul(Y, msg)
+        norm_I, norm_A, norm_S = compact_norms(Z)
+        Z = Z / (norm_I + norm_A + norm_S + 1).unsqueeze(1)
+        dX = torch.cat(
+            (
+                self.linears_tensor[3](Z[:, :1]),
+                self.linears_tensor[4](Z[:, 1:4]),
+                self.linears_tensor[5](Z[:, 4:]),
+            ),
+            dim=1,
+        )
+        return X + dX + (1 + 0.1 * q[..., None, None]) * compact_matmul(dX, dX)
+
     def forward(
         self,
         X: Tensor,
@@ -457,29 +956,47 @@ class Interaction(nn.Module):
         edge_weight: Tensor,
         edge_attr: Tensor,
         q: Tensor,
+        edge_pair: Optional[Tensor] = None,
+        edge_cutoff: Optional[Tensor] = None,
     ) -> Tensor:
-        C = self.cutoff(edge_weight)
+        """If edge_pair is given, edge_weight and edge_attr belong to a half neighbor list and edge_pair is the
+        pair of each edge, see :func:`torchmdnet.models.utils.expand_half_list`. edge_cutoff is the cutoff
+        function of edge_weight, if already computed."""
+        if edge_cutoff is None:
+            edge_cutoff = self.cutoff(edge_weight)
+        C = edge_cutoff
         for linear_scalar in self.linears_scalar:
             edge_attr = self.act(linear_scalar(edge_attr))
         edge_attr = (edge_attr * C.view(-1, 1)).reshape(
             edge_attr.shape[0], self.hidden_channels, 3
         )
+        if edge_pair is not None:
+            edge_attr = edge_attr.index_select(0, edge_pair)
+        if self.compact_representation:
+            return self._compact_forward(X, edge_index, edge_attr, q)
         X = X / (tensor_norm(X) + 1)[..., None, None]
         I, A, S = decompose_tensor(X)
         I = self.linears_tensor[0](I.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
         A = self.linears_tensor[1](A.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
         S = self.linears_tensor[2](S.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
         Y = I + A + S
-        Im = tensor_message_passing(
-            edge_index, edge_attr[..., 0, None, None], I, X.shape[0]
-        )
-        Am = tensor_message_passing(
-            edge_index, edge_attr[..., 1, None, None], A, X.shape[0]
-        )
-        Sm = tensor_message_passing(
-            edge_index, edge_attr[..., 2, None, None], S, X.shape[0]
-        )
-        msg = Im + Am + Sm
+        if self.fused_message_passing:
+            compact = pack_tensor(I, A, S).transpose(1, 2)
+            msg = compact_message_passing(
+                edge_index, edge_attr.transpose(1, 2), compact, X.shape[0]
+            )
+            msg = unpack_tensor(msg.transpose(1, 2))
+        else:
+            Im = tensor_message_passing(
+                edge_index, edge_attr[..., 0, None, None], I, X.shape[0], self.sorted_edges
+            )
+            Am = tensor_message_passing(
+                edge_index, edge_attr[..., 1, None, None], A, X.shape[0], self.sorted_edges
+            )
+            Sm = tensor_message_passing(
+                edge_index, edge_attr[..., 2, None, None], S, X.shape[0], self.sorted_edges
+            )
+            msg = Im + Am + Sm
         if self.equivariance_invariance_group == "O(3)":
             A = torch.matmul(msg, Y)
             B = torch.matmul(Y, msg)
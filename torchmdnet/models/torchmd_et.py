@@ -5,6 +5,7 @@
 from typing import Optional, Tuple
 import torch
 from torch import Tensor, nn
+from torch.utils.checkpoint import checkpoint
 from torchmdnet.models.utils import (
     NeighborEmbedding,
     CosineCutoff,
@@ -12,6 +13,7 @@ from torchmdnet.models.utils import (
     rbf_class_mapping,
     act_class_mapping,
     scatter,
+    segment_scatter,
 )
 from torchmdnet.utils import deprecated_class
 
@@ -79,6 +81,24 @@ class TorchMD_ET(nn.Module):
             (default: :obj:`False`)
         check_errors (bool, optional): Whether to check for errors in the distance module.
             (default: :obj:`True`)
+        neighbor_skin (float, optional): If positive, the neighbor list is built with a
+            cutoff of :obj:`cutoff_upper + neighbor_skin` and reused until an atom moves more
+            than half the skin. Only useful when evaluating consecutive MD frames.
+            (default: :obj:`0.0`)
+        fused_attention (bool, optional): Whether to compute the attention messages with
+            :class:`FusedEquivariantAttention`, which sums them into the atoms chunk by chunk and
+            never stores the per-edge messages. Saves most of the memory used by the edges at the
+            cost of computing the messages again in the backward pass.
+            (default: :obj:`False`)
+        sorted_edges (bool, optional): Whether to sort the edges by receiving atom and
+            aggregate the messages with deterministic segment reductions, see
+            :func:`torchmdnet.models.utils.segment_scatter`.
+            (default: :obj:`False`)
+        checkpoint_layers (bool, optional): Whether to recompute the activations of each attention layer in
+            the backward pass instead of storing them, when training. Only the inputs of each attention layer
+            are kept, which reduces the memory of deep models trained on forces at the cost of one
+            more forward pass of the attention layers. Supports double backward.
+            (default: :obj:`False`)
 
     """
 
@@ -102,6 +122,10 @@ class TorchMD_ET(nn.Module):
         box_vecs=None,
         vector_cutoff=False,
         dtype=torch.float32,
+        neighbor_skin=0.0,
+        fused_attention=False,
+        sorted_edges=False,
+        checkpoint_layers=False,
     ):
         super(TorchMD_ET, self).__init__()
 
@@ -133,6 +157,8 @@ class TorchMD_ET(nn.Module):
         self.cutoff_upper = cutoff_upper
         self.max_z = max_z
         self.dtype = dtype
+        self.sorted_edges = sorted_edges
+        self.checkpoint_layers = checkpoint_layers
 
         act_class = act_class_mapping[activation]
 
@@ -147,13 +173,21 @@ class TorchMD_ET(nn.Module):
             box=box_vecs,
             long_edge_index=True,
             check_errors=check_errors,
+            skin=neighbor_skin,
+            sort_edges=sorted_edges,
         )
         self.distance_expansion = rbf_class_mapping[rbf_type](
             cutoff_lower, cutoff_upper, num_rbf, trainable_rbf
         )
         self.neighbor_embedding = (
             NeighborEmbedding(
-                hidden_channels, num_rbf, cutoff_lower, cutoff_upper, self.max_z, dtype
+                hidden_channels,
+                num_rbf,
+                cutoff_lower,
+                cutoff_upper,
+                self.max_z,
+                dtype,
+                sorted_edges=sorted_edges,
             )
             if neighbor_embedding
             else None
@@ -172,6 +206,8 @@ class TorchMD_ET(nn.Module):
                 cutoff_upper,
                 vector_cutoff,
                 dtype,
+                fused_attention,
+                sorted_edges,
             )
             self.attention_layers.append(layer)
 
@@ -196,10 +232,11 @@ class TorchMD_ET(nn.Module):
         box: Optional[Tensor] = None,
         q: Optional[Tensor] = None,
         s: Optional[Tensor] = None,
+        neighbors: Optional[Tuple[Tensor, Tensor, Tensor]] = None,
     ) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor]:
         x = self.embedding(z)
 
-        edge_index, edge_weight, edge_vec = self.distance(pos, batch, box)
+        edge_index, edge_weight, edge_vec = self.distance(pos, batch, box, neighbors)
         # This assert must be here to convince TorchScript that edge_vec is not None
         # If you remove it TorchScript will complain down below that you cannot use an Optional[Tensor]
         assert (
@@ -213,16 +250,51 @@ class TorchMD_ET(nn.Module):
         if self.neighbor_embedding is not None:
             x = self.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr)
 
+        if self.sorted_edges:
+            # The attention layers aggregate into the second atom of each pair. The list holds
+            # both directions of each pair, so swapping the atoms of every pair gives the same
+            # list sorted by the second atom.
+            edge_index = edge_index.flip(0)
+            edge_vec = -edge_vec
+
         vec = torch.zeros(x.size(0), 3, x.size(1), device=x.device, dtype=x.dtype)
 
-        for attn in self.attention_layers:
-            dx, dvec = attn(x, vec, edge_index, edge_weight, edge_attr, edge_vec)
+        for i, attn in enumerate(self.attention_layers):
+            if self.checkpoint_layers and self.training and not torch.jit.is_scripting():
+                dx, dvec = self._checkpointed_attention(
+                    i, x, vec, edge_index, edge_weight, edge_attr, edge_vec
+                )
+            else:
+                dx, dvec = attn(x, vec, edge_index, edge_weight, edge_attr, edge_vec)
             x = x + dx
             vec = vec + dvec
         x = self.out_norm(x)
 
         return x, vec, z, pos, batch
 
+    @torch.jit.unused
+    def _checkpointed_attention(
+        self,
+        i: int,
+        x: Tensor,
+        vec: Tensor,
+        edge_index: Tensor,
+        edge_weight: Tensor,
+        edge_attr: Tensor,
+        edge_vec: Tensor,
+    ) -> Tuple[Tensor, Tensor]:
+        # The non-reentrant checkpoint supports torch.autograd.grad and double backward
+        return checkpoint(
+            self.attention_layers[i],
+            x,
+            vec,
+            edge_index,
+            edge_weight,
+            edge_attr,
+            edge_vec,
+            use_reentrant=False,
+        )
+
     def __repr__(self):
         return (
             f"{self.__class__.__name__}("
@@ -260,6 +332,8 @@ class EquivariantMultiHeadAttention(nn.Module):
         cutoff_upper,
         vector_cutoff=False,
         dtype=torch.float32,
+        fused=False,
+        sorted_edges=False,
     ):
         super(EquivariantMultiHeadAttention, self).__init__()
         assert hidden_channels % num_heads == 0, (
@@ -294,6 +368,8 @@ class EquivariantMultiHeadAttention(nn.Module):
         if distance_influence in ["values", "both"]:
             self.dv_proj = nn.Linear(num_rbf, hidden_channels * 3, dtype=dtype)
         self.vector_cutoff = vector_cutoff
+        self.fused = fused
+        self.sorted_edges = sorted_edges
 
         self.reset_parameters()
 
@@ -335,18 +411,21 @@ class EquivariantMultiHeadAttention(nn.Module):
             if self.dv_proj is not None
             else None
         )
-        x, vec = self.propagate(
-            edge_index,
-            q=q,
-            k=k,
-            v=v,
-            vec=vec,
-            dk=dk,
-            dv=dv,
-            r_ij=r_ij,
-            d_ij=d_ij,
-            dim_size=None,
-        )
+        if self.fused and not torch.jit.is_scripting():
+            x, vec = self._fused_propagate(edge_index, q, k, v, vec, dk, dv, r_ij, d_ij)
+        else:
+            x, vec = self.propagate(
+                edge_index,
+                q=q,
+                k=k,
+                v=v,
+                vec=vec,
+                dk=dk,
+                dv=dv,
+                r_ij=r_ij,
+                d_ij=d_ij,
+                dim_size=None,
+            )
         x = x.reshape(-1, self.hidden_channels)
         vec = vec.reshape(-1, 3, self.hidden_channels)
 
@@ -355,6 +434,34 @@ class EquivariantMultiHeadAttention(nn.Module):
         dvec = vec3 * o1.unsqueeze(1) + vec
         return dx, dvec
 
+    @torch.jit.unused
+    def _fused_propagate(
+        self,
+        edge_index: Tensor,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        vec: Tensor,
+        dk: Optional[Tensor],
+        dv: Optional[Tensor],
+        r_ij: Tensor,
+        d_ij: Tensor,
+    ) -> Tuple[Tensor, Tensor]:
+        return FusedEquivariantAttention.apply(
+            self,
+            q,
+            k,
+            v,
+            vec,
+            dk,
+            dv,
+            self.cutoff(r_ij),
+            d_ij,
+            edge_index[0],
+            edge_index[1],
+            q.shape[0],
+        )
+
     def propagate(
         self,
         edge_index: Tensor,
@@ -424,11 +531,187 @@ class EquivariantMultiHeadAttention(nn.Module):
         dim_size: Optional[int],
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         x, vec = features
-        x = scatter(x, index, dim=0, dim_size=dim_size)
-        vec = scatter(vec, index, dim=0, dim_size=dim_size)
+        if self.sorted_edges:
+            if dim_size is None:
+                dim_size = int(index.max()) + 1 if index.numel() > 0 else 0
+            x = segment_scatter(x, index, dim_size)
+            vec = segment_scatter(vec, index, dim_size)
+        else:
+            x = scatter(x, index, dim=0, dim_size=dim_size)
+            vec = scatter(vec, index, dim=0, dim_size=dim_size)
         return x, vec
 
     def update(
         self, inputs: Tuple[torch.Tensor, torch.Tensor]
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         return inputs
+
+
+# Maximum number of values of the per-edge vector messages computed at once by FusedEquivariantAttention
+_FUSED_CHUNK_NUMEL = 2**24
+
+
+def _activation_grad(act, x: Tensor, grad: Tensor, create_graph: bool) -> Tensor:
+    """Gradient of act(x) with respect to x, multiplied by grad."""
+    with torch.enable_grad():
+        if not (create_graph and x.requires_grad):
+            x = x.detach().requires_grad_()
+        return torch.autograd.grad(act(x), x, grad, create_graph=create_graph)[0]
+
+
+class FusedEquivariantAttention(torch.autograd.Function):
+    """Message passing of :class:`EquivariantMultiHeadAttention` in a single operation.
+
+    The attention, the weighting of the values and the vector update are computed for chunks of edges and summed
+    into the atoms right away, so the per-edge messages, in particular the vector messages with shape
+    (num_edges, 3, num_heads, head_dim), are never stored for the backward pass. The backward pass is written
+    explicitly, recomputing the messages chunk by chunk, and is itself differentiable so that it also serves to
+    train with forces.
+
+    :meta private:
+    """
+
+    @staticmethod
+    def _chunks(num_edges, channels):
+        chunk = max(1, _FUSED_CHUNK_NUMEL // (3 * channels))
+        return [(start, min(start + chunk, num_edges)) for start in range(0, num_edges, chunk)]
+
+    @staticmethod
+    def _messages(layer, q, k, v, dk, dv, cutoff, src, dst):
+        """Gathered queries and keys, attention before activation and values of a chunk of edges."""
+        q_i = q.index_select(0, dst)
+        k_j = k.index_select(0, src)
+        attn = q_i * k_j if dk is None else q_i * k_j * dk
+        attn = attn.sum(dim=-1)
+        v_j = v.index_select(0, src)
+        if layer.vector_cutoff:
+            v_j = v_j * cutoff[:, None, None]
+        if dv is not None:
+            v_j = v_j * dv
+        return q_i, k_j, attn, v_j
+
+    @staticmethod
+    def forward(ctx, layer, q, k, v, vec, dk, dv, cutoff, d_ij, src, dst, n_atoms):
+        H, D = q.shape[1], q.shape[2]
+        x = q.new_zeros(n_atoms, H, D)
+        vec_out = vec.new_zeros(n_atoms, 3, H, D)
+        for start, end in FusedEquivariantAttention._chunks(src.shape[0], H * D):
+            c = cutoff[start:end]
+            _, _, attn, v_j = FusedEquivariantAttention._messages(
+                layer,
+                q,
+                k,
+                v,
+                None if dk is None else dk[start:end],
+                None if dv is None else dv[start:end],
+                c,
+                src[start:end],
+                dst[start:end],
+            )
+            attn = layer.attn_activation(attn)
+            if not layer.vector_cutoff:
+                attn = attn * c.unsqueeze(1)
+            xv, v1, v2 = torch.split(v_j, D, dim=2)
+            x.index_add_(0, dst[start:end], xv * attn.unsqueeze(2))
+            vec_j = vec.index_select(0, src[start:end])
+            msg = vec_j * v1.unsqueeze(1) + v2.unsqueeze(1) * d_ij[start:end, :, None, None]
+            vec_out.index_add_(0, dst[start:end], msg)
+        ctx.layer = layer
+        ctx.n_atoms = n_atoms
+        ctx.save_for_backward(q, k, v, vec, dk, dv, cutoff, d_ij, src, dst)
+        return x, vec_out
+
+    @staticmethod
+    def backward(ctx, grad_x, grad_vec):
+        q, k, v, vec, dk, dv, cutoff, d_ij, src, dst = ctx.saved_tensors
+        layer = ctx.layer
+        H, D = q.shape[1], q.shape[2]
+        # Only true when the gradients have to be differentiable themselves
+        create_graph = torch.is_grad_enabled()
+        need = ctx.needs_input_grad
+        grad_q = torch.zeros_like(q) if need[1] else None
+        grad_k = torch.zeros_like(k) if need[2] else None
+        grad_v = torch.zeros_like(v) if need[3] else None
+        grad_vec_in = torch.zeros_like(vec) if need[4] else None
+        grad_dk, grad_dv, grad_cutoff, grad_d = [], [], [], []
+        for start, end in FusedEquivariantAttention._chunks(src.shape[0], H * D):
+            s, d = src[start:end], dst[start:end]
+            c = cutoff[start:end]
+            dk_e = None if dk is None else dk[start:end]
+            dv_e = None if dv is None else dv[start:end]
+            d_e = d_ij[start:end]
+            q_i, k_j, pre_attn, v_j = FusedEquivariantAttention._messages(
+                layer, q, k, v, dk_e, dv_e, c, s, d
+            )
+            attn = layer.attn_activation(pre_attn)
+            weight = attn if layer.vector_cutoff else attn * c.unsqueeze(1)
+            xv, v1, v2 = torch.split(v_j, D, dim=2)
+            vec_j = vec.index_select(0, s)
+            gx = grad_x.index_select(0, d)
+            gvec = grad_vec.index_select(0, d)
+
+            # Scalar messages xv * weight and vector messages vec_j * v1 + v2 * d_ij
+            grad_weight = (gx * xv).sum(dim=-1)
+            grad_vj = torch.cat(
+                (
+                    gx * weight.unsqueeze(2),
+                    (gvec * vec_j).sum(dim=1),
+                    (gvec * d_e[:, :, None, None]).sum(dim=1),
+                ),
+                dim=2,
+            )
+            if need[4]:
+                grad_vec_in = grad_vec_in.index_add(0, s, gvec * v1.unsqueeze(1))
+            if need[8]:
+                grad_d.append((gvec * v2.unsqueeze(1)).sum(dim=(2, 3)))
+
+            # Value pathway
+            v_raw = v.index_select(0, s)
+            if layer.vector_cutoff:
+                v_raw = v_raw * c[:, None, None]
+            if dv_e is not None:
+                if need[6]:
+                    grad_dv.append(grad_vj * v_raw)
+                grad_vj = grad_vj * dv_e
+            if layer.vector_cutoff:
+                grad_c = (grad_vj * v.index_select(0, s)).sum(dim=(1, 2))
+                grad_vj = grad_vj * c[:, None, None]
+                grad_attn = grad_weight
+            else:
+                grad_c = (grad_weight * attn).sum(dim=1)
+                grad_attn = grad_weight * c.unsqueeze(1)
+            if need[3]:
+                grad_v = grad_v.index_add(0, s, grad_vj)
+            if need[7]:
+                grad_cutoff.append(grad_c)
+
+            # Attention
+            grad_pre = _activation_grad(
+                layer.attn_activation, pre_attn, grad_attn, create_graph
+            ).unsqueeze(2)
+            if dk_e is not None:
+                if need[5]:
+                    grad_dk.append(grad_pre * q_i * k_j)
+                grad_pre = grad_pre * dk_e
+            if need[1]:
+                grad_q = grad_q.index_add(0, d, grad_pre * k_j)
+            if need[2]:
+                grad_k = grad_k.index_add(0, s, grad_pre * q_i)
+
+        def cat(grads, needed):
+            return torch.cat(grads) if needed and len(grads) > 0 else None
+
+        return (
+            None,
+            grad_q,
+            grad_k,
+            grad_v,
+            grad_vec_in,
+            cat(grad_dk, need[5]),
+            cat(grad_dv, need[6]),
+            cat(grad_cutoff, need[7]),
+            cat(grad_d, need[8]),
+            None,
+            None,
+            None,
+        )
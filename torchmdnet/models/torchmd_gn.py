@@ -5,6 +5,7 @@
 from typing import Optional, Tuple
 import torch
 from torch import Tensor, nn
+from torch.utils.checkpoint import checkpoint
 from torchmdnet.models.utils import (
     NeighborEmbedding,
     CosineCutoff,
@@ -12,6 +13,8 @@ from torchmdnet.models.utils import (
     rbf_class_mapping,
     act_class_mapping,
     scatter,
+    segment_scatter,
+    expand_half_list,
 )
 
 
@@ -86,6 +89,29 @@ class TorchMD_GN(nn.Module):
             (default: :obj:`None`)
         check_errors (bool, optional): Whether to check for errors in the distance module.
             (default: :obj:`True`)
+        neighbor_skin (float, optional): If positive, the neighbor list is built with a
+            cutoff of :obj:`cutoff_upper + neighbor_skin` and reused until an atom moves more
+            than half the skin. Only useful when evaluating consecutive MD frames.
+            (default: :obj:`0.0`)
+        fused_cfconv (bool, optional): Whether to compute the continuous-filter convolutions
+            with :class:`FusedCFConv`, which generates the filters in chunks of edges and never
+            stores the filters of all edges. Saves the memory of the filters at the cost of
+            generating them again in the backward pass.
+            (default: :obj:`False`)
+        sorted_edges (bool, optional): Whether to sort the edges by receiving atom and
+            aggregate the messages with deterministic segment reductions, see
+            :func:`torchmdnet.models.utils.segment_scatter`.
+            (default: :obj:`False`)
+        half_list (bool, optional): Whether to search each pair of neighbors once and compute the
+            radial basis and the filters once per pair, sharing them between the two directions
+            of the pair, see :func:`torchmdnet.models.utils.expand_half_list`. The fused
+            convolutions still generate the filters of both directions.
+            (default: :obj:`False`)
+        checkpoint_layers (bool, optional): Whether to recompute the activations of each interaction block in
+            the backward pass instead of storing them, when training. Only the inputs of each interaction block
+            are kept, which reduces the memory of deep models trained on forces at the cost of one
+            more forward pass of the interaction blocks. Supports double backward.
+            (default: :obj:`False`)
 
     """
 
@@ -107,6 +133,11 @@ class TorchMD_GN(nn.Module):
         aggr="add",
         dtype=torch.float32,
         box_vecs=None,
+        neighbor_skin=0.0,
+        fused_cfconv=False,
+        sorted_edges=False,
+        half_list=False,
+        checkpoint_layers=False,
     ):
         super(TorchMD_GN, self).__init__()
 
@@ -136,6 +167,9 @@ class TorchMD_GN(nn.Module):
         self.cutoff_upper = cutoff_upper
         self.max_z = max_z
         self.aggr = aggr
+        self.sorted_edges = sorted_edges
+        self.half_list = half_list
+        self.checkpoint_layers = checkpoint_layers
 
         act_class = act_class_mapping[activation]
 
@@ -148,6 +182,9 @@ class TorchMD_GN(nn.Module):
             box=box_vecs,
             long_edge_index=True,
             check_errors=check_errors,
+            skin=neighbor_skin,
+            include_transpose=not half_list,
+            sort_edges=sorted_edges and not half_list,
         )
 
         self.distance_expansion = rbf_class_mapping[rbf_type](
@@ -161,6 +198,7 @@ class TorchMD_GN(nn.Module):
                 cutoff_upper,
                 self.max_z,
                 dtype=dtype,
+                sorted_edges=sorted_edges,
             )
             if neighbor_embedding
             else None
@@ -177,6 +215,8 @@ class TorchMD_GN(nn.Module):
                 cutoff_upper,
                 aggr=self.aggr,
                 dtype=dtype,
+                fused=fused_cfconv,
+                sorted_edges=sorted_edges,
             )
             self.interactions.append(block)
 
@@ -198,22 +238,63 @@ class TorchMD_GN(nn.Module):
         box: Optional[Tensor] = None,
         s: Optional[Tensor] = None,
         q: Optional[Tensor] = None,
+        neighbors: Optional[Tuple[Tensor, Tensor, Tensor]] = None,
     ) -> Tuple[Tensor, Optional[Tensor], Tensor, Tensor, Tensor]:
         x = self.embedding(z)
 
-        edge_index, edge_weight, _ = self.distance(pos, batch, box)
+        edge_index, edge_weight, _ = self.distance(pos, batch, box, neighbors)
         edge_attr = self.distance_expansion(edge_weight)
+        edge_pair: Optional[Tensor] = None
+        if self.half_list:
+            edge_index, edge_pair, _ = expand_half_list(
+                edge_index, z.shape[0], sort_edges=self.sorted_edges
+            )
 
         if self.neighbor_embedding is not None:
-            x = self.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr)
-
-        for interaction in self.interactions:
-            x = x + interaction(
-                x, edge_index, edge_weight, edge_attr, n_atoms=z.shape[0]
+            x = self.neighbor_embedding(
+                z, x, edge_index, edge_weight, edge_attr, edge_pair
             )
 
+        for i, interaction in enumerate(self.interactions):
+            if self.checkpoint_layers and self.training and not torch.jit.is_scripting():
+                x = x + self._checkpointed_interaction(
+                    i, x, edge_index, edge_weight, edge_attr, z.shape[0], edge_pair
+                )
+            else:
+                x = x + interaction(
+                    x,
+                    edge_index,
+                    edge_weight,
+                    edge_attr,
+                    n_atoms=z.shape[0],
+                    edge_pair=edge_pair,
+                )
+
         return x, None, z, pos, batch
 
+    @torch.jit.unused
+    def _checkpointed_interaction(
+        self,
+        i: int,
+        x: Tensor,
+        edge_index: Tensor,
+        edge_weight: Tensor,
+        edge_attr: Tensor,
+        n_atoms: int,
+        edge_pair: Optional[Tensor],
+    ) -> Tensor:
+        # The non-reentrant checkpoint supports torch.autograd.grad and double backward
+        return checkpoint(
+            self.interactions[i],
+            x,
+            edge_index,
+            edge_weight,
+            edge_attr,
+            n_atoms,
+            edge_pair,
+            use_reentrant=False,
+        )
+
     def __repr__(self):
         return (
             f"{self.__class__.__name__}("
@@ -247,6 +328,8 @@ class InteractionBlock(nn.Module):
         cutoff_upper,
         aggr="add",
         dtype=torch.float32,
+        fused=False,
+        sorted_edges=False,
     ):
         super(InteractionBlock, self).__init__()
         self.mlp = nn.Sequential(
@@ -263,6 +346,8 @@ class InteractionBlock(nn.Module):
             cutoff_upper,
             aggr=aggr,
             dtype=dtype,
+            fused=fused,
+            sorted_edges=sorted_edges,
         )
         self.act = activation()
         self.lin = nn.Linear(hidden_channels, hidden_channels, dtype=dtype)
@@ -285,8 +370,9 @@ class InteractionBlock(nn.Module):
         edge_weight: Tensor,
         edge_attr: Tensor,
         n_atoms: Optional[int] = None,
+        edge_pair: Optional[Tensor] = None,
     ) -> Tensor:
-        x = self.conv(x, edge_index, edge_weight, edge_attr, n_atoms)
+        x = self.conv(x, edge_index, edge_weight, edge_attr, n_atoms, edge_pair)
         x = self.act(x)
         x = self.lin(x)
         return x
@@ -308,6 +394,8 @@ class CFConv(nn.Module):
         cutoff_upper,
         aggr="add",
         dtype=torch.float32,
+        fused=False,
+        sorted_edges=False,
     ):
         super(CFConv, self).__init__()
         self.lin1 = nn.Linear(in_channels, num_filters, bias=False, dtype=dtype)
@@ -315,6 +403,8 @@ class CFConv(nn.Module):
         self.net = net
         self.cutoff = CosineCutoff(cutoff_lower, cutoff_upper)
         self.aggr = aggr
+        self.fused = fused
+        self.sorted_edges = sorted_edges
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -322,6 +412,33 @@ class CFConv(nn.Module):
         nn.init.xavier_uniform_(self.lin2.weight)
         self.lin2.bias.data.fill_(0)
 
+    def filter(self, edge_weight: Tensor, edge_attr: Tensor) -> Tensor:
+        """Continuous filters of the edges, with shape (num_edges, num_filters)."""
+        C = self.cutoff(edge_weight)
+        return self.net(edge_attr) * C.view(-1, 1)
+
+    @torch.jit.unused
+    def _fused_convolution(
+        self,
+        x: Tensor,
+        edge_index: Tensor,
+        edge_weight: Tensor,
+        edge_attr: Tensor,
+        n_atoms: Optional[int],
+    ) -> Tensor:
+        if n_atoms is None:
+            n_atoms = int(edge_index[0].max()) + 1 if edge_index.shape[1] > 0 else 0
+        return FusedCFConv.apply(
+            self,
+            x,
+            edge_weight,
+            edge_attr,
+            edge_index[1],
+            edge_index[0],
+            n_atoms,
+            *self.net.parameters(),
+        )
+
     def forward(
         self,
         x: Tensor,
@@ -329,12 +446,135 @@ class CFConv(nn.Module):
         edge_weight: Tensor,
         edge_attr: Tensor,
         n_atoms: Optional[int] = None,
+        edge_pair: Optional[Tensor] = None,
     ) -> Tensor:
-        C = self.cutoff(edge_weight)
-        W = self.net(edge_attr) * C.view(-1, 1)
-
+        """If edge_pair is given, edge_weight and edge_attr belong to a half neighbor list and
+        edge_pair is the pair of each edge, see :func:`torchmdnet.models.utils.expand_half_list`."""
         x = self.lin1(x)
-        msg = W * x.index_select(0, edge_index[1])
-        x = scatter(msg, edge_index[0], dim=0, dim_size=n_atoms, reduce=self.aggr)
+        if self.fused and not torch.jit.is_scripting():
+            if edge_pair is not None:
+                edge_weight = edge_weight.index_select(0, edge_pair)
+                edge_attr = edge_attr.index_select(0, edge_pair)
+            x = self._fused_convolution(x, edge_index, edge_weight, edge_attr, n_atoms)
+        else:
+            W = self.filter(edge_weight, edge_attr)
+            if edge_pair is not None:
+                W = W.index_select(0, edge_pair)
+            msg = W * x.index_select(0, edge_index[1])
+            if self.sorted_edges:
+                if n_atoms is None:
+                    n_atoms = int(edge_index[0].max()) + 1 if edge_index.shape[1] > 0 else 0
+                x = segment_scatter(msg, edge_index[0], n_atoms, reduce=self.aggr)
+            else:
+                x = scatter(msg, edge_index[0], dim=0, dim_size=n_atoms, reduce=self.aggr)
         x = self.lin2(x)
         return x
+
+
+# Maximum number of filter values generated at once by FusedCFConv
+_FUSED_CHUNK_NUMEL = 2**24
+
+
+class FusedCFConv(torch.autograd.Function):
+    """Filter generation, gather and aggregation of :class:`CFConv` in a single operation.
+
+    The filters are generated in chunks of edges, multiplied by the features of the source atoms and aggregated
+    into the target atoms, so that the filters of all edges are never stored at once. The backward pass generates
+    them again, chunk by chunk, and is itself differentiable, so models can be trained with forces. The aggregation
+    matches :func:`torchmdnet.models.utils.scatter` for every :obj:`aggr` of :class:`CFConv`.
+
+    :meta private:
+    """
+
+    @staticmethod
+    def forward(ctx, conv, x, edge_weight, edge_attr, src, dst, n_atoms, *params):
+        out = x.new_zeros(n_atoms, x.shape[1])
+        chunk = max(1, _FUSED_CHUNK_NUMEL // x.shape[1])
+        for start in range(0, src.shape[0], chunk):
+            msg = conv.filter(
+                edge_weight[start : start + chunk], edge_attr[start : start + chunk]
+            )
+            msg = msg * x.index_select(0, src[start : start + chunk])
+            if conv.aggr == "max":
+                out.index_reduce_(0, dst[start : start + chunk], msg, "amax")
+            else:
+                out.index_add_(0, dst[start : start + chunk], msg)
+        if conv.aggr == "mean":
+            # The aggregation includes the zero initial value, as in scatter
+            out = out / (torch.bincount(dst, minlength=n_atoms) + 1).unsqueeze(1)
+        ctx.conv = conv
+        ctx.save_for_backward(x, edge_weight, edge_attr, src, dst, out, *params)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, edge_weight, edge_attr, src, dst, out, *params = ctx.saved_tensors
+        conv = ctx.conv
+        # Only true when the gradients have to be differentiable themselves
+        create_graph = torch.is_grad_enabled()
+        chunk = max(1, _FUSED_CHUNK_NUMEL // x.shape[1])
+        chunks = range(0, src.shape[0], chunk)
+        if conv.aggr == "mean":
+            grad = grad / (torch.bincount(dst, minlength=out.shape[0]) + 1).unsqueeze(1)
+        if conv.aggr == "max":
+            # The gradient is shared between the messages equal to the maximum, and the initial zero
+            with torch.no_grad():
+                ties = (out == 0).to(out.dtype)
+                for start in chunks:
+                    msg = conv.filter(
+                        edge_weight[start : start + chunk],
+                        edge_attr[start : start + chunk],
+                    )
+                    msg = msg * x.index_select(0, src[start : start + chunk])
+                    is_max = msg == out.index_select(0, dst[start : start + chunk])
+                    ties.index_add_(0, dst[start : start + chunk], is_max.to(out.dtype))
+            grad = grad / ties
+
+        need_x, need_weight, need_attr = ctx.needs_input_grad[1:4]
+        need_params = ctx.needs_input_grad[7:]
+        grad_x = torch.zeros_like(x) if need_x else None
+        grad_weight, grad_attr = [], []
+        grad_params = [None] * len(params)
+        with torch.enable_grad():
+            for start in chunks:
+                weight = edge_weight[start : start + chunk]
+                attr = edge_attr[start : start + chunk]
+                if not create_graph:
+                    weight = weight.detach().requires_grad_(need_weight)
+                    attr = attr.detach().requires_grad_(need_attr)
+                W = conv.filter(weight, attr)
+                x_src = x.index_select(0, src[start : start + chunk])
+                grad_msg = grad.index_select(0, dst[start : start + chunk])
+                if conv.aggr == "max":
+                    is_max = (W * x_src).detach() == out.index_select(
+                        0, dst[start : start + chunk]
+                    )
+                    grad_msg = grad_msg * is_max
+                if need_x:
+                    grad_x = grad_x.index_add(0, src[start : start + chunk], W * grad_msg)
+                inputs = [weight] if need_weight else []
+                inputs += [attr] if need_attr else []
+                inputs += [p for p, need in zip(params, need_params) if need]
+                if len(inputs) == 0:
+                    continue
+                grads = list(
+                    torch.autograd.grad(
+                        W,
+                        inputs,
+                        grad_outputs=grad_msg * x_src,
+                        create_graph=create_graph,
+                        allow_unused=True,
+                    )
+                )
+                if need_weight:
+                    grad_weight.append(grads.pop(0))
+                if need_attr:
+                    grad_attr.append(grads.pop(0))
+                for i, need in enumerate(need_params):
+                    if need:
+                        g = grads.pop(0)
+                        if g is not None:
+                            grad_params[i] = g if grad_params[i] is None else grad_params[i] + g
+        grad_weight = torch.cat(grad_weight) if need_weight and grad_weight else None
+        grad_attr = torch.cat(grad_attr) if need_attr and grad_attr else None
+        return (None, grad_x, grad_weight, grad_attr, None, None, None, *grad_params)
@@ -12,6 +12,8 @@ from torchmdnet.models.utils import (
     rbf_class_mapping,
     act_class_mapping,
     scatter,
+    segment_scatter,
+    expand_half_list,
 )
 from torchmdnet.utils import deprecated_class
 
@@ -76,6 +78,19 @@ class TorchMD_T(nn.Module):
             (default: :obj:`None`)
         check_errors (bool, optional): Whether to check for errors in the distance module.
             (default: :obj:`True`)
+        neighbor_skin (float, optional): If positive, the neighbor list is built with a
+            cutoff of :obj:`cutoff_upper + neighbor_skin` and reused until an atom moves more
+            than half the skin. Only useful when evaluating consecutive MD frames.
+            (default: :obj:`0.0`)
+        sorted_edges (bool, optional): Whether to sort the edges by receiving atom and
+            aggregate the messages with deterministic segment reductions, see
+            :func:`torchmdnet.models.utils.segment_scatter`.
+            (default: :obj:`False`)
+        half_list (bool, optional): Whether to search each pair of neighbors once and compute the
+            radial basis and the distance projections of the attention once per pair, sharing them
+            between the two directions of the pair, see
+            :func:`torchmdnet.models.utils.expand_half_list`.
+            (default: :obj:`False`)
 
     """
 
@@ -98,6 +113,9 @@ class TorchMD_T(nn.Module):
         max_num_neighbors=32,
         dtype=torch.float,
         box_vecs=None,
+        neighbor_skin=0.0,
+        sorted_edges=False,
+        half_list=False,
     ):
         super(TorchMD_T, self).__init__()
 
@@ -124,6 +142,8 @@ class TorchMD_T(nn.Module):
         self.cutoff_lower = cutoff_lower
         self.cutoff_upper = cutoff_upper
         self.max_z = max_z
+        self.sorted_edges = sorted_edges
+        self.half_list = half_list
 
         act_class = act_class_mapping[activation]
         attn_act_class = act_class_mapping[attn_activation]
@@ -138,6 +158,9 @@ class TorchMD_T(nn.Module):
             box=box_vecs,
             long_edge_index=True,
             check_errors=check_errors,
+            skin=neighbor_skin,
+            include_transpose=not half_list,
+            sort_edges=sorted_edges and not half_list,
         )
 
         self.distance_expansion = rbf_class_mapping[rbf_type](
@@ -151,6 +174,7 @@ class TorchMD_T(nn.Module):
                 cutoff_upper,
                 self.max_z,
                 dtype=dtype,
+                sorted_edges=sorted_edges,
             )
             if neighbor_embedding
             else None
@@ -168,6 +192,7 @@ class TorchMD_T(nn.Module):
                 cutoff_lower,
                 cutoff_upper,
                 dtype=dtype,
+                sorted_edges=sorted_edges,
             )
             self.attention_layers.append(layer)
 
@@ -192,17 +217,25 @@ class TorchMD_T(nn.Module):
         box: Optional[Tensor] = None,
         s: Optional[Tensor] = None,
         q: Optional[Tensor] = None,
+        neighbors: Optional[Tuple[Tensor, Tensor, Tensor]] = None,
     ) -> Tuple[Tensor, Optional[Tensor], Tensor, Tensor, Tensor]:
         x = self.embedding(z)
 
-        edge_index, edge_weight, _ = self.distance(pos, batch, box)
+        edge_index, edge_weight, _ = self.distance(pos, batch, box, neighbors)
         edge_attr = self.distance_expansion(edge_weight)
+        edge_pair: Optional[Tensor] = None
+        if self.half_list:
+            edge_index, edge_pair, _ = expand_half_list(
+                edge_index, z.shape[0], sort_edges=self.sorted_edges
+            )
 
         if self.neighbor_embedding is not None:
-            x = self.neighbor_embedding(z, x, edge_index, edge_weight, edge_attr)
+            x = self.neighbor_embedding(
+                z, x, edge_index, edge_weight, edge_attr, edge_pair
+            )
 
         for attn in self.attention_layers:
-            x = x + attn(x, edge_index, edge_weight, edge_attr, z.shape[0])
+            x = x + attn(x, edge_index, edge_weight, edge_attr, z.shape[0], edge_pair)
         x = self.out_norm(x)
 
         return x, None, z, pos, batch
@@ -242,6 +275,7 @@ class MultiHeadAttention(nn.Module):
         cutoff_lower,
         cutoff_upper,
         dtype=torch.float,
+        sorted_edges=False,
     ):
         super(MultiHeadAttention, self).__init__()
         assert hidden_channels % num_heads == 0, (
@@ -253,6 +287,7 @@ class MultiHeadAttention(nn.Module):
         self.distance_influence = distance_influence
         self.num_heads = num_heads
         self.head_dim = hidden_channels // num_heads
+        self.sorted_edges = sorted_edges
 
         self.layernorm = nn.LayerNorm(hidden_channels, dtype=dtype)
         self.act = activation()
@@ -292,8 +327,16 @@ class MultiHeadAttention(nn.Module):
             self.dv_proj.bias.data.fill_(0)
 
     def forward(
-        self, x: Tensor, edge_index: Tensor, r_ij: Tensor, f_ij: Tensor, n_atoms: int
+        self,
+        x: Tensor,
+        edge_index: Tensor,
+        r_ij: Tensor,
+        f_ij: Tensor,
+        n_atoms: int,
+        edge_pair: Optional[Tensor] = None,
     ) -> Tensor:
+        """If edge_pair is given, r_ij and f_ij belong to a half neighbor list and edge_pair is
+        the pair of each edge, see :func:`torchmdnet.models.utils.expand_half_list`."""
         head_shape = (-1, self.num_heads, self.head_dim)
 
         x = self.layernorm(x)
@@ -311,8 +354,17 @@ class MultiHeadAttention(nn.Module):
             if self.dv_proj is not None
             else None
         )
+        if edge_pair is not None:
+            r_ij = r_ij.index_select(0, edge_pair)
+            if dk is not None:
+                dk = dk.index_select(0, edge_pair)
+            if dv is not None:
+                dv = dv.index_select(0, edge_pair)
         msg = self.message(edge_index, q, k, v, dk, dv, r_ij)
-        out = scatter(msg, edge_index[0], dim=0, dim_size=n_atoms)
+        if self.sorted_edges:
+            out = segment_scatter(msg, edge_index[0], n_atoms)
+        else:
+            out = scatter(msg, edge_index[0], dim=0, dim_size=n_atoms)
         out = self.o_proj(out.reshape(-1, self.num_heads * self.head_dim))
         return out
 
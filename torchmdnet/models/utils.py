@@ -2,8 +2,9 @@
 # Distributed under the MIT License.
 # (See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
 
+import copy
 import math
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 import torch
 from torch import nn, Tensor
 import torch.nn.functional as F
@@ -51,6 +52,7 @@ class NeighborEmbedding(nn.Module):
         cutoff_upper,
         max_z=100,
         dtype=torch.float32,
+        sorted_edges=False,
     ):
         """
         The ET architecture assigns two  learned vectors to each atom type
@@ -64,8 +66,13 @@ class NeighborEmbedding(nn.Module):
         interaction of atom pairs.
 
         See eq. 3 in https://arxiv.org/pdf/2202.02541.pdf for more details.
+
+        If  sorted_edges is  True,  the edges  must be  sorted by  their
+        receiving atom (see  OptimizedDistance), and the messages are summed
+        with :func:`segment_scatter`.
         """
         super(NeighborEmbedding, self).__init__()
+        self.sorted_edges = sorted_edges
         self.embedding = nn.Embedding(max_z, hidden_channels, dtype=dtype)
         self.distance_proj = nn.Linear(num_rbf, hidden_channels, dtype=dtype)
         self.combine = nn.Linear(hidden_channels * 2, hidden_channels, dtype=dtype)
@@ -87,6 +94,7 @@ class NeighborEmbedding(nn.Module):
         edge_index: Tensor,
         edge_weight: Tensor,
         edge_attr: Tensor,
+        edge_pair: Optional[Tensor] = None,
     ) -> Tensor:
         """
         Args:
@@ -95,6 +103,8 @@ class NeighborEmbedding(nn.Module):
             edge_index (Tensor): Graph connectivity (list of neighbor pairs) with shape :obj:`[2, num_edges]`
             edge_weight (Tensor): Edge weight vector of shape :obj:`[num_edges]`
             edge_attr (Tensor): Edge attribute matrix of shape :obj:`[num_edges, 3]`
+            edge_pair (Tensor, optional): If given, edge_weight and edge_attr belong to a half neighbor list and
+                this is the pair of each edge, see :func:`expand_half_list`.
         Returns:
             x_neighbors (Tensor): The embedding of the neighbors of each atom of shape :obj:`[num_nodes, hidden_channels]`
         """
@@ -102,21 +112,42 @@ class NeighborEmbedding(nn.Module):
         mask = edge_index[0] != edge_index[1]
         if not mask.all():
             edge_index = edge_index[:, mask]
-            edge_weight = edge_weight[mask]
-            edge_attr = edge_attr[mask]
+            if edge_pair is None:
+                edge_weight = edge_weight[mask]
+                edge_attr = edge_attr[mask]
+            else:
+                edge_pair = edge_pair[mask]
 
         C = self.cutoff(edge_weight)
         W = self.distance_proj(edge_attr) * C.view(-1, 1)
+        if edge_pair is not None:
+            W = W.index_select(0, edge_pair)
 
         x_neighbors = self.embedding(z)
         msg = W * x_neighbors.index_select(0, edge_index[1])
-        x_neighbors = torch.zeros(
-            z.shape[0], x.shape[1], dtype=x.dtype, device=x.device
-        ).index_add(0, edge_index[0], msg)
+        if self.sorted_edges:
+            x_neighbors = segment_scatter(msg, edge_index[0], z.shape[0])
+        else:
+            x_neighbors = torch.zeros(
+                z.shape[0], x.shape[1], dtype=x.dtype, device=x.device
+            ).index_add(0, edge_index[0], msg)
         x_neighbors = self.combine(torch.cat([x, x_neighbors], dim=1))
         return x_neighbors
 
 
+def _apply_pbc(vec: Tensor, box: Tensor) -> Tensor:
+    """Applies the minimum image convention to a set of distance vectors.
+
+    Args:
+        vec (Tensor): Distance vectors, with shape (N, 3).
+        box (Tensor): Box vectors in reduced form, with shape (3, 3) or (N, 3, 3).
+    """
+    vec = vec - torch.round(vec[:, 2] / box[..., 2, 2]).unsqueeze(1) * box[..., 2, :]
+    vec = vec - torch.round(vec[:, 1] / box[..., 1, 1]).unsqueeze(1) * box[..., 1, :]
+    vec = vec - torch.round(vec[:, 0] / box[..., 0, 0]).unsqueeze(1) * box[..., 0, :]
+    return vec
+
+
 class OptimizedDistance(torch.nn.Module):
     """ Compute the neighbor list for a given cutoff.
 
@@ -157,6 +188,8 @@ class OptimizedDistance(torch.nn.Module):
             1. *Shared*: An O(N^2) algorithm that leverages CUDA shared memory, best for large number of particles.
             2. *Brute*: A brute force O(N^2) algorithm, best for small number of particles.
             3. *Cell*:  A cell list algorithm, best for large number of particles, low cutoffs and low batch size.
+
+            On the CPU *shared* is equivalent to *brute*. The CPU *cell* strategy supports triclinic boxes and bins each sample in the batch independently.
         box : torch.Tensor, optional
             The vectors defining the periodic box.  This must have shape `(3, 3)` or `(max(batch)+1, 3, 3)` if a ox per sample is desired.
             where `box_vectors[0] = a`, `box_vectors[1] = b`, and `box_vectors[2] = c`.
@@ -180,6 +213,14 @@ class OptimizedDistance(torch.nn.Module):
         long_edge_index : bool, optional
             Whether to return edge_index as int64, otherwise int32.
             Default: True
+        skin : float, optional
+            If positive, a Verlet list is used: the pairs are searched with a cutoff of :code:`cutoff_upper + skin` and reused in subsequent calls, only recomputing the distances, until some atom moves more than :code:`skin/2` or the batch or box change.
+            The box must accommodate the extended cutoff and max_num_pairs the extended list. This is useful in MD, where consecutive calls see similar positions. It is not CUDA graph compatible.
+            Default: 0.0
+        sort_edges : bool, optional
+            Whether to return the pairs sorted by their first atom, the one receiving the messages in the models, with the (-1,-1) padding pairs at the end.
+            The messages can then be aggregated with :func:`segment_scatter`, and :func:`edge_ptr` gives the CSR row pointer of the list.
+            Default: False
         """
     def __init__(
         self,
@@ -193,7 +234,9 @@ class OptimizedDistance(torch.nn.Module):
         resize_to_fit=True,
         check_errors=True,
         box=None,
-        long_edge_index=True
+        long_edge_index=True,
+        skin=0.0,
+        sort_edges=False,
     ):
         super(OptimizedDistance, self).__init__()
         self.cutoff_upper = cutoff_upper
@@ -217,9 +260,143 @@ class OptimizedDistance(torch.nn.Module):
             self.box = self.box.cpu()
         self.check_errors = check_errors
         self.long_edge_index = long_edge_index
+        assert skin >= 0, "The skin must be non-negative"
+        self.skin = float(skin)
+        self.sort_edges = sort_edges
+        # Verlet list state, only used when skin > 0
+        self._ref_pos: Optional[Tensor] = None
+        self._ref_batch: Optional[Tensor] = None
+        self._ref_box: Optional[Tensor] = None
+        self._cached_edge_index: Optional[Tensor] = None
+
+    def _find_pairs(
+        self,
+        pos: Tensor,
+        batch: Tensor,
+        box: Tensor,
+        use_periodic: bool,
+        max_pairs: int,
+        cutoff_lower: float,
+        cutoff_upper: float,
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        edge_index, edge_vec, edge_weight, num_pairs = get_neighbor_pairs_kernel(
+            strategy=self.strategy,
+            positions=pos,
+            batch=batch,
+            max_num_pairs=int(max_pairs),
+            cutoff_lower=cutoff_lower,
+            cutoff_upper=cutoff_upper,
+            loop=self.loop,
+            include_transpose=self.include_transpose,
+            box_vectors=box,
+            use_periodic=use_periodic,
+        )
+        if self.check_errors:
+            if num_pairs[0] > max_pairs:
+                raise AssertionError(
+                    "Found num_pairs({}) > max_num_pairs({})".format(
+                        num_pairs[0], max_pairs
+                    )
+                )
+        return edge_index, edge_vec, edge_weight
+
+    def _needs_rebuild(self, pos: Tensor, batch: Tensor, box: Tensor) -> bool:
+        ref_pos = self._ref_pos
+        ref_batch = self._ref_batch
+        ref_box = self._ref_box
+        if ref_pos is None or ref_batch is None or ref_box is None:
+            return True
+        if ref_pos.shape != pos.shape or ref_pos.device != pos.device:
+            return True
+        if ref_box.shape != box.shape or not torch.equal(ref_box, box):
+            return True
+        if not torch.equal(ref_batch, batch):
+            return True
+        max_displacement2 = (pos.detach() - ref_pos).pow(2).sum(dim=1).max()
+        return bool(max_displacement2 > (0.5 * self.skin) ** 2)
+
+    def _verlet_forward(
+        self,
+        pos: Tensor,
+        batch: Tensor,
+        box: Tensor,
+        use_periodic: bool,
+        max_pairs: int,
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        if self._needs_rebuild(pos, batch, box):
+            edge_index, _, _ = self._find_pairs(
+                pos,
+                batch,
+                box,
+                use_periodic,
+                max_pairs,
+                max(float(self.cutoff_lower) - self.skin, 0.0),
+                float(self.cutoff_upper) + self.skin,
+            )
+            self._cached_edge_index = edge_index[:, edge_index[0] != -1].to(torch.long)
+            self._ref_pos = pos.detach().clone()
+            self._ref_batch = batch.clone()
+            self._ref_box = box.clone()
+        edge_index = self._cached_edge_index
+        assert edge_index is not None
+        edge_vec = pos.index_select(0, edge_index[0]) - pos.index_select(0, edge_index[1])
+        if use_periodic:
+            # The cell strategy keeps the box in the CPU
+            box = box.to(pos.device)
+            if box.dim() == 3:
+                box = box.index_select(0, batch.index_select(0, edge_index[0]))
+            edge_vec = _apply_pbc(edge_vec, box)
+        edge_weight = torch.linalg.vector_norm(edge_vec, dim=1)
+        mask = (edge_weight < self.cutoff_upper) & (edge_weight >= self.cutoff_lower)
+        if self.loop:
+            mask = mask | (edge_index[0] == edge_index[1])
+        edge_index = edge_index[:, mask]
+        edge_weight = edge_weight[mask]
+        edge_vec = edge_vec[mask]
+        num_pairs = edge_weight.shape[0]
+        if self.check_errors and num_pairs > max_pairs:
+            raise AssertionError(
+                "Found num_pairs({}) > max_num_pairs({})".format(num_pairs, max_pairs)
+            )
+        if not self.resize_to_fit:
+            # Pad with (-1,-1) pairs, as the kernels do
+            num_pad = max_pairs - num_pairs
+            if num_pad >= 0:
+                edge_index = F.pad(edge_index, (0, num_pad), value=-1)
+                edge_weight = F.pad(edge_weight, (0, num_pad))
+                edge_vec = F.pad(edge_vec, (0, 0, 0, num_pad))
+            else:
+                edge_index = edge_index[:, :max_pairs]
+                edge_weight = edge_weight[:max_pairs]
+                edge_vec = edge_vec[:max_pairs]
+        return edge_index, edge_vec, edge_weight
+
+    def _filter_neighbors(
+        self, neighbors: Tuple[Tensor, Tensor, Tensor], n_atoms: int
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        edge_index, edge_weight, edge_vec = neighbors
+        mask = (edge_weight >= self.cutoff_lower) & (edge_weight < self.cutoff_upper)
+        mask = mask & (edge_index[0] != edge_index[1])
+        if not self.include_transpose:
+            mask = mask & (edge_index[0] > edge_index[1])
+        edge_index = edge_index[:, mask]
+        edge_weight = edge_weight[mask]
+        edge_vec = edge_vec[mask]
+        if self.loop:
+            loop_index = torch.arange(
+                n_atoms, dtype=edge_index.dtype, device=edge_index.device
+            )
+            edge_index = torch.cat([edge_index, loop_index.repeat(2, 1)], dim=1)
+            edge_weight = torch.cat([edge_weight, edge_weight.new_zeros(n_atoms)])
+            edge_vec = torch.cat([edge_vec, edge_vec.new_zeros(n_atoms, 3)])
+        return edge_index, edge_vec, edge_weight
 
     def forward(
-            self, pos: Tensor, batch: Optional[Tensor] = None, box: Optional[Tensor] = None
+        self,
+        pos: Tensor,
+        batch: Optional[Tensor] = None,
+        box: Optional[Tensor] = None,
+        neighbors: Optional[Tuple[Tensor, Tensor, Tensor]] = None,
     ) -> Tuple[Tensor, Tensor, Optional[Tensor]]:
         """
         Compute the neighbor list for a given cutoff.
@@ -232,6 +409,9 @@ class OptimizedDistance(torch.nn.Module):
             A tensor with shape (N,). Defaults to None.
         box : torch.Tensor, optional
             The vectors defining the periodic box.  This must have shape `(3, 3)` or `(max(batch)+1, 3, 3)`,
+        neighbors : tuple of torch.Tensor, optional
+            A precomputed neighbor list, as a tuple `(edge_index, edge_weight, edge_vec)` like the one returned by an OptimizedDistance with `include_transpose=True` and `return_vecs=True`, whose cutoffs cover the ones of this module.
+            If given, no search is performed and the pairs of this list within the cutoffs of this module are returned. The result is not padded, even if `resize_to_fit` is False.
         Returns
         -------
         edge_index : torch.Tensor
@@ -260,33 +440,41 @@ class OptimizedDistance(torch.nn.Module):
             max_pairs = -self.max_num_pairs * pos.shape[0]
         if batch is None:
             batch = torch.zeros(pos.shape[0], dtype=torch.long, device=pos.device)
-        edge_index, edge_vec, edge_weight, num_pairs = get_neighbor_pairs_kernel(
-            strategy=self.strategy,
-            positions=pos,
-            batch=batch,
-            max_num_pairs=int(max_pairs),
-            cutoff_lower=self.cutoff_lower,
-            cutoff_upper=self.cutoff_upper,
-            loop=self.loop,
-            include_transpose=self.include_transpose,
-            box_vectors=box,
-            use_periodic=use_periodic,
-        )
-        if self.check_errors:
-            if num_pairs[0] > max_pairs:
-                raise AssertionError(
-                    "Found num_pairs({}) > max_num_pairs({})".format(
-                        num_pairs[0], max_pairs
-                    )
-                )
-        # Remove (-1,-1)  pairs
-        if self.resize_to_fit:
-            mask = edge_index[0] != -1
-            edge_index = edge_index[:, mask]
-            edge_weight = edge_weight[mask]
-            edge_vec = edge_vec[mask, :]
+        if neighbors is not None:
+            edge_index, edge_vec, edge_weight = self._filter_neighbors(
+                neighbors, pos.shape[0]
+            )
+        elif self.skin > 0:
+            edge_index, edge_vec, edge_weight = self._verlet_forward(
+                pos, batch, box, use_periodic, max_pairs
+            )
+        else:
+            edge_index, edge_vec, edge_weight = self._find_pairs(
+                pos,
+                batch,
+                box,
+                use_periodic,
+                max_pairs,
+                float(self.cutoff_lower),
+                float(self.cutoff_upper),
+            )
+            # Remove (-1,-1)  pairs
+            if self.resize_to_fit:
+                mask = edge_index[0] != -1
+                edge_index = edge_index[:, mask]
+                edge_weight = edge_weight[mask]
+                edge_vec = edge_vec[mask, :]
+        if self.sort_edges:
+            # Padding pairs go last, the order of the pairs of each atom is kept
+            key = edge_index[0].masked_fill(edge_index[0] < 0, pos.shape[0])
+            _, perm = torch.sort(key, stable=True)
+            edge_index = edge_index.index_select(1, perm)
+            edge_weight = edge_weight.index_select(0, perm)
+            edge_vec = edge_vec.index_select(0, perm)
         if self.long_edge_index:
             edge_index = edge_index.to(torch.long)
+        else:
+            edge_index = edge_index.to(torch.int32)
         if self.return_vecs:
             return edge_index, edge_weight, edge_vec
         else:
@@ -556,6 +744,269 @@ def scatter(
     return res
 
 
+def edge_ptr(index: Tensor, num_nodes: int) -> Tensor:
+    """CSR row pointer of a sorted index: the entries of node i are ptr[i]:ptr[i + 1]."""
+    nodes = torch.arange(num_nodes + 1, device=index.device, dtype=index.dtype)
+    return torch.searchsorted(index, nodes)
+
+
+class _SegmentSum(torch.autograd.Function):
+    """Sum of contiguous segments, whose gradient is a gather, and vice versa, so that
+    derivatives of any order are computed with deterministic segment reductions."""
+
+    @staticmethod
+    def forward(ctx, src, index, lengths):
+        ctx.save_for_backward(index, lengths)
+        return torch.segment_reduce(src, "sum", lengths=lengths, axis=0, initial=0)
+
+    @staticmethod
+    def backward(ctx, grad):
+        index, lengths = ctx.saved_tensors
+        return _SegmentGather.apply(grad, index, lengths), None, None
+
+
+class _SegmentGather(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, src, index, lengths):
+        ctx.save_for_backward(index, lengths)
+        return src.index_select(0, index)
+
+    @staticmethod
+    def backward(ctx, grad):
+        index, lengths = ctx.saved_tensors
+        return _SegmentSum.apply(grad, index, lengths), None, None
+
+
+@torch.jit.unused
+def _segment_sum(src: Tensor, index: Tensor, lengths: Tensor) -> Tensor:
+    return _SegmentSum.apply(src, index, lengths)
+
+
+def segment_scatter(
+    src: Tensor, index: Tensor, dim_size: int, reduce: str = "sum"
+) -> Tensor:
+    """Same as :func:`scatter` along the first dimension, for an index sorted in ascending order.
+
+    Each output row is reduced from a contiguous segment of :obj:`src`, always in the same order, so unlike the
+    atomic additions of :func:`scatter` and :obj:`index_add` the result is deterministic. This is also more cache
+    friendly. The edges of :class:`OptimizedDistance` with :obj:`sort_edges=True` are sorted by their first atom.
+    """
+    lengths = edge_ptr(index, dim_size).diff()
+    if reduce in ["add", "sum", "mean"]:
+        if torch.jit.is_scripting():
+            out = torch.segment_reduce(src, "sum", lengths=lengths, axis=0, initial=0)
+        else:
+            out = _segment_sum(src, index, lengths)
+        if reduce == "mean":
+            # Same as scatter, which includes the zero initial value in the mean
+            count = (lengths + 1).view([-1] + [1] * (src.dim() - 1))
+            out = out / count
+        return out
+    if reduce == "max":
+        return torch.segment_reduce(src, "max", lengths=lengths, axis=0, initial=0)
+    raise ValueError(f"Unsupported reduction: {reduce}")
+
+
+def expand_half_list(
+    edge_index: Tensor,
+    num_nodes: int,
+    static_shape: bool = False,
+    sort_edges: bool = False,
+) -> Tuple[Tensor, Tensor, Tensor]:
+    """Full neighbor list of a half list, with each pair once, as returned by :class:`OptimizedDistance` with
+    :obj:`include_transpose=False`.
+
+    The two edges of each pair share the quantities computed on the half list, so these only need to be computed
+    once per pair. Symmetric quantities, like distances or filters, are expanded with
+    :obj:`value.index_select(0, edge_pair)` and antisymmetric ones, like distance vectors, are also multiplied by
+    :obj:`edge_sign`.
+
+    The transposed edges are appended after the half list, except for self loops and (-1,-1) padding pairs, which
+    appear only once. If :obj:`static_shape` is True, their transposed copies are kept pointing to the dummy atom
+    :obj:`num_nodes` instead, so that the size of the list only depends on the size of the half list. If
+    :obj:`sort_edges` is True, the edges are sorted by their first atom as in :class:`OptimizedDistance`.
+
+    Returns:
+        edge_index (Tensor): The full neighbor list, with shape (2, num_edges).
+        edge_pair (Tensor): The index in the half list of the pair of each edge, with shape (num_edges,).
+        edge_sign (Tensor): 1 for the edges of the half list and -1 for the transposed ones, with shape (num_edges,).
+    """
+    pair = torch.arange(edge_index.shape[1], device=edge_index.device)
+    transpose = edge_index.flip(0)
+    loop = edge_index[0] == edge_index[1]
+    if static_shape:
+        transpose = transpose.masked_fill(loop.unsqueeze(0).expand_as(transpose), num_nodes)
+        transpose_pair = pair
+    else:
+        transpose = transpose[:, ~loop]
+        transpose_pair = pair[~loop]
+    edge_index = torch.cat((edge_index, transpose), dim=1)
+    edge_pair = torch.cat((pair, transpose_pair))
+    edge_sign = torch.cat((torch.ones_like(pair), -torch.ones_like(transpose_pair)))
+    if sort_edges:
+        key = edge_index[0].masked_fill(edge_index[0] < 0, num_nodes)
+        _, perm = torch.sort(key, stable=True)
+        edge_index = edge_index.index_select(1, perm)
+        edge_pair = edge_pair.index_select(0, perm)
+        edge_sign = edge_sign.index_select(0, perm)
+    return edge_index, edge_pair, edge_sign
+
+
+class TabulatedFunction(nn.Module):
+    """Cubic Hermite interpolation of a function of the distance, tabulated on a uniform grid.
+
+    The function and its derivative are evaluated in double precision at :obj:`num_points` distances between
+    :obj:`cutoff_lower` and :obj:`cutoff_upper`. The interpolation and its first derivative are continuous, so forces
+    can be computed with autograd as with the original function. Distances are clamped to the grid, which is exact
+    for functions that are constant outside of it, like :class:`CosineCutoff`. The radial basis expansions are
+    tabulated from 0, since self loops have a zero distance, and :class:`ExpNormalSmearing` vanishes beyond
+    :obj:`cutoff_upper`.
+
+    This is meant for inference: the parameters of the function are frozen in the table.
+
+    Args:
+        function (nn.Module): Maps a tensor of distances to a tensor with the same shape, or with an extra last
+            dimension, with each value depending only on its distance.
+        cutoff_lower (float): Smallest tabulated distance.
+        cutoff_upper (float): Largest tabulated distance.
+        num_points (int, optional): Number of grid points. (default: :obj:`4096`)
+        dtype (torch.dtype, optional): Type of the table. (default: :obj:`torch.float32`)
+
+    Attributes:
+        max_error (float): Largest error of the interpolation at the midpoints of the grid, where it is the
+            largest, relative to the largest absolute value of the function.
+        max_grad_error (float): Same for the derivative.
+    """
+
+    value_shape: List[int]
+
+    def __init__(
+        self, function, cutoff_lower, cutoff_upper, num_points=4096, dtype=torch.float32
+    ):
+        super(TabulatedFunction, self).__init__()
+        assert num_points > 1, "At least two grid points are needed"
+        assert cutoff_upper > cutoff_lower, "The grid must have a positive length"
+        self.cutoff_lower = float(cutoff_lower)
+        self.cutoff_upper = float(cutoff_upper)
+        self.num_points = num_points
+        self.spacing = (self.cutoff_upper - self.cutoff_lower) / (num_points - 1)
+        function = copy.deepcopy(function).to(device="cpu", dtype=torch.float64)
+        grid = torch.linspace(
+            self.cutoff_lower, self.cutoff_upper, num_points, dtype=torch.float64
+        )
+        values, derivatives = self._evaluate(function, grid)
+        self.value_shape = list(values.shape[1:])
+        self.register_buffer("values", values.reshape(num_points, -1).to(dtype))
+        # Stored per grid spacing, as used by the Hermite basis
+        self.register_buffer(
+            "derivatives", (derivatives * self.spacing).reshape(num_points, -1).to(dtype)
+        )
+
+        # Accuracy check against the function itself, at the midpoints
+        midpoints = grid[:-1] + 0.5 * self.spacing
+        ref_values, ref_derivatives = self._evaluate(function, midpoints)
+        table = (self.values.to(torch.float64), self.derivatives.to(torch.float64))
+        interp_values, interp_derivatives = self._evaluate(
+            lambda x: self._interpolate(x, table[0], table[1]), midpoints
+        )
+        interp_values = interp_values.reshape(ref_values.shape)
+        interp_derivatives = interp_derivatives.reshape(ref_derivatives.shape)
+        self.max_error = float(
+            (interp_values - ref_values).abs().max() / ref_values.abs().max().clamp(min=1e-30)
+        )
+        self.max_grad_error = float(
+            (interp_derivatives - ref_derivatives).abs().max()
+            / ref_derivatives.abs().max().clamp(min=1e-30)
+        )
+
+    @staticmethod
+    def _evaluate(function, grid: Tensor) -> Tuple[Tensor, Tensor]:
+        """Values of the function at the grid and their derivatives with respect to the distance."""
+        with torch.enable_grad():
+            grid = grid.detach().requires_grad_(True)
+            values = function(grid)
+            flat = values.reshape(grid.shape[0], -1)
+            derivatives = [
+                torch.autograd.grad(flat[:, i].sum(), grid, retain_graph=True)[0]
+                for i in range(flat.shape[1])
+            ]
+        derivatives = torch.stack(derivatives, dim=1).reshape(values.shape)
+        return values.detach(), derivatives
+
+    def _interpolate(self, dist: Tensor, values: Tensor, derivatives: Tensor) -> Tensor:
+        x = (dist.clamp(self.cutoff_lower, self.cutoff_upper).reshape(-1) - self.cutoff_lower) / self.spacing
+        index = x.detach().floor().clamp(max=self.num_points - 2).to(torch.long)
+        t = (x - index).unsqueeze(1).to(values.dtype)
+        y0 = values.index_select(0, index)
+        y1 = values.index_select(0, index + 1)
+        m0 = derivatives.index_select(0, index)
+        m1 = derivatives.index_select(0, index + 1)
+        t2 = t * t
+        t3 = t2 * t
+        out = (
+            (2 * t3 - 3 * t2 + 1) * y0
+            + (t3 - 2 * t2 + t) * m0
+            + (3 * t2 - 2 * t3) * y1
+            + (t3 - t2) * m1
+        )
+        return out.reshape(list(dist.shape) + self.value_shape)
+
+    def forward(self, dist: Tensor) -> Tensor:
+        return self._interpolate(dist, self.values, self.derivatives)
+
+
+def tabulate_radial_functions(model: nn.Module, num_points: int = 4096, rtol: float = 1e-4) -> nn.Module:
+    """Replaces the radial basis expansions and the cosine cutoffs of a model with :class:`TabulatedFunction`
+    interpolations, which avoid the transcendental functions of every edge in each call.
+
+    The cutoffs with the same bounds, which most models have in every layer, share a single table. The
+    parameters of the expansions are frozen, so this is meant for inference, after loading a trained model.
+
+    Args:
+        model (nn.Module): The model, modified in place.
+        num_points (int, optional): Number of grid points of each table. (default: :obj:`4096`)
+        rtol (float, optional): Largest relative error of the interpolation, and of its derivative, with respect
+            to the analytic functions. (default: :obj:`1e-4`)
+
+    Returns:
+        nn.Module: The model.
+
+    Raises:
+        ValueError: If some table is not accurate enough, in which case more grid points are needed.
+    """
+    parameter = next(model.parameters(), None)
+    dtype = parameter.dtype if parameter is not None else torch.float32
+    device = parameter.device if parameter is not None else torch.device("cpu")
+    tables: Dict[Tuple[str, float, float], TabulatedFunction] = {}
+
+    def tabulate(function: nn.Module, cutoff_lower: float) -> TabulatedFunction:
+        table = TabulatedFunction(
+            function, cutoff_lower, function.cutoff_upper, num_points, dtype
+        )
+        if table.max_error > rtol or table.max_grad_error > rtol:
+            raise ValueError(
+                f"The table of {function.__class__.__name__} has a relative error of {table.max_error:.2e} "
+                f"and {table.max_grad_error:.2e} in its derivative, larger than {rtol:.2e}. "
+                f"Use more than {num_points} points."
+            )
+        return table.to(device)
+
+    def replace(module: nn.Module):
+        for name, child in module.named_children():
+            if isinstance(child, CosineCutoff):
+                key = ("cutoff", float(child.cutoff_lower), float(child.cutoff_upper))
+                if key not in tables:
+                    tables[key] = tabulate(child, child.cutoff_lower)
+                setattr(module, name, tables[key])
+            elif isinstance(child, (GaussianSmearing, ExpNormalSmearing)):
+                setattr(module, name, tabulate(child, 0.0))
+            else:
+                replace(child)
+
+    replace(model)
+    return model
+
+
 rbf_class_mapping = {"gauss": GaussianSmearing, "expnorm": ExpNormalSmearing}
 
 act_class_mapping = {
@@ -4,8 +4,12 @@
 
 from typing import Optional, Tuple
 import torch as pt
-from NNPOps.CFConv import CFConv
-from NNPOps.CFConvNeighbors import CFConvNeighbors
+
+try:
+    from NNPOps.CFConv import CFConv
+    from NNPOps.CFConvNeighbors import CFConvNeighbors
+except ImportError:
+    CFConv = None
 
 from .models.model import TorchMD_Net
 from .models.torchmd_gn import TorchMD_GN
@@ -83,11 +87,24 @@ def optimize(model):
     """
     Returns an optimized version for a given TorchMD_Net model.
     If the model is not supported, a ValueError is raised.
+
+    TorchMD_GN uses the CFConv of NNPOps when it is installed and supports the
+    configuration of the model. Otherwise, its CFConv layers are switched to the
+    in-tree fused implementation (see :class:`torchmdnet.models.torchmd_gn.FusedCFConv`),
+    which supports batches and every configuration of TorchMD_GN.
     """
     assert isinstance(model, TorchMD_Net)
 
     if isinstance(model.representation_model, TorchMD_GN):
-        model.representation_model = TorchMD_GN_optimized(model.representation_model)
+        try:
+            if CFConv is None:
+                raise ValueError("NNPOps is not installed")
+            model.representation_model = TorchMD_GN_optimized(
+                model.representation_model
+            )
+        except ValueError:
+            for interaction in model.representation_model.interactions:
+                interaction.conv.fused = True
     else:
         raise ValueError("Unsupported model! Only TorchMD_GN is suppored.")
 
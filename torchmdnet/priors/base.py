@@ -3,7 +3,25 @@
 # (See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
 
 from torch import nn, Tensor
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple
+
+
+def get_shared_neighbors(
+    extra_args: Optional[Dict[str, Tensor]]
+) -> Optional[Tuple[Tensor, Tensor, Tensor]]:
+    r"""Returns the neighbor list shared by the model through `extra_args`, if any.
+
+    When a TorchMD_Net is created with `share_neighbors=True` it computes a single neighbor list and
+    passes it to the priors as the `neighbor_edge_index`, `neighbor_edge_weight` and `neighbor_edge_vec`
+    fields of `extra_args`. The result can be passed as the `neighbors` argument of an `OptimizedDistance`.
+    """
+    if extra_args is None or "neighbor_edge_index" not in extra_args:
+        return None
+    return (
+        extra_args["neighbor_edge_index"],
+        extra_args["neighbor_edge_weight"],
+        extra_args["neighbor_edge_vec"],
+    )
 
 
 class BasePrior(nn.Module):
@@ -23,6 +41,13 @@ class BasePrior(nn.Module):
         """
         return {}
 
+    def get_neighbor_distance(self):
+        r"""Returns the `OptimizedDistance` module used by the prior to find its neighbors, or None.
+        Priors returning a module can receive a neighbor list shared with the rest of the model
+        (see :func:`get_shared_neighbors`), which covers the cutoffs of the module.
+        """
+        return None
+
     def pre_reduce(self, x, z, pos, batch, extra_args: Optional[Dict[str, Tensor]]):
         r"""Pre-reduce method of the prior model.
 
@@ -2,15 +2,138 @@
 # Distributed under the MIT License.
 # (See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
 
+import math
 import torch
+from torch import Tensor
 from torchmdnet.priors.base import BasePrior
 from torchmdnet.models.utils import OptimizedDistance, scatter
 from typing import Optional, Dict
 
+
+def _bspline_weights(w: Tensor, order: int) -> Tensor:
+    """Evaluates the cardinal B-spline of the given order at :math:`w + k`, for :math:`k=0,\\dots,order-1`.
+
+    Args:
+        w (Tensor): Fractional part of the grid coordinates, with shape (N,).
+        order (int): Order of the B-spline.
+
+    Returns:
+        Tensor: The weights, with shape (N, order).
+    """
+    k = torch.arange(order, dtype=w.dtype, device=w.device)
+    x = w.unsqueeze(1) + k
+    # M_1(x) is 1 in [0, 1) and 0 elsewhere
+    theta = torch.zeros_like(x)
+    theta[:, 0] = 1
+    for n in range(2, order + 1):
+        shifted = torch.nn.functional.pad(theta[:, :-1], (1, 0))
+        theta = (x * theta + (n - x) * shifted) / (n - 1)
+    return theta
+
+
+def _bspline_moduli(grid_size: int, order: int, dtype: torch.dtype, device: torch.device) -> Tensor:
+    """Squared moduli of the exponential Euler splines used by smooth PME, see Essmann et al. (1995)."""
+    m = _bspline_weights(torch.zeros(1, dtype=dtype, device=device), order)[0, 1:]
+    n = torch.arange(grid_size, dtype=dtype, device=device)
+    k = torch.arange(order - 1, dtype=dtype, device=device)
+    arg = 2 * math.pi * n.unsqueeze(1) * k / grid_size
+    den = (m * torch.cos(arg)).sum(1) ** 2 + (m * torch.sin(arg)).sum(1) ** 2
+    # For odd orders the modulus vanishes at the Nyquist frequency, interpolate from the neighbors
+    zero = den < 1e-7
+    interpolated = 0.5 * (torch.roll(den, 1) + torch.roll(den, -1))
+    den = torch.where(zero, interpolated, den)
+    return 1 / den
+
+
+def _ewald_reciprocal_energy(x: Tensor, q: Tensor, box: Tensor, alpha: float, tolerance: float) -> Tensor:
+    """Reciprocal space part of the Ewald sum of a single sample, summing over explicit wave vectors."""
+    recip = torch.linalg.inv(box).T
+    volume = box[0, 0] * box[1, 1] * box[2, 2]
+    kmax = [
+        int(math.ceil(alpha * float(box[i, i]) * math.sqrt(-math.log(tolerance)) / math.pi))
+        for i in range(3)
+    ]
+    n = torch.cartesian_prod(
+        torch.arange(-kmax[0], kmax[0] + 1, dtype=x.dtype, device=x.device),
+        torch.arange(-kmax[1], kmax[1] + 1, dtype=x.dtype, device=x.device),
+        torch.arange(-kmax[2], kmax[2] + 1, dtype=x.dtype, device=x.device),
+    )
+    n = n[(n != 0).any(dim=1)]
+    k = 2 * math.pi * n @ recip
+    k2 = (k * k).sum(dim=1)
+    phase = x @ k.T
+    structure_factor2 = (q @ torch.cos(phase)) ** 2 + (q @ torch.sin(phase)) ** 2
+    return (2 * math.pi / volume) * (
+        torch.exp(-k2 / (4 * alpha**2)) / k2 * structure_factor2
+    ).sum()
+
+
+def _pme_reciprocal_energy(
+    x: Tensor, q: Tensor, box: Tensor, alpha: float, tolerance: float, order: int
+) -> Tensor:
+    """Reciprocal space part of the Ewald sum of a single sample, using smooth particle mesh Ewald."""
+    inv_box = torch.linalg.inv(box)
+    recip = inv_box.T
+    volume = box[0, 0] * box[1, 1] * box[2, 2]
+    grid = [
+        max(int(math.ceil(2 * alpha * float(box[i, i]) / (3 * tolerance**0.2))), order)
+        for i in range(3)
+    ]
+    # Spread the charges on the grid
+    s = x @ inv_box
+    u = (s - torch.floor(s)) * torch.tensor(grid, dtype=x.dtype, device=x.device)
+    base = torch.floor(u)
+    w = u - base
+    offset = torch.arange(order, device=x.device)
+    g0 = (base[:, 0].long().unsqueeze(1) - offset) % grid[0]
+    g1 = (base[:, 1].long().unsqueeze(1) - offset) % grid[1]
+    g2 = (base[:, 2].long().unsqueeze(1) - offset) % grid[2]
+    theta0 = _bspline_weights(w[:, 0], order)
+    theta1 = _bspline_weights(w[:, 1], order)
+    theta2 = _bspline_weights(w[:, 2], order)
+    index = (g0[:, :, None, None] * grid[1] + g1[:, None, :, None]) * grid[2] + g2[:, None, None, :]
+    weight = (
+        q[:, None, None, None]
+        * theta0[:, :, None, None]
+        * theta1[:, None, :, None]
+        * theta2[:, None, None, :]
+    )
+    charge_grid = torch.zeros(grid[0] * grid[1] * grid[2], dtype=x.dtype, device=x.device)
+    charge_grid = charge_grid.index_add(0, index.flatten(), weight.flatten())
+    transformed = torch.fft.fftn(charge_grid.view(grid[0], grid[1], grid[2]))
+    transformed2 = transformed.real**2 + transformed.imag**2
+    # Convolution with the influence function
+    n0 = torch.fft.fftfreq(grid[0], 1.0 / grid[0], dtype=x.dtype, device=x.device)
+    n1 = torch.fft.fftfreq(grid[1], 1.0 / grid[1], dtype=x.dtype, device=x.device)
+    n2 = torch.fft.fftfreq(grid[2], 1.0 / grid[2], dtype=x.dtype, device=x.device)
+    m = (
+        n0[:, None, None, None] * recip[0]
+        + n1[None, :, None, None] * recip[1]
+        + n2[None, None, :, None] * recip[2]
+    )
+    m2 = (m * m).sum(dim=-1)
+    m2[0, 0, 0] = 1
+    moduli = (
+        _bspline_moduli(grid[0], order, x.dtype, x.device)[:, None, None]
+        * _bspline_moduli(grid[1], order, x.dtype, x.device)[None, :, None]
+        * _bspline_moduli(grid[2], order, x.dtype, x.device)[None, None, :]
+    )
+    influence = torch.exp(-(math.pi**2) * m2 / alpha**2) / m2 * moduli
+    influence[0, 0, 0] = 0
+    return (influence * transformed2).sum() / (2 * math.pi * volume)
+
+
 class Coulomb(BasePrior):
     """This class implements a Coulomb potential, scaled by a cosine switching function to reduce its
     effect at short distances.
 
+    By default all pairs of atoms in each sample interact directly, with no periodic boundary conditions.
+    For periodic systems the energy can be computed with an Ewald sum instead, setting `method` to "ewald" or "pme".
+    The real space part is then computed on a neighbor list with cutoff `cutoff_distance` and the reciprocal part
+    with explicit wave vectors ("ewald", best for small systems) or with smooth particle mesh Ewald ("pme", O(N log N)).
+    In both cases the switching function is applied to the short range interactions, so the result matches "direct"
+    for a system in an infinitely large box.
+
     Parameters
     ----------
     lower_switch_distance : float
@@ -24,7 +147,18 @@ class Coulomb(BasePrior):
     energy_scale : float, optional
         Factor to multiply with energies in the dataset to convert them to Joules (*not* J/mol).
     box_vecs : torch.Tensor, optional
-        Initial box vectors for periodic boundary conditions. If None, no periodic boundary conditions are used.
+        Initial box vectors for periodic boundary conditions, in the units of the dataset. If None, no periodic
+        boundary conditions are used.
+    method : str, optional
+        One of "direct", "ewald" or "pme". Defaults to "direct".
+    cutoff_distance : float, optional
+        Real space cutoff for the Ewald methods, in nm like the switching distances. It must not be smaller than
+        `upper_switch_distance`.
+    ewald_error_tolerance : float, optional
+        Approximate relative error of the Ewald methods, which determines the splitting parameter, the number of wave
+        vectors and the size of the PME grid. Defaults to 5e-4.
+    pme_order : int, optional
+        Order of the B-splines used to spread the charges with PME. Defaults to 5.
     dataset : Dataset
         Dataset object.
 
@@ -33,30 +167,69 @@ class Coulomb(BasePrior):
     The Dataset used with this class must include a `partial_charges` field for each sample, and provide
     `distance_scale` and `energy_scale` attributes if they are not explicitly passed as arguments.
     """
-    def __init__(self, lower_switch_distance, upper_switch_distance, max_num_neighbors, distance_scale=None, energy_scale=None, box_vecs=None, dataset=None):
+    def __init__(self, lower_switch_distance, upper_switch_distance, max_num_neighbors, distance_scale=None, energy_scale=None, box_vecs=None, method="direct", cutoff_distance=None, ewald_error_tolerance=5e-4, pme_order=5, dataset=None):
         super(Coulomb, self).__init__()
         if distance_scale is None:
             distance_scale = dataset.distance_scale
         if energy_scale is None:
             energy_scale = dataset.energy_scale
-        self.distance = OptimizedDistance(0, torch.inf, max_num_pairs=-max_num_neighbors)
+        assert method in ["direct", "ewald", "pme"], f'Unknown method "{method}". Choose from direct, ewald, pme.'
+        if method == "direct":
+            self.distance = OptimizedDistance(0, torch.inf, max_num_pairs=-max_num_neighbors)
+        else:
+            assert cutoff_distance is not None, f"The {method} method requires a cutoff_distance"
+            assert cutoff_distance >= upper_switch_distance, "cutoff_distance must be at least upper_switch_distance"
+            self.distance = OptimizedDistance(0, cutoff_distance, max_num_pairs=-max_num_neighbors)
         self.lower_switch_distance = lower_switch_distance
         self.upper_switch_distance = upper_switch_distance
         self.max_num_neighbors = max_num_neighbors
         self.distance_scale = float(distance_scale)
         self.energy_scale = float(energy_scale)
         self.initial_box = box_vecs
+        self.method = method
+        self.cutoff_distance = cutoff_distance
+        self.ewald_error_tolerance = float(ewald_error_tolerance)
+        self.pme_order = int(pme_order)
+        # Ewald splitting parameter, as chosen by OpenMM
+        self.alpha = (
+            math.sqrt(-math.log(2 * self.ewald_error_tolerance)) / cutoff_distance
+            if cutoff_distance is not None
+            else 0.0
+        )
+
     def get_init_args(self):
         return {'lower_switch_distance': self.lower_switch_distance,
                 'upper_switch_distance': self.upper_switch_distance,
                 'max_num_neighbors': self.max_num_neighbors,
                 'distance_scale': self.distance_scale,
                 'energy_scale': self.energy_scale,
-                'initial_box': self.initial_box}
+                'box_vecs': self.initial_box,
+                'method': self.method,
+                'cutoff_distance': self.cutoff_distance,
+                'ewald_error_tolerance': self.ewald_error_tolerance,
+                'pme_order': self.pme_order}
 
     def reset_parameters(self):
         pass
 
+    def _reciprocal_energy(self, x: Tensor, charges: Tensor, batch: Tensor, box: Tensor, n_samples: int) -> Tensor:
+        # Reciprocal space, self and neutralizing background terms of each sample
+        energies = []
+        for i in range(n_samples):
+            mask = batch == i
+            x_i = x[mask]
+            q_i = charges[mask]
+            box_i = box if box.dim() == 2 else box[i]
+            if self.method == "pme":
+                energy = _pme_reciprocal_energy(x_i, q_i, box_i, self.alpha, self.ewald_error_tolerance, self.pme_order)
+            else:
+                energy = _ewald_reciprocal_energy(x_i, q_i, box_i, self.alpha, self.ewald_error_tolerance)
+            energy = energy - self.alpha / math.sqrt(math.pi) * (q_i**2).sum()
+            volume = box_i[0, 0] * box_i[1, 1] * box_i[2, 2]
+            energy = energy - math.pi * q_i.sum() ** 2 / (2 * volume * self.alpha**2)
+            energies.append(energy)
+        return torch.stack(energies)
+
     def post_reduce(self, y, z, pos, batch, box: Optional[torch.Tensor] = None, extra_args: Optional[Dict[str, torch.Tensor]] = None):
         """ Compute the Coulomb energy for each sample in a batch.
 
@@ -71,7 +244,7 @@ class Coulomb(BasePrior):
         batch : torch.Tensor
             Tensor of shape (num_atoms,) containing the batch index for each atom in the batch.
         box : torch.Tensor, optional
-            Tensor of shape (3, 3) containing the box vectors for the batch. If None, use the initial box vectors.
+            Tensor of shape (3, 3) or (batch_size, 3, 3) containing the box vectors for the batch. If None, use the initial box vectors.
         extra_args : dict, optional
             Dictionary of extra arguments. Must contain a `partial_charges` field.
 
@@ -83,15 +256,28 @@ class Coulomb(BasePrior):
         # Convert to nm and calculate distance.
         x = 1e9*self.distance_scale*pos
         box = box if box is not None else self.initial_box
+        if box is not None:
+            box = 1e9*self.distance_scale*box.to(x.dtype)
         edge_index, distance, _ = self.distance(x, batch, box=box)
 
         # Compute the energy, converting to the dataset's units.  Multiply by 0.5 because every atom pair
         # appears twice.
-        q = extra_args['partial_charges'][edge_index]
+        assert extra_args is not None
+        charges = extra_args['partial_charges']
+        q = charges[edge_index]
         lower = torch.tensor(self.lower_switch_distance)
         upper = torch.tensor(self.upper_switch_distance)
         phase = (torch.max(lower, torch.min(upper, distance))-lower)/(upper-lower)
-        energy = (0.5-0.5*torch.cos(torch.pi*phase))*q[0]*q[1]/distance
-        energy = 0.5*(2.30707e-28/self.energy_scale/self.distance_scale)*scatter(energy, batch[edge_index[0]], dim=0, reduce="sum")
+        switch = 0.5-0.5*torch.cos(torch.pi*phase)
+        prefactor = 2.30707e-28/self.energy_scale/self.distance_scale
+        if self.method == "direct":
+            energy = switch*q[0]*q[1]/distance
+            energy = 0.5*prefactor*scatter(energy, batch[edge_index[0]], dim=0, reduce="sum")
+        else:
+            assert box is not None, f"The {self.method} method requires periodic boundary conditions"
+            # The switching function only modifies the real space part of the Ewald sum
+            energy = (torch.erfc(self.alpha*distance)+switch-1)*q[0]*q[1]/distance
+            energy = 0.5*scatter(energy, batch[edge_index[0]], dim=0, reduce="sum", dim_size=y.shape[0])
+            energy = prefactor*(energy + self._reciprocal_energy(x, charges, batch, box, y.shape[0]))
         energy = energy.reshape(y.shape)
         return y + energy
@@ -2,7 +2,7 @@
 # Distributed under the MIT License.
 # (See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
 
-from torchmdnet.priors.base import BasePrior
+from torchmdnet.priors.base import BasePrior, get_shared_neighbors
 from torchmdnet.models.utils import OptimizedDistance, scatter
 import torch as pt
 from typing import Optional, Dict
@@ -150,6 +150,9 @@ class D2(BasePrior):
     def reset_parameters(self):
         pass
 
+    def get_neighbor_distance(self):
+        return self.distances
+
     def get_init_args(self):
         return {
             "cutoff_distance": self.cutoff_distance,
@@ -167,7 +170,9 @@ class D2(BasePrior):
         energy_scale = self.energy_scale * 6.02214076e23  # J --> J/mol
 
         # Get atom pairs and their distancence
-        ij, R_ij, _ = self.distances(pos, batch)
+        ij, R_ij, _ = self.distances(
+            pos, batch, None, get_shared_neighbors(extra_args)
+        )
         R_ij *= distance_scale
 
         # No interactions
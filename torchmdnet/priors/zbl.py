@@ -3,7 +3,7 @@
 # (See accompanying file README.md file or copy at http://opensource.org/licenses/MIT)
 
 import torch
-from torchmdnet.priors.base import BasePrior
+from torchmdnet.priors.base import BasePrior, get_shared_neighbors
 from torchmdnet.models.utils import OptimizedDistance, CosineCutoff, scatter
 from typing import Optional, Dict
 
@@ -71,8 +71,13 @@ class ZBL(BasePrior):
     def reset_parameters(self):
         pass
 
+    def get_neighbor_distance(self):
+        return self.distance
+
     def post_reduce(self, y, z, pos, batch, box: Optional[torch.Tensor] = None, extra_args: Optional[Dict[str, torch.Tensor]] = None):
-        edge_index, distance, _ = self.distance(pos, batch, box)
+        edge_index, distance, _ = self.distance(
+            pos, batch, box, get_shared_neighbors(extra_args)
+        )
         if edge_index.shape[1] == 0:
             return y
         atomic_number = self.atomic_number[z[edge_index]]
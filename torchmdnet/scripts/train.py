@@ -33,6 +33,11 @@ def get_argparse():
     parser.add_argument('--num-epochs', default=300, type=int, help='number of epochs')
     parser.add_argument('--batch-size', default=32, type=int, help='batch size')
     parser.add_argument('--inference-batch-size', default=None, type=int, help='Batchsize for validation and tests.')
+    parser.add_argument('--dynamic-batch-size', default=None, type=int, help='If set, batches are packed up to this total size (see --dynamic-batch-metric) instead of containing a fixed number of molecules. batch-size and inference-batch-size are then ignored')
+    parser.add_argument('--shuffle-block-size', default=None, type=int, help='If set, the training set is shuffled by blocks of this many consecutive samples, mixing shuffle-window-blocks blocks at a time, so that samples are read almost sequentially from disk')
+    parser.add_argument('--shuffle-window-blocks', default=4, type=int, help='Number of blocks whose samples are shuffled together with --shuffle-block-size')
+    parser.add_argument('--shuffle-prefetch', default=False, type=bool, help='With --shuffle-block-size, ask the operating system to read each window of blocks ahead (memory mapped datasets only)')
+    parser.add_argument('--dynamic-batch-metric', default='atoms', type=str, choices=['atoms', 'edges'], help='Size measure used by --dynamic-batch-size: the number of atoms, or an estimate of the number of edges using max-num-neighbors')
     parser.add_argument('--lr', default=1e-4, type=float, help='learning rate')
     parser.add_argument('--lr-patience', type=int, default=10, help='Patience for lr-schedule. Patience per eval-interval of validation')
     parser.add_argument('--lr-metric', type=str, default='val_total_mse_loss', choices=['train_total_mse_loss', 'val_total_mse_loss'], help='Metric to monitor when deciding whether to reduce learning rate')
@@ -68,6 +73,7 @@ def get_argparse():
     parser.add_argument('--energy-files', default=None, type=str, help='Custom energy files glob')
     parser.add_argument('--force-files', default=None, type=str, help='Custom force files glob')
     parser.add_argument('--dataset-preload-limit', default=1024, type=int, help='Custom and HDF5 datasets will preload to RAM datasets that are less than this size in MB')
+    parser.add_argument('--dataset-preload-shared', action='store_true', help='Custom and HDF5 datasets are preloaded once per node into /dev/shm, shared by all ranks and workers, instead of once per process')
     parser.add_argument('--y-weight', default=1.0, type=float, help='Weighting factor for y label in the loss function')
     parser.add_argument('--neg-dy-weight', default=1.0, type=float, help='Weighting factor for neg_dy label in the loss function')
 
@@ -87,6 +93,7 @@ def get_argparse():
     parser.add_argument('--trainable-rbf', type=bool, default=False, help='If distance expansion functions should be trainable')
     parser.add_argument('--neighbor-embedding', type=bool, default=False, help='If a neighbor embedding should be applied before interactions')
     parser.add_argument('--aggr', type=str, default='add', help='Aggregation operation for CFConv filter output. Must be one of \'add\', \'mean\', or \'max\'')
+    parser.add_argument('--fused-cfconv', type=bool, default=False, help='If true, the CFConv layers generate their filters in chunks of edges inside a fused operation, without storing the filters of all edges for the backward pass.')
 
     # Transformer specific
     parser.add_argument('--distance-influence', type=str, default='both', choices=['keys', 'values', 'both', 'none'], help='Where distance information is included inside the attention')
@@ -95,6 +102,7 @@ def get_argparse():
 
     # Equivariant Transformer specific
     parser.add_argument('--vector-cutoff', type=bool, default=False, help='If true, the vector features are weighted by the cutoff function during message passing, forcing the energy to be continuous at the cutoff.')
+    parser.add_argument('--fused-attention', type=bool, default=False, help='If true, the attention layers of the Equivariant Transformer sum their messages into the atoms chunk by chunk inside a fused operation, without storing the per-edge messages for the backward pass.')
 
     # TensorNet specific
     parser.add_argument('--equivariance-invariance-group', type=str, default='O(3)', help='Equivariance and invariance group of TensorNet')
@@ -104,6 +112,8 @@ def get_argparse():
         These requirements correspond to a particular rotation of the system and reduced form of the vectors, as well as the requirement that the cutoff be no larger than half the box width.
     Example: [[1,0,0],[0,1,0],[0,0,1]]""")
     parser.add_argument('--static_shapes', type=bool, default=False, help='If true, TensorNet will use statically shaped tensors for the network, making it capturable into a CUDA graphs. In some situations static shapes can lead to a speedup, but it increases memory usage.')
+    parser.add_argument('--fused-message-passing', type=bool, default=False, help='If true, TensorNet computes the messages between atoms in a compact form of the irreducible tensor components, without storing per-edge messages for the backward pass. This saves most of the memory used by the edges during training.')
+    parser.add_argument('--compact-representation', type=bool, default=False, help='If true, TensorNet keeps the atomic features as the 9 values of their irreducible components instead of 3x3 tensors, computing the matrix products in closed form. Implies --fused-message-passing.')
 
     # other args
     parser.add_argument('--check_errors', type=bool, default=True, help='Will check if max_num_neighbors is not enough to contain all neighbors. This is incompatible with CUDA graphs.')
@@ -113,6 +123,13 @@ def get_argparse():
     parser.add_argument('--atom-filter', type=int, default=-1, help='Only sum over atoms with Z > atom_filter')
     parser.add_argument('--max-z', type=int, default=100, help='Maximum atomic number that fits in the embedding matrix')
     parser.add_argument('--max-num-neighbors', type=int, default=32, help='Maximum number of neighbors to consider in the network')
+    parser.add_argument('--share-neighbors', type=bool, default=False, help='If true, a single neighbor list at the largest cutoff is computed and shared by the model and the priors that use neighbors (D2, ZBL), instead of one per module')
+    parser.add_argument('--precomputed-neighbors', type=bool, default=False, help='If true, the pairs of neighbors within cutoff-upper are computed once and stored by the dataset (only datasets based on MemmappedDataset, without periodic boxes), and the model uses them instead of searching for neighbors in every step')
+    parser.add_argument('--neighbor-skin', type=float, default=0.0, help='If positive, the neighbor list is built with cutoff-upper plus this skin and reused until an atom moves more than half of it. Useful for inference on MD trajectories, no effect on training batches')
+    parser.add_argument('--sorted-edges', type=bool, default=False, help='If true, the neighbor list is sorted by receiving atom and the messages are aggregated with deterministic segment reductions instead of atomic scatter operations')
+    parser.add_argument('--half-list', type=bool, default=False, help='If true, each pair of neighbors is searched once and its edge features are computed once and shared by both directions. Supported by graph-network, transformer and tensornet')
+    parser.add_argument('--checkpoint-layers', type=bool, default=False, help='If true, the activations of each interaction layer are recomputed in the backward pass instead of stored during training. Saves memory at the cost of time. Supported by graph-network, equivariant-transformer and tensornet')
+    parser.add_argument('--edge-forces', type=bool, default=False, help='If true, the forces are computed from the gradient of the energy with respect to the vector of each pair of neighbors, scattered into the atoms, so that the force graph does not go through the neighbor search')
     parser.add_argument('--standardize', type=bool, default=False, help='If true, multiply prediction by dataset std and add mean')
     parser.add_argument('--reduce-op', type=str, default='add', choices=['add', 'mean'], help='Reduce operation to apply to atomic predictions')
     parser.add_argument('--wandb-use', default=False, type=bool, help='Defines if wandb is used or not')
@@ -213,6 +230,8 @@ def main():
         inference_mode=False,
         # Test-during-training requires reloading the dataloaders every epoch
         reload_dataloaders_every_n_epochs=1 if args.test_interval > 0 else 0,
+        # The dynamic batch sampler shards the batches between processes by itself
+        use_distributed_sampler=not args.dynamic_batch_size,
     )
 
     trainer.fit(model, data, ckpt_path=None if args.reset_trainer else args.load_model)
@@ -4,7 +4,11 @@
 
 import yaml
 import argparse
+import hashlib
 import numpy as np
+import os
+import shutil
+import time
 import torch
 from os.path import dirname, join, exists
 from lightning_utilities.core.rank_zero import rank_zero_warn
@@ -342,6 +346,80 @@ def number(text):
     return num_float
 
 
+def sizes_from_slices(slices):
+    """Number of atoms of each sample of a collated :obj:`torch_geometric.data.InMemoryDataset`.
+
+    Args:
+        slices (dict): The slices of the dataset, which must include the atomic numbers, "z".
+
+    Returns:
+        np.ndarray: The number of atoms of each sample.
+    """
+    return np.diff(slices["z"].numpy())
+
+
+def shared_memory_arrays(files, make_arrays, description="", directory="/dev/shm", timeout=3600):
+    """Stores arrays once per node in a shared directory and maps them read-only in every process.
+
+    The arrays are identified by the paths, sizes and modification times of the files they are read from, plus a
+    description of how they are read. The first process asking for them, whichever rank or DataLoader worker it is,
+    writes the arrays returned by :obj:`make_arrays` to :obj:`directory`, the other processes wait for it to finish.
+    All of them then memory map the same files, so that with a directory in memory, such as :obj:`/dev/shm`, the data
+    is held once per node. The files are kept after the processes exit, to be reused by later runs.
+
+    Args:
+        files (list of str): Files the arrays are read from.
+        make_arrays (callable): Returns a dictionary of numpy arrays. Only called by the process writing them.
+        description (str, optional): Distinguishes arrays read differently from the same files.
+        directory (str, optional): Directory shared by the processes. (default: :obj:`/dev/shm`)
+        timeout (float, optional): Maximum time to wait for another process writing the arrays, in seconds.
+
+    Returns:
+        dict: The read-only, memory-mapped arrays.
+    """
+    key = hashlib.md5(description.encode())
+    for f in files:
+        stat = os.stat(f)
+        key.update(f"{os.path.abspath(f)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    path = join(directory, f"torchmdnet-{key.hexdigest()}")
+    done = join(path, "done")
+    try:
+        os.makedirs(path)
+    except FileExistsError:
+        start = time.time()
+        while not exists(done):
+            if time.time() - start > timeout:
+                raise TimeoutError(
+                    f"Timed out waiting for the shared arrays in {path}. If the process writing them was killed, "
+                    "remove the directory and try again."
+                )
+            time.sleep(0.1)
+    else:
+        try:
+            arrays = make_arrays()
+            for name, array in arrays.items():
+                np.save(join(path, f"{name}.npy"), np.ascontiguousarray(array))
+            with open(done + ".tmp", "w") as f:
+                f.write("\n".join(arrays))
+            os.rename(done + ".tmp", done)
+        except BaseException:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+    with open(done) as f:
+        names = f.read().split()
+    return {name: np.load(join(path, f"{name}.npy"), mmap_mode="r") for name in names}
+
+
+def read_only_tensor(array):
+    """Wraps a read-only numpy array, e.g. from :func:`shared_memory_arrays`, in a tensor without copying it.
+
+    The tensor must not be modified in place.
+    """
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+        return torch.from_numpy(array)
+
+
 class MissingEnergyException(Exception):
     pass
 